@@ -117,6 +117,15 @@ DATABASES = {
 
 
 
+# Cache
+# Map clusters/tiles are cached and invalidated on write, so multi-worker deployments
+# should point CACHE_URL at a shared backend (e.g. filecache:///tmp/catalog-cache or redis://...).
+
+CACHES = {
+    "default": env.cache("CACHE_URL", default="locmemcache://"),
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -185,8 +194,9 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 
 
 
-AWS_ACCESS_KEY_ID = env('AWS_ACCESS_KEY_ID')
-AWS_SECRET_ACCESS_KEY = env('AWS_SECRET_ACCESS_KEY')
+# Optional: without them boto3 falls back to its own credential chain (instance role, ~/.aws)
+AWS_ACCESS_KEY_ID = env('AWS_ACCESS_KEY_ID', default=None)
+AWS_SECRET_ACCESS_KEY = env('AWS_SECRET_ACCESS_KEY', default=None)
 AWS_STORAGE_BUCKET_NAME = "catalog-bkt"
 AWS_S3_REGION_NAME = "us-east-1"  # adjust as needed
 AWS_QUERYSTRING_AUTH = False
@@ -195,6 +205,50 @@ AWS_S3_CUSTOM_DOMAIN = f"{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com"
 DEFAULT_FILE_STORAGE = "storages.backends.s3boto3.S3Boto3Storage"
 MEDIA_URL = f"https://{AWS_S3_CUSTOM_DOMAIN}/"
 
+# Where CustomImage files live (home/storage.py): "s3" (the bucket above), "local" (IMAGE_STORAGE_ROOT,
+# served at IMAGE_STORAGE_URL in DEBUG), "memory" (per process, for tests and benchmarks) or a Storage class path
+IMAGE_STORAGE = env('IMAGE_STORAGE', default='s3')
+IMAGE_STORAGE_ROOT = env('IMAGE_STORAGE_ROOT', default=str(BASE_DIR / 'media'))
+IMAGE_STORAGE_URL = env('IMAGE_STORAGE_URL', default='/media/')
+
+# Background export artifacts: "local" keeps them in EXPORT_ROOT, "s3" writes them to the bucket
+EXPORT_STORAGE = env('EXPORT_STORAGE', default='local')
+EXPORT_ROOT = env('EXPORT_ROOT', default=str(BASE_DIR / 'exports'))
+# Seconds a job may stay "running" before workers assume theirs died and run it again; keep it above the slowest export
+EXPORT_JOB_TIMEOUT = env.int('EXPORT_JOB_TIMEOUT', default=60 * 60)
+# Seconds finished export jobs and their files are kept, and how long one outlives a newer export of the
+# same format and filters (so downloads already in progress can finish); run_export_jobs deletes the rest
+EXPORT_JOB_RETENTION = env.int('EXPORT_JOB_RETENTION', default=7 * 24 * 60 * 60)
+EXPORT_SUPERSEDED_RETENTION = env.int('EXPORT_SUPERSEDED_RETENTION', default=60 * 60)
+
+# Uploaded images are downscaled to this longest side and re-encoded at this JPEG quality (home/images.py)
+IMAGE_MAX_DIMENSION = env.int('IMAGE_MAX_DIMENSION', default=2048)
+IMAGE_UPLOAD_QUALITY = env.int('IMAGE_UPLOAD_QUALITY', default=85)
+
+# "sync" uploads images to storage inside the request; "async" spools them to IMAGE_SPOOL_ROOT
+# and IMAGE_UPLOAD_WORKERS background threads push them to storage (see home/uploads.py).
+# Either way the resized derivatives are made on those threads
+IMAGE_UPLOAD_MODE = env('IMAGE_UPLOAD_MODE', default='sync')
+IMAGE_SPOOL_ROOT = env('IMAGE_SPOOL_ROOT', default=str(BASE_DIR / 'upload_spool'))
+IMAGE_UPLOAD_WORKERS = env.int('IMAGE_UPLOAD_WORKERS', default=4)
+
+# Image URLs are memoized per process in an LRU of this many entries (0 disables it);
+# IMAGE_STORE_URLS also saves each image's URL on its row so rendering doesn't touch the storage at all
+IMAGE_URL_CACHE_SIZE = env.int('IMAGE_URL_CACHE_SIZE', default=10000)
+IMAGE_STORE_URLS = env.bool('IMAGE_STORE_URLS', default=False)
+
+# Let browsers POST images straight to the bucket with a presigned policy instead of through Django
+# (home/direct_uploads.py); needs the S3 storage and a CORS rule on the bucket allowing POST from the site.
+# Confirmed uploads are normalized and moved to their final key on the IMAGE_UPLOAD_WORKERS threads
+IMAGE_DIRECT_UPLOADS = env.bool('IMAGE_DIRECT_UPLOADS', default=False)
+IMAGE_DIRECT_UPLOAD_MAX_BYTES = env.int('IMAGE_DIRECT_UPLOAD_MAX_BYTES', default=20 * 1024 * 1024)
+IMAGE_DIRECT_UPLOAD_EXPIRES = env.int('IMAGE_DIRECT_UPLOAD_EXPIRES', default=600)
+
+# New trees within this many meters of an existing tree of the same species count as duplicates.
+# TREE_DUPLICATE_ACTION: "warn" saves the tree and reports the match, "merge" folds it into the existing tree, "off" skips the check
+TREE_DUPLICATE_RADIUS_M = env.float('TREE_DUPLICATE_RADIUS_M', default=5.0)
+TREE_DUPLICATE_ACTION = env('TREE_DUPLICATE_ACTION', default='warn')
+
 SOCIALACCOUNT_PROVIDERS = {
     "google": {
         "SCOPE": [
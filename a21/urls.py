@@ -14,6 +14,8 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 # from home.views import google_login_redirect
@@ -27,4 +29,8 @@ urlpatterns = [
     # path('accounts/login/', google_login_redirect, name='account_login'),
 
 
-]
\ No newline at end of file
+]
+
+if settings.IMAGE_STORAGE == 'local':
+    # Development only: static() adds nothing unless DEBUG is on
+    urlpatterns += static(settings.IMAGE_STORAGE_URL, document_root=settings.IMAGE_STORAGE_ROOT)
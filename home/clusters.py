@@ -0,0 +1,126 @@
+import math
+
+from django.core.cache import cache
+from django.db.models import Count, ExpressionWrapper, F, FloatField, Sum, Value
+from django.db.models.functions import Cos, Floor, Ln, Radians, Tan
+
+from .geo import BBox, MAX_LATITUDE, filter_bbox, tile_bounds, tiles_for_bbox, world_fraction
+from .map_cache import current_generation
+from .models import TreeSubmission
+
+# Each map tile is split into CELLS_PER_TILE x CELLS_PER_TILE grid cells (32px cells on 256px tiles)
+CELLS_PER_TILE = 8
+MAX_CLUSTER_ZOOM = 18
+# Refuse requests that would aggregate more tiles than a large screen can show
+MAX_CLUSTER_TILES = 64
+# Signals invalidate tiles as trees change; the timeout only bounds staleness from queryset.update()
+CLUSTER_CACHE_TIMEOUT = 60 * 60
+
+
+def cluster_cache_key(generation, zoom, x, y):
+    return f"tree_clusters:{generation}:{zoom}:{x}:{y}"
+
+
+def _cell_expressions(zoom):
+    """Database expressions for the global grid cell (x, y) of a tree at this zoom"""
+    cells = float((1 << zoom) * CELLS_PER_TILE)
+    lat = Radians('latitude')
+    # Web-mercator y as a fraction of the map height: (1 - ln(tan(lat) + sec(lat)) / pi) / 2
+    mercator = Ln(Tan(lat) + Value(1.0) / Cos(lat))
+    cell_x = Floor(ExpressionWrapper(
+        (F('longitude') + Value(180.0)) / Value(360.0) * Value(cells),
+        output_field=FloatField(),
+    ))
+    cell_y = Floor(ExpressionWrapper(
+        (Value(1.0) - mercator / Value(math.pi)) / Value(2.0) * Value(cells),
+        output_field=FloatField(),
+    ))
+    return cell_x, cell_y
+
+
+def _aggregate_tiles(zoom, tiles):
+    """
+    Run one grouped query over the area covered by the tiles and fold the rows
+    into {(x, y): [cluster, ...]}. Every requested tile gets an entry, even when empty.
+    """
+    xs = [x for x, _ in tiles]
+    ys = [y for _, y in tiles]
+    # tiles are ordered west to east, so the first/last columns also handle antimeridian wrap
+    west, east = tile_bounds(xs[0], 0, zoom), tile_bounds(xs[-1], 0, zoom)
+    north, south = tile_bounds(0, min(ys), zoom), tile_bounds(0, max(ys), zoom)
+    area = BBox(
+        west.min_lon,
+        max(south.min_lat, -MAX_LATITUDE),
+        east.max_lon,
+        min(north.max_lat, MAX_LATITUDE),
+    )
+
+    cell_x, cell_y = _cell_expressions(zoom)
+    rows = (
+        filter_bbox(TreeSubmission.objects.filter(is_deleted=False), area)
+        .annotate(cell_x=cell_x, cell_y=cell_y)
+        .values('cell_x', 'cell_y', 'species')
+        .annotate(count=Count('id'), lat_sum=Sum('latitude'), lon_sum=Sum('longitude'))
+        .order_by()
+    )
+
+    wanted = set(tiles)
+    max_cell = (1 << zoom) * CELLS_PER_TILE - 1
+    cells = {}
+    for row in rows:
+        cx = min(int(row['cell_x']), max_cell)
+        cy = min(max(int(row['cell_y']), 0), max_cell)
+        tile = (cx // CELLS_PER_TILE, cy // CELLS_PER_TILE)
+        if tile not in wanted:
+            continue
+        cell = cells.setdefault((tile, cx, cy), {'count': 0, 'lat_sum': 0.0, 'lon_sum': 0.0, 'species': {}})
+        cell['count'] += row['count']
+        cell['lat_sum'] += row['lat_sum']
+        cell['lon_sum'] += row['lon_sum']
+        cell['species'][row['species']] = cell['species'].get(row['species'], 0) + row['count']
+
+    result = {tile: [] for tile in tiles}
+    for (tile, _, _), cell in cells.items():
+        result[tile].append({
+            'latitude': cell['lat_sum'] / cell['count'],
+            'longitude': cell['lon_sum'] / cell['count'],
+            'count': cell['count'],
+            'species': cell['species'],
+        })
+    return result
+
+
+def get_clusters(zoom, bbox):
+    """
+    Return the tree clusters for every tile touching the bbox at this zoom,
+    serving tiles from the cache and aggregating the missing ones in a single query.
+    """
+    tiles = tiles_for_bbox(bbox, zoom, max_tiles=MAX_CLUSTER_TILES)
+
+    generation = current_generation()
+    keys = {tile: cluster_cache_key(generation, zoom, *tile) for tile in tiles}
+    cached = cache.get_many(list(keys.values()))
+    missing = [tile for tile in tiles if keys[tile] not in cached]
+
+    clusters = []
+    for tile in tiles:
+        if keys[tile] in cached:
+            clusters.extend(cached[keys[tile]])
+
+    if missing:
+        fresh = _aggregate_tiles(zoom, missing)
+        cache.set_many({keys[tile]: fresh[tile] for tile in missing}, CLUSTER_CACHE_TIMEOUT)
+        for tile in missing:
+            clusters.extend(fresh[tile])
+
+    return clusters
+
+
+def cluster_keys_for_point(latitude, longitude, generation):
+    """Cache keys of the cluster tiles containing this point at every zoom level"""
+    fx, fy = world_fraction(longitude, latitude)
+    keys = []
+    for zoom in range(MAX_CLUSTER_ZOOM + 1):
+        n = 1 << zoom
+        keys.append(cluster_cache_key(generation, zoom, min(int(fx * n), n - 1), min(int(fy * n), n - 1)))
+    return keys
@@ -1,3 +1,5 @@
+from django.db.models import F
+
 from home.models import Message, Notification
 
 def unread_messages(request):
@@ -5,13 +7,12 @@ def unread_messages(request):
     Context processor to provide unread message count globally in templates.
     """
     if request.user.is_authenticated:
-        # Count messages where user is a participant but hasn't read them and isn't the sender
+        # Messages from others past the user's read watermark in each of their conversations
         unread_count = Message.objects.filter(
-            conversation__participants=request.user
+            conversation__memberships__user=request.user,
+            id__gt=F('conversation__memberships__last_read_message_id'),
         ).exclude(
             sender=request.user
-        ).exclude(
-            read_by=request.user
         ).count()
 
         return {'unread_message_count': unread_count}
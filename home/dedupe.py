@@ -0,0 +1,131 @@
+from django.conf import settings
+from django.db import transaction
+
+from .geo import grid_cell, grid_cells_near_cell, grid_cells_within, haversine_m
+from .models import CustomImage, TreeSubmission
+from .orphans import without_references
+
+# Attributes a merged duplicate may fill in on the existing tree when it has none
+MERGE_FIELDS = ('height', 'diameter', 'description', 'image')
+
+
+def find_duplicate(species, latitude, longitude, radius_m=None, exclude_id=None):
+    """
+    Return the closest live tree of the same species within radius_m, or None.
+    Only the grid cells around the point are read, so the cost doesn't grow with the catalog.
+    """
+    if radius_m is None:
+        radius_m = settings.TREE_DUPLICATE_RADIUS_M
+    candidates = TreeSubmission.objects.filter(
+        grid_cell__in=grid_cells_within(latitude, longitude, radius_m),
+        species=species,
+        is_deleted=False,
+    )
+    if exclude_id is not None:
+        candidates = candidates.exclude(id=exclude_id)
+
+    best, best_distance = None, radius_m
+    for tree in candidates:
+        distance = haversine_m(latitude, longitude, tree.latitude, tree.longitude)
+        if distance <= best_distance:
+            best, best_distance = tree, distance
+    return best
+
+
+def discard_unused_images(image_ids):
+    """Delete the given CustomImage rows that nothing references any more (their files go once unshared)"""
+    image_ids = [image_id for image_id in image_ids if image_id]
+    if image_ids:
+        without_references(CustomImage.objects.filter(id__in=image_ids)).delete()
+
+
+def save_tree(tree, action=None):
+    """
+    Save a new tree, applying the TREE_DUPLICATE_ACTION setting.
+    Returns (tree, duplicate): with "merge" a duplicate absorbs the new tree and is returned as both,
+    with "warn" the new tree is saved and the nearby match is returned alongside it.
+    A merged submission's image is deleted unless the existing tree takes it over.
+    """
+    action = action or settings.TREE_DUPLICATE_ACTION
+    duplicate = None
+    if action != 'off':
+        duplicate = find_duplicate(tree.species, float(tree.latitude), float(tree.longitude))
+
+    if duplicate is not None and action == 'merge':
+        changed = [field for field in MERGE_FIELDS
+                   if not getattr(duplicate, field) and getattr(tree, field)]
+        for field in changed:
+            setattr(duplicate, field, getattr(tree, field))
+        with transaction.atomic():
+            if changed:
+                duplicate.save()
+            discard_unused_images([tree.image_id])
+        return duplicate, duplicate
+
+    tree.save()
+    return tree, duplicate
+
+
+def find_duplicate_clusters(radius_m=None, queryset=None):
+    """
+    Group live trees of the same species around a keeper: the oldest tree not yet grouped takes every
+    younger ungrouped tree within radius_m of itself. Membership is measured from the keeper only, so
+    a row of evenly spaced street trees doesn't chain into one group.
+    Trees are bucketed by grid cell in one pass and only compared with trees in neighbouring cells,
+    so the work is roughly linear in the catalog size. Returns lists of tree ids, oldest first.
+    """
+    if radius_m is None:
+        radius_m = settings.TREE_DUPLICATE_RADIUS_M
+    if queryset is None:
+        queryset = TreeSubmission.objects.filter(is_deleted=False)
+
+    trees = []
+    buckets = {}
+    points = queryset.order_by('id').values_list('id', 'species', 'latitude', 'longitude').iterator(chunk_size=5000)
+    for tree_id, species, latitude, longitude in points:
+        cell = grid_cell(latitude, longitude)
+        trees.append((tree_id, cell, species, latitude, longitude))
+        buckets.setdefault((cell, species), []).append((tree_id, latitude, longitude))
+
+    grouped = set()
+    clusters = []
+    # Oldest first, so every keeper is the tree merge_duplicate_cluster will keep
+    for keeper_id, cell, species, lat, lon in trees:
+        if keeper_id in grouped:
+            continue
+        members = [keeper_id]
+        for other_cell in grid_cells_near_cell(cell, radius_m):
+            for other_id, other_lat, other_lon in buckets.get((other_cell, species), ()):
+                if other_id <= keeper_id or other_id in grouped:
+                    continue
+                if haversine_m(lat, lon, other_lat, other_lon) <= radius_m:
+                    members.append(other_id)
+        if len(members) > 1:
+            grouped.update(members)
+            clusters.append(sorted(members))
+    return clusters
+
+
+@transaction.atomic
+def merge_duplicate_cluster(tree_ids):
+    """
+    Keep the oldest tree of a cluster, fill its missing attributes from the others and soft-delete the rest.
+    The removed trees let go of their images; the ones the keeper didn't take over are deleted.
+    """
+    trees = list(TreeSubmission.objects.select_for_update().filter(id__in=tree_ids).order_by('id'))
+    keeper, duplicates = trees[0], trees[1:]
+    changed = False
+    released = []
+    for duplicate in duplicates:
+        for field in MERGE_FIELDS:
+            if not getattr(keeper, field) and getattr(duplicate, field):
+                setattr(keeper, field, getattr(duplicate, field))
+                changed = True
+        released.append(duplicate.image_id)
+        duplicate.is_deleted = True
+        duplicate.image = None
+        duplicate.save(update_fields=['is_deleted', 'image', 'updated_at'])
+    if changed:
+        keeper.save()
+    discard_unused_images(released)
+    return keeper
@@ -0,0 +1,192 @@
+import logging
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.db import IntegrityError, transaction
+
+from .images import ensure_derivatives, normalize_upload
+from .models import STAGING_PREFIX, CustomImage, custom_image_path
+from .uploads import claim_upload, find_stored_copy, hash_upload, queue_upload
+
+logger = logging.getLogger(__name__)
+
+# Content types a ticket can be issued for -> extension of the staged object
+DIRECT_UPLOAD_CONTENT_TYPES = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'image/gif': '.gif',
+}
+# What the staged file's leading bytes must identify it as; the full decode happens in the upload worker
+DIRECT_UPLOAD_FORMATS = {'JPEG', 'PNG', 'WEBP', 'GIF'}
+# Enough leading bytes to tell those formats apart
+SNIFF_BYTES = 16
+TICKET_SALT = "home.direct_uploads"
+
+
+class DirectUploadError(Exception):
+    """A ticket request or confirmation the client has to fix; the message is safe to show"""
+
+
+def _storage():
+    return CustomImage._meta.get_field('image').storage
+
+
+def _bucket_key(storage, name):
+    location = storage.location.strip('/')
+    return f"{location}/{name}" if location else name
+
+
+def create_upload_ticket(user, category, content_type, size):
+    """
+    Reserve a staging key for one image and return what the browser needs to POST it straight to the bucket:
+    {"url", "fields", "ticket"}. The presigned policy pins the key, the content type and the maximum size;
+    the ticket is a signed token to hand back to confirm_upload().
+    """
+    if category not in dict(CustomImage.CATEGORY_CHOICES):
+        raise DirectUploadError("Unknown image category.")
+    extension = DIRECT_UPLOAD_CONTENT_TYPES.get(content_type)
+    if extension is None:
+        raise DirectUploadError("Please upload a JPEG, PNG, WebP or GIF image.")
+    max_bytes = settings.IMAGE_DIRECT_UPLOAD_MAX_BYTES
+    if size is not None and not 0 < size <= max_bytes:
+        raise DirectUploadError(f"Images can be at most {max_bytes // (1024 * 1024)} MB.")
+
+    storage = _storage()
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is None:
+        raise DirectUploadError("Direct uploads are not available; attach the image to the form instead.")
+
+    name = f"{STAGING_PREFIX}/{user.pk}/{uuid.uuid4().hex}{extension}"
+    post = bucket.meta.client.generate_presigned_post(
+        Bucket=bucket.name,
+        Key=_bucket_key(storage, name),
+        Fields={'Content-Type': content_type},
+        Conditions=[{'Content-Type': content_type}, ['content-length-range', 1, max_bytes]],
+        ExpiresIn=settings.IMAGE_DIRECT_UPLOAD_EXPIRES,
+    )
+    ticket = signing.dumps({'name': name, 'user': user.pk, 'category': category}, salt=TICKET_SALT)
+    return {'url': post['url'], 'fields': post['fields'], 'ticket': ticket}
+
+
+def _sniff_format(data):
+    """Image format named by a file's leading bytes, or None"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'GIF'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def _inspect_staged(storage, name):
+    """(size, format) of a staged object from a HEAD and a ranged read of its first bytes; None if it isn't there"""
+    client = storage.bucket.meta.client
+    key = _bucket_key(storage, name)
+    try:
+        size = client.head_object(Bucket=storage.bucket.name, Key=key)['ContentLength']
+    except client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    if not size:
+        return 0, None
+    leading = client.get_object(Bucket=storage.bucket.name, Key=key, Range=f"bytes=0-{SNIFF_BYTES - 1}")['Body'].read()
+    return size, _sniff_format(leading)
+
+
+def confirm_upload(user, ticket, private=False):
+    """
+    Accept a staged upload once the browser reports it done and return its CustomImage, still pending.
+    The request only checks the ticket and, from a HEAD and a ranged read of the first bytes, the stored size
+    and format; the object is not pulled through the web process. An upload worker then normalizes and hashes
+    it like a form upload, stores it under its content-addressed key (see finish_direct_upload) and deletes
+    the staged object. A rejected upload's staged object is deleted straight away.
+    """
+    try:
+        # Tickets outlive their presigned POST a little, for uploads that finish right at the deadline
+        claims = signing.loads(ticket, salt=TICKET_SALT, max_age=settings.IMAGE_DIRECT_UPLOAD_EXPIRES * 2)
+    except signing.BadSignature:
+        raise DirectUploadError("This upload has expired. Please try again.")
+    if claims['user'] != user.pk:
+        raise DirectUploadError("This upload belongs to someone else.")
+
+    storage = _storage()
+    name = claims['name']
+    if CustomImage.objects.filter(image=name).exists():
+        raise DirectUploadError("This upload has already been confirmed.")
+    inspected = _inspect_staged(storage, name)
+    if inspected is None:
+        raise DirectUploadError("The image has not been uploaded yet.")
+
+    size, image_format = inspected
+    try:
+        if size > settings.IMAGE_DIRECT_UPLOAD_MAX_BYTES:
+            raise DirectUploadError("This image is too large.")
+        if image_format not in DIRECT_UPLOAD_FORMATS:
+            raise DirectUploadError("Please upload a JPEG, PNG, WebP or GIF image.")
+    except DirectUploadError:
+        storage.delete(name)
+        raise
+
+    image = CustomImage(user=user, category=claims['category'], private=private, status='pending')
+    # The staged name until the worker has stored the normalized file
+    image.image.name = name
+    try:
+        with transaction.atomic():
+            image.save()
+    except IntegrityError:
+        # A concurrent confirmation of the same ticket got there first (customimage_unique_staged_upload)
+        raise DirectUploadError("This upload has already been confirmed.")
+    queue_upload(finish_direct_upload, image.pk)
+    return image
+
+
+def finish_direct_upload(image_id):
+    """
+    Upload worker job for a confirmed direct upload: normalize the staged file, store it under its content hash
+    (or point at an identical stored copy), mark the image ready and delete the staged object.
+    Returns the image, or None when it was not pending here.
+    """
+    if not claim_upload(image_id):
+        return None
+    image = CustomImage.objects.get(id=image_id)
+    storage = image.image.storage
+    staged = image.image.name
+    try:
+        with storage.open(staged, 'rb') as f:
+            normalized = normalize_upload(f)
+        image.content_hash = hash_upload(normalized)
+        with transaction.atomic():
+            existing = find_stored_copy(image.content_hash)
+            if existing is not None:
+                image.image.name = existing.image.name
+                image.derivatives = existing.derivatives
+                image.width, image.height = existing.width, existing.height
+            else:
+                image.image.name = storage.save(custom_image_path(image, normalized.name), normalized)
+                image.width, image.height = normalized.image_size
+            image.status = 'ready'
+            image.save(update_fields=['image', 'content_hash', 'derivatives', 'width', 'height', 'status'])
+    except Exception:
+        logger.exception("Direct upload of image %s failed", image_id)
+        CustomImage.objects.filter(id=image_id).update(status='failed')
+        image.status = 'failed'
+        return image
+    finally:
+        storage.delete(staged)
+
+    # The normalized bytes are still in memory; a reused copy already has its derivatives
+    ensure_derivatives(image, normalized)
+    return image
+
+
+def claim_uploaded_image(image_id, user, category):
+    """The confirmed upload `image_id` if it is the user's and of this category, for forms to attach; else None"""
+    if not image_id:
+        return None
+    return CustomImage.objects.filter(id=image_id, user=user, category=category).first()
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+
+from .exports import EXPORT_FORMATS, EXPORT_WRITERS, export_rows, filter_export_trees
+from .models import ExportJob, TreeSubmission
+
+logger = logging.getLogger(__name__)
+
+# Request parameters that affect the export contents (see filter_export_trees)
+EXPORT_FILTER_PARAMS = ('bbox', 'species', 'start', 'end', 'submitter', 'flagged')
+
+
+def normalize_export_params(params):
+    """Keep the filter parameters as {name: sorted values} so equal requests hash the same"""
+    normalized = {}
+    for name in EXPORT_FILTER_PARAMS:
+        values = sorted(v for v in params.getlist(name) if v)
+        if values:
+            normalized[name] = values
+    return normalized
+
+
+def catalog_version():
+    """Cheap stamp that changes whenever any tree is added, edited or removed"""
+    stats = TreeSubmission.objects.aggregate(latest=Max('updated_at'), total=Count('id'))
+    latest = stats['latest'].isoformat() if stats['latest'] else ''
+    return f"{latest}:{stats['total']}"
+
+
+def export_job_key(export_format, params):
+    payload = json.dumps(
+        {'format': export_format, 'params': params, 'catalog': catalog_version()},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def request_export(export_format, params, user=None):
+    """
+    Return the job for this export, creating it (or re-queueing a failed or stale one) when needed.
+    Raises ValueError for an unknown format or malformed filters.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("format must be one of: csv, geojson, ndjson")
+
+    params = normalize_export_params(params)
+    # Validate the filters now rather than failing later in the worker
+    filter_export_trees(MultiValueDict(params))
+
+    job, created = ExportJob.objects.get_or_create(
+        key=export_job_key(export_format, params),
+        defaults={'format': export_format, 'params': params, 'requested_by': user},
+    )
+    if job.status == 'failed':
+        job.status = 'pending'
+        job.error = ''
+        job.save(update_fields=['status', 'error'])
+    elif job.status == 'running' and requeue_stale_jobs(ExportJob.objects.filter(id=job.id)):
+        job.refresh_from_db()
+    return job, created
+
+
+def requeue_stale_jobs(jobs=None):
+    """
+    Put running jobs whose worker has been at them for longer than EXPORT_JOB_TIMEOUT back in the queue:
+    a worker that crashed or was killed mid-export never finishes them. Returns how many were re-queued.
+    """
+    jobs = ExportJob.objects.all() if jobs is None else jobs
+    cutoff = timezone.now() - timedelta(seconds=settings.EXPORT_JOB_TIMEOUT)
+    return jobs.filter(status='running', started_at__lt=cutoff).update(status='pending', started_at=None)
+
+
+def claim_next_job():
+    """
+    Atomically move the oldest pending job to running, after re-queueing stale ones;
+    returns None when the queue is empty
+    """
+    requeue_stale_jobs()
+    while True:
+        job_id = ExportJob.objects.filter(status='pending').values_list('id', flat=True).first()
+        if job_id is None:
+            return None
+        claimed = ExportJob.objects.filter(id=job_id, status='pending').update(
+            status='running', started_at=timezone.now()
+        )
+        # Another worker may have claimed it first; try the next one
+        if claimed:
+            return ExportJob.objects.get(id=job_id)
+
+
+def run_export_job(job):
+    """Write the export to a temporary file, then store it as the job's artifact"""
+    _, extension = EXPORT_FORMATS[job.format]
+    try:
+        trees = filter_export_trees(MultiValueDict(job.params))
+        with tempfile.TemporaryFile() as tmp:
+            for chunk in EXPORT_WRITERS[job.format](export_rows(trees)):
+                tmp.write(chunk.encode('utf-8'))
+            job.size = tmp.tell()
+            tmp.seek(0)
+            job.file.save(f"{job.key}.{extension}", File(tmp), save=False)
+    except Exception as e:
+        job.status = 'failed'
+        job.error = str(e)
+    else:
+        job.status = 'done'
+    job.finished_at = timezone.now()
+    job.save()
+    return job
+
+
+def expired_jobs(now=None):
+    """
+    Finished jobs that can go: those older than EXPORT_JOB_RETENTION, and those a newer finished export of the
+    same format and filters replaced more than EXPORT_SUPERSEDED_RETENTION ago. Every tree edit changes the
+    catalog stamp in the key, so without this each edit leaves another artifact behind for good.
+    """
+    now = now or timezone.now()
+    finished = ExportJob.objects.filter(status__in=['done', 'failed'])
+    expired = set(finished.filter(
+        finished_at__lt=now - timedelta(seconds=settings.EXPORT_JOB_RETENTION)
+    ).values_list('id', flat=True))
+
+    superseded_cutoff = now - timedelta(seconds=settings.EXPORT_SUPERSEDED_RETENTION)
+    # Finish time of the newest done job per (format, filters)
+    replaced_at = {}
+    rows = finished.order_by('-created_at', '-id').values_list('id', 'format', 'params', 'status', 'finished_at')
+    for job_id, export_format, params, status, finished_at in rows.iterator(chunk_size=2000):
+        group = (export_format, json.dumps(params, sort_keys=True))
+        if group in replaced_at:
+            if replaced_at[group] < superseded_cutoff:
+                expired.add(job_id)
+        elif status == 'done' and finished_at is not None:
+            replaced_at[group] = finished_at
+    return ExportJob.objects.filter(id__in=expired)
+
+
+def delete_expired_jobs(now=None):
+    """Delete expired_jobs() and their artifacts; a job whose file can't be deleted is kept for the next run"""
+    deleted = 0
+    for job in expired_jobs(now).iterator():
+        if job.file:
+            try:
+                job.file.delete(save=False)
+            except Exception:
+                logger.exception("Could not delete export artifact %s", job.file.name)
+                continue
+        job.delete()
+        deleted += 1
+    return deleted
@@ -0,0 +1,174 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .geo import filter_bbox, parse_bbox
+from .models import TreeSubmission
+
+EXPORT_CHUNK_SIZE = 2000
+
+CSV_HEADER = ["ID", "Species", "Description", "Latitude", "Longitude", "Submitted By", "Date"]
+
+# Only the columns the exports need, with the submitter joined in the same query
+EXPORT_FIELDS = (
+    'id',
+    'species',
+    'description',
+    'latitude',
+    'longitude',
+    'height',
+    'diameter',
+    'is_flagged',
+    'user__nickname',
+    'user__username',
+    'submitted_at',
+)
+
+# format name -> (content type, file extension)
+EXPORT_FORMATS = {
+    'csv': ("text/csv", "csv"),
+    'geojson': ("application/geo+json", "geojson"),
+    'ndjson': ("application/x-ndjson", "ndjson"),
+}
+
+
+class Echo:
+    """File-like object whose write() hands the value back, so csv.writer can feed a generator"""
+
+    def write(self, value):
+        return value
+
+
+def _parse_day(value):
+    try:
+        return parse_date(value)
+    except ValueError:
+        # Well-formed but impossible, e.g. 2024-13-01
+        raise ValueError(f"Invalid date: {value}")
+
+
+def _parse_boundary(value, end=False):
+    """Parse a date or datetime filter value; a bare end date includes that whole day"""
+    # Dates first: parse_datetime() also accepts a bare date, as midnight
+    day = _parse_day(value)
+    if day is not None:
+        if end:
+            day += timedelta(days=1)
+        moment = datetime.combine(day, time.min)
+    else:
+        moment = parse_datetime(value)
+        if moment is None:
+            raise ValueError(f"Invalid date: {value}")
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def filter_export_trees(params):
+    """
+    Build the export queryset from request parameters:
+    bbox, species (repeatable), start/end (dates or datetimes), submitter (username), flagged (true/false).
+    Raises ValueError on malformed values.
+    """
+    trees = TreeSubmission.objects.filter(is_deleted=False)
+
+    if params.get('bbox'):
+        trees = filter_bbox(trees, parse_bbox(params['bbox']))
+
+    species = [s for s in params.getlist('species') if s]
+    if species:
+        trees = trees.filter(species__in=species)
+
+    if params.get('start'):
+        trees = trees.filter(submitted_at__gte=_parse_boundary(params['start']))
+    if params.get('end'):
+        end = params['end']
+        # Bare dates are inclusive of the whole day, datetimes are exact
+        if _parse_day(end) is not None:
+            trees = trees.filter(submitted_at__lt=_parse_boundary(end, end=True))
+        else:
+            trees = trees.filter(submitted_at__lte=_parse_boundary(end))
+
+    if params.get('submitter'):
+        trees = trees.filter(user__username=params['submitter'])
+
+    flagged = params.get('flagged', '').strip().lower()
+    if flagged in ('true', '1'):
+        trees = trees.filter(is_flagged=True)
+    elif flagged in ('false', '0'):
+        trees = trees.filter(is_flagged=False)
+    elif flagged:
+        raise ValueError("flagged must be true or false")
+
+    return trees
+
+
+def export_rows(trees=None):
+    """Yield one named row per tree (see EXPORT_FIELDS) without loading the queryset into memory"""
+    if trees is None:
+        trees = TreeSubmission.objects.filter(is_deleted=False)
+    return trees.order_by('id').values_list(*EXPORT_FIELDS, named=True).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def _properties(row):
+    return {
+        'id': row.id,
+        'species': row.species,
+        'description': row.description,
+        'height': row.height,
+        'diameter': row.diameter,
+        'is_flagged': row.is_flagged,
+        'submitted_by': row.user__nickname or row.user__username,
+        'submitted_at': row.submitted_at.isoformat(),
+    }
+
+
+def iter_csv(rows):
+    """Yield the CSV export line by line"""
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for row in rows:
+        yield writer.writerow([
+            row.id,
+            row.species,
+            row.description,
+            row.latitude,
+            row.longitude,
+            row.user__nickname or row.user__username,
+            row.submitted_at.strftime("%Y-%m-%d %H:%M:%S"),
+        ])
+
+
+def iter_ndjson(rows):
+    """Yield one JSON object per line"""
+    for row in rows:
+        record = _properties(row)
+        record['latitude'] = row.latitude
+        record['longitude'] = row.longitude
+        yield json.dumps(record) + "\n"
+
+
+def iter_geojson(rows):
+    """Yield a GeoJSON FeatureCollection one feature at a time"""
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = "\n"
+    for row in rows:
+        feature = {
+            'type': 'Feature',
+            'id': row.id,
+            'geometry': {'type': 'Point', 'coordinates': [row.longitude, row.latitude]},
+            'properties': _properties(row),
+        }
+        yield separator + json.dumps(feature)
+        separator = ",\n"
+    yield "\n]}\n"
+
+
+EXPORT_WRITERS = {
+    'csv': iter_csv,
+    'geojson': iter_geojson,
+    'ndjson': iter_ndjson,
+}
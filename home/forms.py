@@ -1,5 +1,35 @@
+import math
+
 from django import forms
 from .models import CustomUser, Message, Conversation, CustomImage, TreeSubmission # <-- ADDED 'Message' IMPORT
+from .dedupe import save_tree
+from .images import normalize_upload
+from .uploads import store_uploaded_image
+from .direct_uploads import claim_uploaded_image
+from django.conf import settings
+from django.urls import reverse
+from PIL import Image
+
+def normalize_image_upload(image_file):
+    """Clean step shared by the image upload fields: downscale, apply EXIF rotation, strip metadata, re-encode"""
+    if not image_file:
+        return image_file
+    try:
+        return normalize_upload(image_file)
+    except (OSError, Image.DecompressionBombError):
+        raise forms.ValidationError('This image could not be processed. Please upload a JPEG, PNG or WebP photo.')
+
+def enable_direct_upload(form, field_name, category):
+    """
+    With IMAGE_DIRECT_UPLOADS on, mark the file input so direct-upload.js sends the file straight to the bucket
+    and submits only the confirmed image's id in the form's uploaded_image field
+    """
+    if settings.IMAGE_DIRECT_UPLOADS:
+        form.fields[field_name].widget.attrs.update({
+            'data-direct-upload': category,
+            'data-ticket-url': reverse('request_upload_ticket'),
+            'data-confirm-url': reverse('confirm_direct_upload'),
+        })
 
 class GroupConversationForm(forms.ModelForm):
     participants = forms.ModelMultipleChoiceField(
@@ -20,6 +50,8 @@ class GroupConversationForm(forms.ModelForm):
 
 class ProfileForm(forms.ModelForm):
     avatar_upload = forms.ImageField(required=False)
+    # Id of an avatar already sent to the bucket by direct-upload.js
+    uploaded_image = forms.IntegerField(required=False, widget=forms.HiddenInput)
     class Meta:
         model = CustomUser
         fields = [
@@ -33,17 +65,22 @@ class ProfileForm(forms.ModelForm):
             "nickname": forms.TextInput(),
         }
     
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        enable_direct_upload(self, "avatar_upload", "avatars")
+
+    def clean_avatar_upload(self):
+        return normalize_image_upload(self.cleaned_data.get("avatar_upload"))
+
     def save(self, commit=True, user=None):
         instance = super().save(commit=False)
         image_file = self.cleaned_data.get("avatar_upload")
 
         if image_file and user:
-            custom_image = CustomImage.objects.create(
-                image=image_file,
-                user=user,
-                category="avatars"
-            )
+            custom_image = store_uploaded_image(image_file, user, "avatars")
             instance.avatar = custom_image
+        elif user:
+            instance.avatar = claim_uploaded_image(self.cleaned_data.get("uploaded_image"), user, "avatars") or instance.avatar
 
         if commit:
             instance.save()
@@ -51,6 +88,7 @@ class ProfileForm(forms.ModelForm):
 
 class MessageForm(forms.ModelForm):
     image_upload = forms.ImageField(required=False)
+    uploaded_image = forms.IntegerField(required=False, widget=forms.HiddenInput)
     class Meta:
         model = Message
         fields = ['content']
@@ -66,11 +104,15 @@ class MessageForm(forms.ModelForm):
         super().__init__(*args, **kwargs)
         # Make content not required since user can send just an image
         self.fields['content'].required = False
+        enable_direct_upload(self, 'image_upload', 'message_attachments')
+
+    def clean_image_upload(self):
+        return normalize_image_upload(self.cleaned_data.get('image_upload'))
 
     def clean(self):
         cleaned_data = super().clean()
         content = cleaned_data.get('content')
-        image_upload = cleaned_data.get('image_upload')
+        image_upload = cleaned_data.get('image_upload') or cleaned_data.get('uploaded_image')
 
         # Require at least content or image
         if not content and not image_upload:
@@ -82,12 +124,12 @@ class MessageForm(forms.ModelForm):
         instance = super().save(commit=False)
         image_file = self.cleaned_data.get("image_upload")
         if image_file and user:
-            custom_image = CustomImage.objects.create(
-                image=image_file,
-                user=user,
-                category="message_attachments"
-            )
+            custom_image = store_uploaded_image(image_file, user, "message_attachments")
             instance.image_attachment = custom_image
+        elif user:
+            instance.image_attachment = claim_uploaded_image(
+                self.cleaned_data.get("uploaded_image"), user, "message_attachments"
+            )
 
         if commit:
             instance.save()
@@ -98,8 +140,87 @@ class CustomImagePrivacyForm(forms.ModelForm):
         model = CustomImage
         fields = ['private']
 
+# Validation rules shared by TreeForm and the bulk/file import paths
+
+def validate_tree_location(value):
+    if not value:
+        raise forms.ValidationError('Please click on the map to set a location.')
+    return value
+
+def validate_tree_species(species):
+    if not species or species == "":
+        raise forms.ValidationError('Please select a tree species from the dropdown.')
+    return species
+
+def _species_lookup_key(value):
+    return " ".join(value.replace("_", " ").replace("-", " ").lower().split())
+
+_SPECIES_LOOKUP = None
+
+def normalize_species(value):
+    """
+    Map a species key ("red_maple") or label in any case ("RED MAPLE") to its SPECIES_CHOICES label,
+    which is what the map form stores. Names that aren't in the list are returned trimmed but unchanged.
+    """
+    global _SPECIES_LOOKUP
+    if _SPECIES_LOOKUP is None:
+        _SPECIES_LOOKUP = {}
+        for key, label in SPECIES_CHOICES:
+            if key:
+                _SPECIES_LOOKUP[_species_lookup_key(key)] = label
+                _SPECIES_LOOKUP[_species_lookup_key(label)] = label
+    value = (value or "").strip()
+    return _SPECIES_LOOKUP.get(_species_lookup_key(value), value)
+
+def _optional_float(value):
+    if value is None or value == "":
+        return None
+    value = float(value)
+    # float() accepts "nan" and "inf", which TreeForm's FloatFields reject
+    if not math.isfinite(value):
+        raise ValueError("not a finite number")
+    return value
+
+def clean_tree_row(row):
+    """
+    Validate one imported tree (a dict of field name -> raw value) with the TreeForm rules.
+    Returns (cleaned_data, errors); errors maps field names to a list of messages.
+    """
+    cleaned, errors = {}, {}
+
+    for field, low, high in (('latitude', -90, 90), ('longitude', -180, 180)):
+        try:
+            value = validate_tree_location(_optional_float(row.get(field)))
+            if not low <= value <= high:
+                raise forms.ValidationError(f'{field.capitalize()} must be between {low} and {high}.')
+            cleaned[field] = value
+        except (TypeError, ValueError):
+            errors[field] = ['Enter a number.']
+        except forms.ValidationError as e:
+            errors[field] = e.messages
+
+    try:
+        species = validate_tree_species(normalize_species(str(row.get('species') or '')))
+        if len(species) > TreeSubmission._meta.get_field('species').max_length:
+            raise forms.ValidationError('Species name is too long.')
+        cleaned['species'] = species
+    except forms.ValidationError as e:
+        errors['species'] = e.messages
+
+    for field in ('height', 'diameter'):
+        try:
+            cleaned[field] = _optional_float(row.get(field))
+        except (TypeError, ValueError):
+            errors[field] = ['Enter a number.']
+
+    cleaned['description'] = str(row.get('description') or '')
+    return cleaned, errors
+
 class TreeForm(forms.ModelForm):
     image_upload = forms.ImageField(required=False)
+    uploaded_image = forms.IntegerField(required=False, widget=forms.HiddenInput)
+    # Set by save(): the existing nearby tree of the same species, if any
+    duplicate_of = None
 
     class Meta:
         model = TreeSubmission
@@ -123,38 +244,35 @@ class TreeForm(forms.ModelForm):
             },
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        enable_direct_upload(self, 'image_upload', 'tree_images')
+
     def clean_latitude(self):
-        latitude = self.cleaned_data.get('latitude')
-        if not latitude:
-            raise forms.ValidationError('Please click on the map to set a location.')
-        return latitude
+        return validate_tree_location(self.cleaned_data.get('latitude'))
 
     def clean_longitude(self):
-        longitude = self.cleaned_data.get('longitude')
-        if not longitude:
-            raise forms.ValidationError('Please click on the map to set a location.')
-        return longitude
+        return validate_tree_location(self.cleaned_data.get('longitude'))
 
     def clean_species(self):
-        species = self.cleaned_data.get('species')
-        if not species or species == "":
-            raise forms.ValidationError('Please select a tree species from the dropdown.')
-        return species
+        return validate_tree_species(self.cleaned_data.get('species'))
+
+    def clean_image_upload(self):
+        return normalize_image_upload(self.cleaned_data.get('image_upload'))
 
     def save(self, commit=True, user=None):
         instance = super().save(commit=False)
         print(self.cleaned_data)
         image_file = self.cleaned_data.get("image_upload")
         if image_file and user:
-            custom_image = CustomImage.objects.create(
-                image=image_file,
-                user=user,
-                category="tree_images"
-            )
+            custom_image = store_uploaded_image(image_file, user, "tree_images")
             instance.image = custom_image
+        elif user:
+            instance.image = claim_uploaded_image(self.cleaned_data.get("uploaded_image"), user, "tree_images")
 
         if commit:
-            instance.save()
+            # May fold the submission into an existing nearby tree (TREE_DUPLICATE_ACTION)
+            instance, self.duplicate_of = save_tree(instance)
         return instance
 
 # AI Use: Generated with ChatGPT on 2025-12-8
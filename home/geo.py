@@ -0,0 +1,209 @@
+import math
+
+from django.db.models import Q
+
+# Web-mercator can't represent the poles, so latitudes are clamped to this range
+MAX_LATITUDE = 85.05112878
+
+
+class BBox:
+    """Longitude/latitude bounding box as sent by the map (minLon,minLat,maxLon,maxLat)"""
+
+    def __init__(self, min_lon, min_lat, max_lon, max_lat):
+        self.min_lon = min_lon
+        self.min_lat = min_lat
+        self.max_lon = max_lon
+        self.max_lat = max_lat
+
+    @property
+    def crosses_antimeridian(self):
+        return self.min_lon > self.max_lon
+
+    def as_list(self):
+        return [self.min_lon, self.min_lat, self.max_lon, self.max_lat]
+
+    def contains(self, lon, lat):
+        if not self.min_lat <= lat <= self.max_lat:
+            return False
+        if self.crosses_antimeridian:
+            return lon >= self.min_lon or lon <= self.max_lon
+        return self.min_lon <= lon <= self.max_lon
+
+
+def parse_bbox(value):
+    """
+    Parse a "minLon,minLat,maxLon,maxLat" string.
+    Raises ValueError when the value is malformed or out of range.
+    """
+    parts = [p.strip() for p in value.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox must have four comma-separated values")
+
+    min_lon, min_lat, max_lon, max_lat = (float(p) for p in parts)
+    if not all(math.isfinite(v) for v in (min_lon, min_lat, max_lon, max_lat)):
+        raise ValueError("bbox values must be finite numbers")
+    if not (-180 <= min_lon <= 180 and -180 <= max_lon <= 180):
+        raise ValueError("bbox longitudes must be between -180 and 180")
+    if not (-90 <= min_lat <= 90 and -90 <= max_lat <= 90):
+        raise ValueError("bbox latitudes must be between -90 and 90")
+    if min_lat > max_lat:
+        raise ValueError("bbox minLat must not be greater than maxLat")
+
+    return BBox(min_lon, min_lat, max_lon, max_lat)
+
+
+def parse_zoom(value, max_zoom=22):
+    zoom = int(value)
+    if not 0 <= zoom <= max_zoom:
+        raise ValueError(f"zoom must be between 0 and {max_zoom}")
+    return zoom
+
+
+def world_fraction(lon, lat):
+    """Position of a point on the web-mercator square as fractions (fx, fy) of its width/height, from the top-left"""
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    fx = (lon + 180.0) / 360.0
+    fy = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0
+    return fx, fy
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    """Return the (x, y) web-mercator tile containing the point at the given zoom"""
+    n = 1 << zoom
+    fx, fy = world_fraction(lon, lat)
+    return min(max(int(fx * n), 0), n - 1), min(max(int(fy * n), 0), n - 1)
+
+
+def tile_bounds(x, y, zoom):
+    """Return the BBox covered by web-mercator tile (x, y) at the given zoom"""
+    n = 1 << zoom
+    min_lon = x / n * 360.0 - 180.0
+    max_lon = (x + 1) / n * 360.0 - 180.0
+    max_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    min_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return BBox(min_lon, min_lat, max_lon, max_lat)
+
+
+def snap_bbox_to_tiles(bbox, zoom):
+    """
+    Grow a bbox outward to the edges of the tiles it touches at the given zoom,
+    so small pans inside the snapped area don't need another round trip.
+    """
+    if bbox.crosses_antimeridian:
+        return bbox
+    min_x, max_y = lonlat_to_tile(bbox.min_lon, bbox.min_lat, zoom)
+    max_x, min_y = lonlat_to_tile(bbox.max_lon, bbox.max_lat, zoom)
+    top_left = tile_bounds(min_x, min_y, zoom)
+    bottom_right = tile_bounds(max_x, max_y, zoom)
+    # min/max keeps boxes that reach past the mercator latitude limit intact
+    return BBox(
+        top_left.min_lon,
+        min(bbox.min_lat, bottom_right.min_lat),
+        bottom_right.max_lon,
+        max(bbox.max_lat, top_left.max_lat),
+    )
+
+
+def filter_bbox(queryset, bbox, lat_field="latitude", lon_field="longitude"):
+    """Restrict a queryset to rows whose coordinates fall inside the bbox (index friendly ranges)"""
+    queryset = queryset.filter(**{f"{lat_field}__range": (bbox.min_lat, bbox.max_lat)})
+    if bbox.crosses_antimeridian:
+        return queryset.filter(
+            Q(**{f"{lon_field}__gte": bbox.min_lon}) | Q(**{f"{lon_field}__lte": bbox.max_lon})
+        )
+    return queryset.filter(**{f"{lon_field}__range": (bbox.min_lon, bbox.max_lon)})
+
+
+def tiles_for_bbox(bbox, zoom, max_tiles=None):
+    """
+    Return the (x, y) tiles at the given zoom that cover the bbox, west to east.
+    Raises ValueError, before listing anything, when there would be more than max_tiles.
+    """
+    n = 1 << zoom
+    min_x, max_y = lonlat_to_tile(bbox.min_lon, bbox.min_lat, zoom)
+    max_x, min_y = lonlat_to_tile(bbox.max_lon, bbox.max_lat, zoom)
+    columns = (max_x - min_x) % n + 1
+    if max_tiles is not None and columns * (max_y - min_y + 1) > max_tiles:
+        raise ValueError("bbox covers too many tiles at this zoom")
+    if min_x <= max_x:
+        xs = list(range(min_x, max_x + 1))
+    else:
+        # Box crosses the antimeridian: wrap around the tile columns
+        xs = list(range(min_x, n)) + list(range(0, max_x + 1))
+    return [(x, y) for x in xs for y in range(min_y, max_y + 1)]
+
+
+# Mean earth radius (IUGG) used for haversine distances
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180.0
+
+# Trees are bucketed into a fixed lat/lon grid (about 111m per side at the equator) stored on TreeSubmission.grid_cell,
+# so proximity lookups only read the handful of cells around a point
+GRID_CELL_DEGREES = 0.001
+GRID_COLUMNS = round(360 / GRID_CELL_DEGREES)
+GRID_ROWS = round(180 / GRID_CELL_DEGREES)
+
+
+def grid_row_col(lat, lon):
+    row = min(max(int(math.floor((lat + 90.0) / GRID_CELL_DEGREES)), 0), GRID_ROWS - 1)
+    col = int(math.floor((lon + 180.0) / GRID_CELL_DEGREES)) % GRID_COLUMNS
+    return row, col
+
+
+def grid_cell(lat, lon):
+    """Integer id of the grid cell containing the point"""
+    row, col = grid_row_col(lat, lon)
+    return row * GRID_COLUMNS + col
+
+
+def grid_cells_within(lat, lon, radius_m):
+    """
+    Ids of every grid cell that may hold points within radius_m of (lat, lon).
+    Meant for small radii; near the poles the column span grows quickly.
+    """
+    lat_span = radius_m / METERS_PER_DEGREE
+    min_row, _ = grid_row_col(lat - lat_span, lon)
+    max_row, _ = grid_row_col(lat + lat_span, lon)
+    # Columns narrow towards the poles, so size the span for the highest latitude touched
+    widest = min(abs(lat) + lat_span, 89.9)
+    lon_span = min(lat_span / math.cos(math.radians(widest)), 180.0)
+    _, min_col = grid_row_col(lat, lon - lon_span)
+    col_count = min(int(math.floor((lon + lon_span + 180.0) / GRID_CELL_DEGREES))
+                    - int(math.floor((lon - lon_span + 180.0) / GRID_CELL_DEGREES)) + 1, GRID_COLUMNS)
+    cols = [(min_col + i) % GRID_COLUMNS for i in range(col_count)]
+    return [row * GRID_COLUMNS + col for row in range(min_row, max_row + 1) for col in cols]
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def grid_cells_near_cell(cell, radius_m):
+    """Ids of every grid cell that may hold points within radius_m of some point inside the given cell"""
+    row, col = divmod(cell, GRID_COLUMNS)
+    lat_span = radius_m / METERS_PER_DEGREE
+    row_span = math.ceil(lat_span / GRID_CELL_DEGREES)
+    widest = min(max(abs(row * GRID_CELL_DEGREES - 90.0), abs((row + 1) * GRID_CELL_DEGREES - 90.0)) + lat_span, 89.9)
+    col_span = min(math.ceil(lat_span / math.cos(math.radians(widest)) / GRID_CELL_DEGREES), GRID_COLUMNS // 2)
+    rows = range(max(row - row_span, 0), min(row + row_span, GRID_ROWS - 1) + 1)
+    cols = {(col + offset) % GRID_COLUMNS for offset in range(-col_span, col_span + 1)}
+    return [r * GRID_COLUMNS + c for r in rows for c in cols]
+
+
+def haversine_batch(lat, lon, points):
+    """Great-circle distances in meters from (lat, lon) to each (lat, lon) pair in points, in one pass"""
+    radians, sin, cos, asin, sqrt = math.radians, math.sin, math.cos, math.asin, math.sqrt
+    phi1 = radians(lat)
+    cos_phi1 = cos(phi1)
+    diameter = 2 * EARTH_RADIUS_M
+    distances = []
+    append = distances.append
+    for other_lat, other_lon in points:
+        phi2 = radians(other_lat)
+        a = sin((phi2 - phi1) / 2) ** 2 + cos_phi1 * cos(phi2) * sin(radians(other_lon - lon) / 2) ** 2
+        append(diameter * asin(min(1.0, sqrt(a))))
+    return distances
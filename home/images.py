@@ -0,0 +1,210 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image, ImageCms, ImageOps, ImageSequence, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+# Longest side, in pixels, of each stored derivative
+DERIVATIVE_SIZES = (64, 256, 1024)
+# format name -> (Pillow format, file extension)
+DERIVATIVE_FORMATS = {
+    'webp': ('WEBP', 'webp'),
+    'jpeg': ('JPEG', 'jpg'),
+}
+DERIVATIVE_QUALITY = 80
+# Animated formats normalize_upload re-encodes frame by frame; other multi-frame files (MPO) keep their first frame
+ANIMATED_FORMATS = {'GIF': '.gif', 'PNG': '.png', 'WEBP': '.webp'}
+
+_url_cache = OrderedDict()
+_url_cache_lock = threading.Lock()
+
+
+def derivative_key(size, image_format):
+    return f"{size}.{image_format}"
+
+
+def _encode(image, image_format):
+    pil_format, _ = DERIVATIVE_FORMATS[image_format]
+    if image_format == 'jpeg' and image.mode != 'RGB':
+        # JPEG has no alpha channel: flatten transparent images onto white
+        rgba = image.convert('RGBA')
+        flattened = Image.new('RGB', rgba.size, (255, 255, 255))
+        flattened.paste(rgba, mask=rgba.getchannel('A'))
+        image = flattened
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or image.mode == 'P' else 'RGB')
+    buffer = BytesIO()
+    image.save(buffer, pil_format, quality=DERIVATIVE_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+def signs_urls(storage):
+    """Whether the storage hands out expiring signed URLs (S3 querystring_auth), which must never be kept"""
+    return bool(getattr(storage, 'querystring_auth', False))
+
+
+def storage_url(storage, name):
+    """
+    storage.url(name), memoized per process in an LRU of IMAGE_URL_CACHE_SIZE entries.
+    Stored names are never rewritten in place, so an unsigned URL stays valid for as long as the object exists;
+    signed URLs expire and always go to the storage.
+    """
+    if signs_urls(storage) or settings.IMAGE_URL_CACHE_SIZE <= 0:
+        return storage.url(name)
+    key = (id(storage), name)
+    with _url_cache_lock:
+        url = _url_cache.get(key)
+        if url is not None:
+            _url_cache.move_to_end(key)
+            return url
+    url = storage.url(name)
+    with _url_cache_lock:
+        _url_cache[key] = url
+        while len(_url_cache) > settings.IMAGE_URL_CACHE_SIZE:
+            _url_cache.popitem(last=False)
+    return url
+
+
+def clear_url_cache():
+    with _url_cache_lock:
+        _url_cache.clear()
+
+
+def _load_original(f):
+    with Image.open(f) as original:
+        # Bake the EXIF rotation in, since the derivatives don't keep the metadata
+        return ImageOps.exif_transpose(original)
+
+
+def generate_derivatives(custom_image, source=None):
+    """
+    Store a WebP and a JPEG copy of the image at each DERIVATIVE_SIZES next to the original
+    (avatars/photo.png -> avatars/photo_256.webp) and return {"256.webp": storage name, ...}.
+    Images smaller than a size are re-encoded at their own size rather than upscaled.
+    Pass the original's bytes as `source` (an open file) when they are at hand, to skip downloading them.
+    """
+    field = custom_image.image
+    storage = field.storage
+    base, _ = os.path.splitext(field.name)
+
+    if source is not None:
+        source.seek(0)
+        original = _load_original(source)
+    else:
+        with field.open('rb') as f:
+            original = _load_original(f)
+
+    derivatives = {}
+    for size in DERIVATIVE_SIZES:
+        resized = original.copy()
+        resized.thumbnail((size, size), Image.LANCZOS)
+        for image_format, (_, extension) in DERIVATIVE_FORMATS.items():
+            name = storage.save(f"{base}_{size}.{extension}", ContentFile(_encode(resized, image_format)))
+            derivatives[derivative_key(size, image_format)] = name
+    return derivatives
+
+
+def ensure_derivatives(custom_image, source=None):
+    """Generate and record the derivatives if they are missing; unreadable images keep serving the original"""
+    if custom_image.derivatives:
+        return custom_image.derivatives
+    try:
+        derivatives = generate_derivatives(custom_image, source)
+    except (UnidentifiedImageError, OSError) as e:
+        logger.warning("Could not generate derivatives for image %s: %s", custom_image.pk, e)
+        return {}
+    # update() rather than save() so post_save doesn't run again
+    type(custom_image).objects.filter(pk=custom_image.pk).update(derivatives=derivatives)
+    custom_image.derivatives = derivatives
+    # The change feed shows the resized URL; move the trees using this image up it
+    custom_image.treesubmission_set.update(updated_at=timezone.now())
+    return derivatives
+
+
+def _convert_mode(image, mode, icc_profile):
+    """
+    Convert to mode ("RGB" or "RGBA"), returning (image, profile to embed). An embedded profile describes the
+    source colour space (CMYK, greyscale), so on a mode change the pixels go through it to sRGB where LittleCMS
+    can, and the profile is dropped either way.
+    """
+    if image.mode == mode:
+        return image, icc_profile
+    if icc_profile:
+        try:
+            source = ImageCms.ImageCmsProfile(BytesIO(icc_profile))
+            return ImageCms.profileToProfile(image, source, ImageCms.createProfile('sRGB'), outputMode=mode), None
+        except (ImageCms.PyCMSError, OSError, ValueError):
+            pass
+    return image.convert(mode), None
+
+
+def _normalize_animation(image, max_dimension, quality):
+    """Re-encode every frame of an animated GIF/PNG/WebP at most max_dimension px, keeping timing but no metadata"""
+    frames, durations = [], []
+    for frame in ImageSequence.Iterator(image):
+        durations.append(frame.info.get('duration', 100))
+        frame = frame.convert('RGBA')
+        frame.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        # convert() copies the info dict, which is where comments, EXIF and XMP would be written back from
+        frame.info = {}
+        frames.append(frame)
+
+    options = {'save_all': True, 'append_images': frames[1:], 'duration': durations}
+    if 'loop' in image.info:
+        options['loop'] = image.info['loop']
+    if image.format == 'GIF':
+        options['disposal'] = 2
+    elif image.format == 'WEBP':
+        options['quality'] = quality
+    buffer = BytesIO()
+    frames[0].save(buffer, image.format, **options)
+    return buffer, frames[0].size
+
+
+def normalize_upload(uploaded_file, max_dimension=None, quality=None):
+    """
+    Re-encode an uploaded image before it is stored: apply the EXIF orientation, cap the longest side
+    at IMAGE_MAX_DIMENSION and drop the metadata (the colour profile is kept while the colour mode is).
+    Photos become JPEG at IMAGE_UPLOAD_QUALITY, images with transparency PNG; animations keep their format
+    and every frame.
+    The returned file carries image_size = (width, height).
+    """
+    max_dimension = max_dimension or settings.IMAGE_MAX_DIMENSION
+    quality = quality or settings.IMAGE_UPLOAD_QUALITY
+
+    uploaded_file.seek(0)
+    with Image.open(uploaded_file) as image:
+        if getattr(image, 'is_animated', False) and image.format in ANIMATED_FORMATS:
+            extension = ANIMATED_FORMATS[image.format]
+            buffer, size = _normalize_animation(image, max_dimension, quality)
+        else:
+            if image.format == 'JPEG':
+                # Let the decoder skip detail we'd throw away (a 12MP photo decodes at 1/2 or 1/4 scale)
+                image.draft('RGB', (max_dimension, max_dimension))
+            icc_profile = image.info.get('icc_profile')
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+            buffer = BytesIO()
+            if has_alpha:
+                image, icc_profile = _convert_mode(image, 'RGBA', icc_profile)
+                image.save(buffer, 'PNG', optimize=True, icc_profile=icc_profile)
+                extension = '.png'
+            else:
+                image, icc_profile = _convert_mode(image, 'RGB', icc_profile)
+                image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True, icc_profile=icc_profile)
+                extension = '.jpg'
+            size = image.size
+
+    stem, _ = os.path.splitext(os.path.basename(uploaded_file.name))
+    normalized = ContentFile(buffer.getvalue(), name=f"{stem}{extension}")
+    normalized.image_size = size
+    return normalized
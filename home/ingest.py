@@ -0,0 +1,170 @@
+import csv
+import json
+
+from django.db import transaction
+
+from .forms import clean_tree_row
+from .geo import grid_cell
+from .models import TreeSubmission
+from .signals import invalidate_tree_locations
+
+INGEST_BATCH_SIZE = 1000
+
+# Columns read from imported rows; anything else is ignored
+TREE_IMPORT_FIELDS = ('latitude', 'longitude', 'species', 'height', 'diameter', 'description')
+
+
+def _text_lines(lines):
+    """Decode byte lines (e.g. from iterating a request body) and pass text lines through"""
+    for line in lines:
+        # utf-8-sig drops a leading byte order mark written by spreadsheet tools
+        yield line.decode('utf-8-sig') if isinstance(line, bytes) else line
+
+
+def iter_ndjson_rows(lines):
+    """Yield (row_number, dict_or_None, error) for each non-blank line of NDJSON"""
+    for number, line in enumerate(_text_lines(lines), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError:
+            yield number, None, {'__all__': ['Invalid JSON']}
+            continue
+        if not isinstance(row, dict):
+            yield number, None, {'__all__': ['Each line must be a JSON object']}
+            continue
+        yield number, row, None
+
+
+def iter_csv_rows(lines):
+    """Yield (row_number, dict, None) for each CSV record; the header names the columns (case-insensitive)"""
+    reader = csv.reader(_text_lines(lines))
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = [name.strip().lower() for name in header]
+    for number, record in enumerate(reader, start=1):
+        if not any(record):
+            continue
+        yield number, dict(zip(columns, record)), None
+
+
+def iter_geojson_features(fileobj, chunk_size=64 * 1024):
+    """
+    Yield the features of a GeoJSON FeatureCollection one at a time, reading the file in chunks
+    so only the current feature (not the whole collection) is held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    # Skip ahead to the opening bracket of the "features" array
+    while True:
+        start = buffer.find('"features"')
+        bracket = buffer.find('[', start) if start != -1 else -1
+        if bracket != -1:
+            buffer = buffer[bracket + 1:]
+            break
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            raise ValueError('No "features" array found')
+        buffer += chunk
+
+    pos = 0
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buffer):
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                raise ValueError('Unexpected end of file inside "features"')
+            buffer, pos = chunk, 0
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            feature, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Most likely the feature continues in the next chunk
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                raise ValueError('Invalid JSON in "features"')
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield feature
+        if pos > chunk_size:
+            buffer, pos = buffer[pos:], 0
+
+
+def feature_to_row(feature):
+    """Flatten a Point feature into an import row: its properties plus latitude/longitude"""
+    if not isinstance(feature, dict):
+        raise ValueError('Each feature must be a JSON object')
+    geometry = feature.get('geometry') or {}
+    coordinates = geometry.get('coordinates')
+    if geometry.get('type') != 'Point' or not isinstance(coordinates, list) or len(coordinates) < 2:
+        raise ValueError('Feature geometry must be a Point')
+    row = dict(feature.get('properties') or {})
+    row['longitude'], row['latitude'] = coordinates[0], coordinates[1]
+    return row
+
+
+def iter_geojson_rows(fileobj):
+    """Yield (feature_number, dict_or_None, error) for each feature of a FeatureCollection"""
+    for number, feature in enumerate(iter_geojson_features(fileobj), start=1):
+        try:
+            yield number, feature_to_row(feature), None
+        except ValueError as e:
+            yield number, None, {'__all__': [str(e)]}
+
+
+class BulkTreeImporter:
+    """
+    Validates rows with the TreeForm rules and inserts them with bulk_create,
+    one transaction per batch. Errors are collected per row instead of aborting the import.
+    """
+
+    def __init__(self, user, batch_size=INGEST_BATCH_SIZE, max_errors=1000, on_flush=None):
+        self.user = user
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        # Called inside each batch's transaction, e.g. to record a resume checkpoint atomically
+        self.on_flush = on_flush
+        self.last_row = 0
+        self.pending = []
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+
+    def add(self, number, row, error=None):
+        """Validate one parsed row and queue it; flushes automatically when a batch fills up"""
+        self.last_row = number
+        if error is None:
+            cleaned, error = clean_tree_row({field: row.get(field) for field in TREE_IMPORT_FIELDS})
+        if error:
+            self.failed += 1
+            # Keep the response bounded when a whole file is malformed
+            if len(self.errors) < self.max_errors:
+                self.errors.append({'row': number, 'errors': error})
+            return False
+
+        # bulk_create skips TreeSubmission.save(), so fill in the grid cell here
+        cleaned['grid_cell'] = grid_cell(cleaned['latitude'], cleaned['longitude'])
+        self.pending.append(TreeSubmission(user=self.user, **cleaned))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Insert the queued trees in one transaction and refresh the cached map tiles they touch"""
+        if not self.pending:
+            return 0
+        batch, self.pending = self.pending, []
+        with transaction.atomic():
+            TreeSubmission.objects.bulk_create(batch, batch_size=self.batch_size)
+            if self.on_flush is not None:
+                self.on_flush(self, batch)
+        # bulk_create doesn't send post_save, so clear the map caches here
+        invalidate_tree_locations({(tree.latitude, tree.longitude) for tree in batch})
+        self.created += len(batch)
+        return len(batch)
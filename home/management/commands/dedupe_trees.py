@@ -0,0 +1,40 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from home.dedupe import find_duplicate_clusters, merge_duplicate_cluster
+
+
+class Command(BaseCommand):
+    help = "Find groups of same-species trees mapped within a few meters of each other, and optionally merge them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--radius', type=float, default=None,
+                            help="Distance in meters (defaults to TREE_DUPLICATE_RADIUS_M)")
+        parser.add_argument('--merge', action='store_true',
+                            help="Keep the oldest tree of each group and soft-delete the others")
+        parser.add_argument('--show', type=int, default=50, help="How many groups to list")
+
+    def handle(self, *args, **options):
+        radius = options['radius'] if options['radius'] is not None else settings.TREE_DUPLICATE_RADIUS_M
+        if radius <= 0:
+            raise CommandError("--radius must be positive")
+
+        started = time.monotonic()
+        clusters = find_duplicate_clusters(radius)
+        elapsed = time.monotonic() - started
+
+        duplicates = sum(len(ids) - 1 for ids in clusters)
+        self.stdout.write(
+            f"Found {len(clusters)} groups ({duplicates} duplicate trees) within {radius:g}m in {elapsed:.1f}s"
+        )
+        for ids in clusters[:options['show']]:
+            self.stdout.write("  " + ", ".join(str(tree_id) for tree_id in ids))
+        if len(clusters) > options['show']:
+            self.stdout.write(f"  ... and {len(clusters) - options['show']} more")
+
+        if options['merge']:
+            for ids in clusters:
+                merge_duplicate_cluster(ids)
+            self.stdout.write(self.style.SUCCESS(f"Merged {len(clusters)} groups, removed {duplicates} trees"))
@@ -0,0 +1,66 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from home.models import CustomImage
+from home.orphans import (
+    DELETE_BATCH_SIZE, delete_stored_files, orphaned_files, referenced_names, remove_spool_files,
+    unreferenced_images,
+)
+from home.signals import defer_image_file_release
+
+
+class Command(BaseCommand):
+    help = "Delete images nothing refers to: CustomImage rows without an avatar/message/tree, then stored files without a row"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted")
+        parser.add_argument('--grace-hours', type=float, default=24,
+                            help="Leave rows and files younger than this alone (default 24)")
+        parser.add_argument('--skip-files', action='store_true', help="Only delete rows; don't list the storage")
+        parser.add_argument('--show', type=int, default=20, help="How many names to list")
+
+    def handle(self, *args, **options):
+        if options['grace_hours'] < 0:
+            raise CommandError("--grace-hours can't be negative")
+        grace = timedelta(hours=options['grace_hours'])
+        dry_run = options['dry_run']
+        started = time.monotonic()
+
+        garbage = unreferenced_images(grace)
+        rows = list(garbage.order_by('id').values_list('id', 'spool_path'))
+        self.stdout.write(f"{len(rows)} unreferenced image rows")
+        if not dry_run:
+            with defer_image_file_release():
+                for start in range(0, len(rows), DELETE_BATCH_SIZE):
+                    batch = rows[start:start + DELETE_BATCH_SIZE]
+                    CustomImage.objects.filter(id__in=[image_id for image_id, _ in batch]).delete()
+                    remove_spool_files(spool_path for _, spool_path in batch)
+
+        if options['skip_files']:
+            self.stdout.write(f"Done in {time.monotonic() - started:.1f}s")
+            return
+
+        # After the deletes above the remaining rows are exactly the live ones; a dry run has to leave the garbage out
+        live = CustomImage.objects.exclude(pk__in=garbage.values('pk')) if dry_run else None
+        referenced = referenced_names(live)
+        storage = CustomImage._meta.get_field('image').storage
+        orphans = list(orphaned_files(storage, referenced, grace))
+        self.stdout.write(f"{len(orphans)} stored files without a row")
+        for name in orphans[:options['show']]:
+            self.stdout.write(f"  {name}")
+        if len(orphans) > options['show']:
+            self.stdout.write(f"  ... and {len(orphans) - options['show']} more")
+
+        if dry_run:
+            self.stdout.write(f"Dry run, nothing deleted ({time.monotonic() - started:.1f}s)")
+            return
+
+        errors = delete_stored_files(storage, orphans)
+        for name, error in list(errors.items())[:options['show']]:
+            self.stderr.write(f"  could not delete {name}: {error}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {len(rows)} rows and {len(orphans) - len(errors)} files "
+            f"({len(errors)} failed) in {time.monotonic() - started:.1f}s"
+        ))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from home.images import ensure_derivatives
+from home.models import CustomImage
+
+
+class Command(BaseCommand):
+    help = "Create the resized WebP/JPEG copies for images uploaded before derivatives existed"
+
+    def handle(self, *args, **options):
+        done = skipped = 0
+        for image in CustomImage.objects.filter(derivatives={}).exclude(image='').iterator():
+            if ensure_derivatives(image):
+                done += 1
+            else:
+                skipped += 1
+        self.stdout.write(self.style.SUCCESS(f"Generated derivatives for {done} images ({skipped} unreadable)"))
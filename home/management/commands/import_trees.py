@@ -0,0 +1,129 @@
+import hashlib
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from home.ingest import INGEST_BATCH_SIZE, BulkTreeImporter, iter_csv_rows, iter_geojson_rows, iter_ndjson_rows
+from home.models import ImportCheckpoint
+
+# file extension -> format
+IMPORT_FORMATS = {
+    '.csv': 'csv',
+    '.geojson': 'geojson',
+    '.json': 'geojson',
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+}
+
+
+def file_fingerprint(path):
+    """Identify a file by its absolute path, size and first 64KB without reading all of it"""
+    digest = hashlib.sha256()
+    digest.update(os.path.abspath(path).encode('utf-8'))
+    digest.update(str(os.path.getsize(path)).encode('ascii'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(64 * 1024))
+    return digest.hexdigest()
+
+
+class Command(BaseCommand):
+    help = "Import trees from a CSV, GeoJSON or NDJSON file, streaming it in batches and resuming after interruptions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="Path to the file to import")
+        parser.add_argument('--user', required=True, help="Username the imported trees are attributed to")
+        parser.add_argument('--format', choices=sorted(set(IMPORT_FORMATS.values())), help="Defaults to the file extension")
+        parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE)
+        parser.add_argument('--restart', action='store_true', help="Ignore any saved checkpoint and import from the first row")
+        parser.add_argument('--show-errors', type=int, default=20, help="How many row errors to print at the end")
+
+    def handle(self, *args, **options):
+        path = options['file']
+        if not os.path.isfile(path):
+            raise CommandError(f"No such file: {path}")
+
+        file_format = options['format'] or IMPORT_FORMATS.get(os.path.splitext(path)[1].lower())
+        if file_format is None:
+            raise CommandError("Can't tell the format from the extension; pass --format")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+
+        try:
+            user = get_user_model().objects.get(username=options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f"No user named {options['user']}")
+
+        checkpoint, _ = ImportCheckpoint.objects.get_or_create(
+            source=file_fingerprint(path), defaults={'path': os.path.abspath(path)}
+        )
+        if options['restart']:
+            checkpoint.rows_done = checkpoint.created = checkpoint.failed = 0
+            checkpoint.finished = False
+            checkpoint.save()
+        elif checkpoint.finished:
+            self.stdout.write(f"{path} was already imported ({checkpoint.created} trees); use --restart to import it again")
+            return
+        elif checkpoint.rows_done:
+            self.stdout.write(f"Resuming after row {checkpoint.rows_done}")
+
+        skip_through = checkpoint.rows_done
+        started = time.monotonic()
+        processed = 0
+
+        def save_checkpoint(importer, batch):
+            # Runs inside the batch transaction, so the checkpoint and the inserted rows commit together
+            checkpoint.rows_done = importer.last_row
+            checkpoint.created += len(batch)
+            checkpoint.failed = failed_before + importer.failed
+            checkpoint.save(update_fields=['rows_done', 'created', 'failed', 'updated_at'])
+
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"row {importer.last_row}: {importer.created + len(batch)} created, "
+                f"{importer.failed} failed, {processed / elapsed if elapsed else 0:.0f} rows/s"
+            )
+
+        failed_before = checkpoint.failed
+        importer = BulkTreeImporter(
+            user,
+            batch_size=options['batch_size'],
+            max_errors=options['show_errors'],
+            on_flush=save_checkpoint,
+        )
+
+        if file_format == 'csv':
+            f = open(path, newline='', encoding='utf-8-sig')
+            rows = iter_csv_rows(f)
+        elif file_format == 'geojson':
+            f = open(path, encoding='utf-8-sig')
+            rows = iter_geojson_rows(f)
+        else:
+            f = open(path, encoding='utf-8-sig')
+            rows = iter_ndjson_rows(f)
+
+        with f:
+            try:
+                for number, row, error in rows:
+                    if number <= skip_through:
+                        continue
+                    processed += 1
+                    importer.add(number, row, error)
+            except ValueError as e:
+                # Structural problems (e.g. truncated GeoJSON) stop the import; committed batches are kept
+                importer.flush()
+                raise CommandError(f"{e} after row {importer.last_row}")
+            importer.flush()
+
+        checkpoint.failed = failed_before + importer.failed
+        checkpoint.finished = True
+        checkpoint.save(update_fields=['failed', 'finished', 'updated_at'])
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {importer.created} trees ({importer.failed} rows failed) "
+            f"from {processed} rows in {elapsed:.1f}s ({processed / elapsed if elapsed else 0:.0f} rows/s)"
+        ))
+        for error in importer.errors:
+            self.stderr.write(f"row {error['row']}: {error['errors']}")
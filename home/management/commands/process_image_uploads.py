@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from home.direct_uploads import finish_direct_upload
+from home.models import CustomImage
+from home.uploads import finish_upload
+
+
+class Command(BaseCommand):
+    help = (
+        "Upload spooled images and process confirmed direct uploads that are still pending, "
+        "e.g. after the web process restarted mid-upload"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true', help="Queue failed uploads again first")
+        parser.add_argument('--requeue-uploading', action='store_true',
+                            help="Reset uploads stuck in 'uploading'; only safe while no web workers are running")
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            CustomImage.objects.filter(status='failed').exclude(spool_path='').update(status='pending')
+        if options['requeue_uploading']:
+            CustomImage.objects.filter(status='uploading').update(status='pending')
+
+        started = time.monotonic()
+        done = failed = skipped = 0
+        pending = CustomImage.objects.filter(status='pending').order_by('id').values_list('id', 'spool_path')
+        for image_id, spool_path in pending:
+            # Form uploads wait in the local spool; confirmed direct uploads are still staged in the bucket
+            image = finish_upload(image_id) if spool_path else finish_direct_upload(image_id)
+            if image is None:
+                skipped += 1
+            elif image.status == 'ready':
+                done += 1
+            else:
+                failed += 1
+        self.stdout.write(
+            f"Uploaded {done} images, {failed} failed, {skipped} skipped in {time.monotonic() - started:.1f}s"
+        )
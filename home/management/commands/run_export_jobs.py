@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from home.export_jobs import claim_next_job, delete_expired_jobs, run_export_job
+
+# Seconds between sweeps for expired and superseded export jobs while the queue is idle
+CLEANUP_INTERVAL = 10 * 60
+
+
+class Command(BaseCommand):
+    help = "Process queued tree export jobs, polling for new ones until stopped, and delete expired ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds to wait when the queue is empty")
+
+    def cleanup(self):
+        deleted = delete_expired_jobs()
+        if deleted:
+            self.stdout.write(f"Deleted {deleted} expired export jobs")
+
+    def handle(self, *args, **options):
+        last_cleanup = None
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if last_cleanup is None or time.monotonic() - last_cleanup >= CLEANUP_INTERVAL:
+                    self.cleanup()
+                    last_cleanup = time.monotonic()
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            started = time.monotonic()
+            job = run_export_job(job)
+            elapsed = time.monotonic() - started
+            if job.status == 'done':
+                self.stdout.write(f"Export {job.key[:12]} done: {job.size} bytes in {elapsed:.1f}s")
+            else:
+                self.stderr.write(f"Export {job.key[:12]} failed: {job.error}")
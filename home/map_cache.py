@@ -0,0 +1,21 @@
+from django.core.cache import cache
+
+# Part of every cached cluster/tile key; bumping it retires all of them at once
+GENERATION_KEY = "tree_map_generation"
+
+
+def current_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # add() so concurrent first requests agree on the starting value
+        cache.add(GENERATION_KEY, 1, None)
+        generation = cache.get(GENERATION_KEY, 1)
+    return generation
+
+
+def bump_generation():
+    """Invalidate every cached cluster and vector tile, e.g. after a bulk import"""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, 2, None)
@@ -4,7 +4,7 @@ import django.contrib.auth.models
 import django.contrib.auth.validators
 import django.db.models.deletion
 import django.utils.timezone
-import storages.backends.s3
+import home.storage
 from django.conf import settings
 from django.db import migrations, models
 
@@ -113,7 +113,7 @@ class Migration(migrations.Migration):
                     models.ImageField(
                         blank=True,
                         null=True,
-                        storage=storages.backends.s3.S3Storage(),
+                        storage=home.storage.image_storage,
                         upload_to="avatars/",
                     ),
                 ),
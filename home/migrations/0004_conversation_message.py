@@ -1,7 +1,7 @@
 # Generated by Django 5.2.7 on 2025-11-17 01:27
 
 import django.db.models.deletion
-import storages.backends.s3
+import home.storage
 from django.conf import settings
 from django.db import migrations, models
 
@@ -26,7 +26,7 @@ class Migration(migrations.Migration):
                 ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
                 ('content', models.TextField()),
                 ('timestamp', models.DateTimeField(auto_now_add=True)),
-                ('image_attachment', models.ImageField(blank=True, null=True, storage=storages.backends.s3.S3Storage(), upload_to='message_attachments/')),
+                ('image_attachment', models.ImageField(blank=True, null=True, storage=home.storage.image_storage, upload_to='message_attachments/')),
                 ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='home.conversation')),
                 ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sent_messages', to=settings.AUTH_USER_MODEL)),
             ],
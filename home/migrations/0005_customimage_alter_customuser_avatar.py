@@ -2,7 +2,7 @@
 
 import django.db.models.deletion
 import home.models
-import storages.backends.s3
+import home.storage
 from django.conf import settings
 from django.db import migrations, models
 
@@ -21,7 +21,7 @@ class Migration(migrations.Migration):
             name='CustomImage',
             fields=[
                 ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
-                ('image', models.ImageField(storage=storages.backends.s3.S3Storage(), upload_to=home.models.custom_image_path)),
+                ('image', models.ImageField(storage=home.storage.image_storage, upload_to=home.models.custom_image_path)),
                 ('category', models.CharField(choices=[('avatars', 'Avatar'), ('message_attachments', 'Attachment'), ('trees', 'Tree')], max_length=30)),
                 ('private', models.BooleanField(default=False)),
                 ('flaged', models.BooleanField(default=False)),
@@ -1,6 +1,6 @@
 # Generated by Django 5.2.7 on 2025-12-09 18:19
 
-import storages.backends.s3
+import home.storage
 from django.db import migrations, models
 
 
@@ -27,7 +27,7 @@ class Migration(migrations.Migration):
             field=models.ImageField(
                 blank=True,
                 null=True,
-                storage=storages.backends.s3.S3Storage(),
+                storage=home.storage.image_storage,
                 upload_to="tree_images/",
             ),
         ),
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0013_alter_customimage_category_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='treesubmission',
+            index=models.Index(fields=['latitude', 'longitude'], name='tree_lat_lon_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:40
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_updated_at(apps, schema_editor):
+    TreeSubmission = apps.get_model("home", "TreeSubmission")
+    TreeSubmission.objects.update(updated_at=F("submitted_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0014_treesubmission_lat_lon_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treesubmission',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_updated_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='treesubmission',
+            index=models.Index(fields=['updated_at', 'id'], name='tree_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0015_treesubmission_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='treesubmission',
+            index=models.Index(fields=['species'], name='tree_species_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='treesubmission',
+            index=models.Index(fields=['submitted_at'], name='tree_submitted_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:37
+
+import math
+
+from django.db import migrations, models
+
+# Frozen copy of home.geo.grid_cell at the time of this migration
+GRID_CELL_DEGREES = 0.001
+GRID_COLUMNS = 360000
+GRID_ROWS = 180000
+
+
+def grid_cell(lat, lon):
+    row = min(max(int(math.floor((lat + 90.0) / GRID_CELL_DEGREES)), 0), GRID_ROWS - 1)
+    col = int(math.floor((lon + 180.0) / GRID_CELL_DEGREES)) % GRID_COLUMNS
+    return row * GRID_COLUMNS + col
+
+
+def backfill_grid_cell(apps, schema_editor):
+    TreeSubmission = apps.get_model("home", "TreeSubmission")
+    batch = []
+    for tree in TreeSubmission.objects.only("id", "latitude", "longitude").iterator(chunk_size=2000):
+        tree.grid_cell = grid_cell(tree.latitude, tree.longitude)
+        batch.append(tree)
+        if len(batch) >= 2000:
+            TreeSubmission.objects.bulk_update(batch, ["grid_cell"])
+            batch = []
+    if batch:
+        TreeSubmission.objects.bulk_update(batch, ["grid_cell"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0018_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treesubmission',
+            name='grid_cell',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_grid_cell, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='treesubmission',
+            index=models.Index(fields=['grid_cell', 'species'], name='tree_grid_cell_idx'),
+        ),
+    ]
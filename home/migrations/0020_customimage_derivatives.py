@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0019_treesubmission_grid_cell'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customimage',
+            name='derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
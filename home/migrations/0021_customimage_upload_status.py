@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0020_customimage_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customimage',
+            name='spool_path',
+            field=models.CharField(blank=True, editable=False, max_length=500),
+        ),
+        migrations.AddField(
+            model_name='customimage',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending upload'), ('uploading', 'Uploading'), ('ready', 'Ready'), ('failed', 'Failed')], db_index=True, default='ready', max_length=10),
+        ),
+    ]
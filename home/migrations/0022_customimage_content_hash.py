@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0021_customimage_upload_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customimage',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64),
+        ),
+    ]
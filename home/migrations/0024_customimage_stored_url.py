@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0023_customimage_dimensions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customimage',
+            name='stored_url',
+            field=models.CharField(blank=True, editable=False, max_length=500),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 19:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0024_customimage_stored_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customimage',
+            name='uploaded_at',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+    ]
@@ -0,0 +1,95 @@
+# Generated by Django 5.2.7 on 2026-10-18 20:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def read_by_to_watermarks(apps, schema_editor):
+    """
+    Each member's watermark is the newest message of the conversation they had read.
+    Threads were always marked read as a whole, so everything before it was read too.
+    """
+    Message = apps.get_model("home", "Message")
+    ConversationMembership = apps.get_model("home", "ConversationMembership")
+    ReadBy = Message.read_by.through
+
+    watermarks = {
+        (row["message__conversation_id"], row["customuser_id"]): row["last_read"]
+        for row in ReadBy.objects.values("message__conversation_id", "customuser_id").annotate(last_read=Max("message_id"))
+    }
+    batch = []
+    for membership in ConversationMembership.objects.only("id", "conversation_id", "user_id").iterator(chunk_size=2000):
+        last_read = watermarks.get((membership.conversation_id, membership.user_id))
+        if last_read:
+            membership.last_read_message_id = last_read
+            batch.append(membership)
+    ConversationMembership.objects.bulk_update(batch, ["last_read_message_id"], batch_size=2000)
+
+
+def watermarks_to_read_by(apps, schema_editor):
+    Message = apps.get_model("home", "Message")
+    ConversationMembership = apps.get_model("home", "ConversationMembership")
+    ReadBy = Message.read_by.through
+
+    for membership in ConversationMembership.objects.filter(last_read_message_id__gt=0).iterator(chunk_size=2000):
+        message_ids = Message.objects.filter(
+            conversation_id=membership.conversation_id, id__lte=membership.last_read_message_id
+        ).values_list("id", flat=True)
+        ReadBy.objects.bulk_create(
+            [ReadBy(message_id=message_id, customuser_id=membership.user_id) for message_id in message_ids],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0025_customimage_uploaded_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Adopt the auto-created participants table as the through model; nothing changes in the database
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='ConversationMembership',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='home.conversation')),
+                        ('user', models.ForeignKey(db_column='customuser_id', on_delete=django.db.models.deletion.CASCADE, related_name='conversation_memberships', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'home_conversation_participants',
+                        'unique_together': {('conversation', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='conversation',
+                    name='participants',
+                    field=models.ManyToManyField(related_name='conversations', through='home.ConversationMembership', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='conversationmembership',
+            name='last_read_message_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversationmembership',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'id'], name='message_conversation_id_idx'),
+        ),
+        migrations.RunPython(read_by_to_watermarks, watermarks_to_read_by),
+        migrations.RemoveField(
+            model_name='message',
+            name='read_by',
+        ),
+    ]
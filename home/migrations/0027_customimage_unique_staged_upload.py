@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 20:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0026_conversationmembership'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='customimage',
+            constraint=models.UniqueConstraint(condition=models.Q(('image__startswith', 'uploads/')), fields=('image',), name='customimage_unique_staged_upload'),
+        ),
+    ]
@@ -1,14 +1,33 @@
+import os
+
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
 
-from storages.backends.s3boto3 import S3Boto3Storage
+from django.core.files.storage import FileSystemStorage
+
+from .geo import grid_cell
+from .images import signs_urls, storage_url
+from .storage import image_storage
+
 
-s3_storage = S3Boto3Storage()
+def export_storage():
+    """Where export artifacts are written: the S3 bucket or a local directory (EXPORT_STORAGE setting)"""
+    if settings.EXPORT_STORAGE == 's3':
+        from storages.backends.s3boto3 import S3Boto3Storage
+        return S3Boto3Storage(location='exports')
+    return FileSystemStorage(location=settings.EXPORT_ROOT)
 
 # Create your models here.
 
+# Browsers write direct uploads here; once confirmed, each file moves to its content-addressed key
+STAGING_PREFIX = "uploads"
+
 def custom_image_path(instance, filename):
+    if instance.content_hash:
+        # Content-addressed: the same bytes always get the same key, whatever the category or file name
+        _, extension = os.path.splitext(filename)
+        return f"images/{instance.content_hash[:2]}/{instance.content_hash}{extension.lower()}"
     return f"{instance.category}/{filename}"
 
 class CustomImage(models.Model):
@@ -18,18 +37,99 @@ class CustomImage(models.Model):
         ("tree_images", "Tree")
     ]
 
-    image = models.ImageField(upload_to=custom_image_path, storage=s3_storage, null=False, blank=False)
+    image = models.ImageField(upload_to=custom_image_path, storage=image_storage, null=False, blank=False)
     category = models.CharField(max_length=30, choices=CATEGORY_CHOICES)
     private = models.BooleanField(default=False)
     flaged = models.BooleanField(default=False)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True)
+    # Resized copies stored next to the original: {"<size>.<format>": storage name} (see images.py)
+    derivatives = models.JSONField(default=dict, blank=True, editable=False)
+
+    STATUS_CHOICES = [
+        ("pending", "Pending upload"),
+        ("uploading", "Uploading"),
+        ("ready", "Ready"),
+        ("failed", "Failed"),
+    ]
+    # Async uploads (IMAGE_UPLOAD_MODE) start as "pending" with the file in spool_path until a worker stores it
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="ready", db_index=True)
+    spool_path = models.CharField(max_length=500, blank=True, editable=False)
+    # SHA-256 of the file; rows with the same hash share one stored object (see uploads.store_uploaded_image)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
+    # Pixel size of the stored (normalized) image; unknown for images uploaded before normalization
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    # Unknown for images uploaded before it was recorded
+    uploaded_at = models.DateTimeField(auto_now_add=True, null=True)
+    # URL of the original, filled in on save when IMAGE_STORE_URLS is on so rendering never asks the storage.
+    # Never set (or used) while the storage signs its URLs, since those expire
+    stored_url = models.CharField(max_length=500, blank=True, editable=False)
+
+    class Meta:
+        constraints = [
+            # A staged direct upload gets one row, however many times (or how concurrently) its ticket is confirmed
+            models.UniqueConstraint(
+                fields=['image'], condition=models.Q(image__startswith=f"{STAGING_PREFIX}/"),
+                name='customimage_unique_staged_upload',
+            ),
+        ]
+
+    @property
+    def is_ready(self):
+        return self.status == "ready"
+
+    @property
+    def url(self):
+        """URL of the original image, whether or not it is private"""
+        storage = self.image.storage
+        if self.stored_url and not signs_urls(storage):
+            return self.stored_url
+        return storage_url(storage, self.image.name)
 
     @property
     def public_url(self):
-        if not self.private:
-            return self.image.url
+        if not self.private and self.is_ready:
+            return self.url
         return None
 
+    def url_for(self, size, image_format='webp'):
+        """
+        URL of the smallest stored derivative at least `size` px on its longest side
+        (or the largest one there is), falling back to the original until derivatives exist.
+        None while the upload is still pending.
+        """
+        if not self.is_ready:
+            return None
+        sizes = sorted(int(key.split('.')[0]) for key in self.derivatives if key.endswith(f".{image_format}"))
+        if not sizes:
+            return self.url
+        chosen = next((s for s in sizes if s >= size), sizes[-1])
+        return storage_url(self.image.storage, self.derivatives[f"{chosen}.{image_format}"])
+
+    # Sized variants of public_url for templates; None for private images
+    @property
+    def thumbnail_url(self):
+        return self.url_for(64) if not self.private else None
+
+    @property
+    def preview_url(self):
+        return self.url_for(256) if not self.private else None
+
+    @property
+    def large_url(self):
+        return self.url_for(1024) if not self.private else None
+
+    def save(self, *args, **kwargs):
+        if (settings.IMAGE_STORE_URLS and self.is_ready and self.image.name and not self.stored_url
+                and not signs_urls(self.image.storage)):
+            # Store a new file now (super().save() would, a step later) so the URL is for its final name
+            self._meta.get_field('image').pre_save(self, self._state.adding)
+            self.stored_url = self.image.storage.url(self.image.name)
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'stored_url'}
+        super().save(*args, **kwargs)
+
 class CustomUser(AbstractUser):
     ROLE_CHOICES = (
         ('user', 'User'),
@@ -48,7 +148,7 @@ class CustomUser(AbstractUser):
 
 class Conversation(models.Model):
     participants = models.ManyToManyField(
-        settings.AUTH_USER_MODEL, related_name="conversations"
+        settings.AUTH_USER_MODEL, related_name="conversations", through="ConversationMembership"
     )
     name = models.CharField(max_length=255, blank=True, null=True)
     is_group = models.BooleanField(default=False)
@@ -70,17 +170,38 @@ class Message(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
 
     image_attachment = models.ForeignKey(CustomImage, on_delete=models.SET_NULL, null=True, blank=True, default=None)
-    
-    read_by = models.ManyToManyField(
-        settings.AUTH_USER_MODEL, related_name="read_messages", blank=True
-    )
 
     class Meta:
-        ordering = ['timestamp'] 
+        ordering = ['timestamp']
+        indexes = [
+            # Unread counts: messages in a conversation past a member's read watermark
+            models.Index(fields=['conversation', 'id'], name='message_conversation_id_idx'),
+        ]
 
     def __str__(self):
         return f"Message from {self.sender.get_display_name()} at {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
 
+class ConversationMembership(models.Model):
+    """
+    A participant of a conversation and how far they have read it. Messages with an id above
+    last_read_message_id are unread, so marking a thread read is one UPDATE of this row.
+    Reuses the table of the former auto-created participants M2M, so every participant already has a row.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="memberships")
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="conversation_memberships",
+        db_column="customuser_id",
+    )
+    last_read_message_id = models.PositiveBigIntegerField(default=0)
+    last_read_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = "home_conversation_participants"
+        unique_together = [("conversation", "user")]
+
+    def __str__(self):
+        return f"{self.user} in conversation {self.conversation_id}"
+
 class TreeSubmission(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     species = models.CharField(max_length=100)
@@ -96,10 +217,34 @@ class TreeSubmission(models.Model):
     flagged_at = models.DateTimeField(null=True, blank=True)
     flag_reason = models.TextField(blank=True)
     is_deleted = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Spatial hash of latitude/longitude (see geo.grid_cell), kept in sync on save
+    grid_cell = models.BigIntegerField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Serves the map's bounding-box lookups (range on latitude, then longitude)
+            models.Index(fields=['latitude', 'longitude'], name='tree_lat_lon_idx'),
+            # Serves the (updated_at, id) cursor used by the change feed
+            models.Index(fields=['updated_at', 'id'], name='tree_updated_idx'),
+            # Export filters
+            models.Index(fields=['species'], name='tree_species_idx'),
+            models.Index(fields=['submitted_at'], name='tree_submitted_idx'),
+            # Proximity lookups (duplicate detection, nearby search) by grid cell, then species
+            models.Index(fields=['grid_cell', 'species'], name='tree_grid_cell_idx'),
+        ]
 
     def __str__(self):
         return f"{self.species} ({self.latitude}, {self.longitude})"
 
+    def save(self, *args, **kwargs):
+        if self.latitude is not None and self.longitude is not None:
+            self.grid_cell = grid_cell(float(self.latitude), float(self.longitude))
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'grid_cell'}
+        super().save(*args, **kwargs)
+
 class Notification(models.Model):
     NOTIFICATION_TYPES = (
         ('tree_flagged', 'Tree Flagged'),
@@ -134,4 +279,45 @@ class Notification(models.Model):
         ordering = ['-created_at']
 
     def __str__(self):
-        return f"{self.notification_type} for {self.recipient.get_display_name()}"
\ No newline at end of file
+        return f"{self.notification_type} for {self.recipient.get_display_name()}"
+
+class ExportJob(models.Model):
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+
+    # Hash of format + filters + catalog change stamp, so identical requests share one artifact
+    key = models.CharField(max_length=64, unique=True)
+    format = models.CharField(max_length=10)
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', db_index=True)
+    file = models.FileField(upload_to='', storage=export_storage, blank=True)
+    size = models.BigIntegerField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='export_jobs')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.format} export {self.key[:12]} ({self.status})"
+
+class ImportCheckpoint(models.Model):
+    # Fingerprint of the imported file (path, size and leading bytes), so a resume only applies to the same file
+    source = models.CharField(max_length=64, unique=True)
+    path = models.CharField(max_length=500)
+    # Rows up to and including this number are already committed
+    rows_done = models.PositiveIntegerField(default=0)
+    created = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.path} ({self.rows_done} rows)"
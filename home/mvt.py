@@ -0,0 +1,183 @@
+"""
+Minimal Mapbox Vector Tile (v2) encoder for point layers.
+
+Only the parts of the spec the tree map needs are implemented: one layer of
+POINT features with string/bool/int properties, written straight to protobuf
+wire format so no PostGIS or protobuf dependency is required.
+"""
+import hashlib
+import struct
+
+from django.core.cache import cache
+
+from .geo import BBox, filter_bbox, tile_bounds, world_fraction
+from .map_cache import current_generation
+from .models import TreeSubmission
+
+EXTENT = 4096
+# Points just outside the tile are kept so symbols on the edge aren't clipped
+BUFFER = 64
+# Below this the map shows /api/trees/clusters/ instead (CLUSTER_BELOW_ZOOM in map.js); a lower tile would
+# hold a whole city's trees, encoded in the request after every cache generation bump
+MIN_TILE_ZOOM = 12
+MAX_TILE_ZOOM = 18
+TILE_CACHE_TIMEOUT = 60 * 60
+TILE_LAYER = "trees"
+TILE_CONTENT_TYPE = "application/vnd.mapbox-vector-tile"
+
+# Protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH = 2
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+
+def _length_delimited(field, payload):
+    return _key(field, _LENGTH) + _varint(len(payload)) + payload
+
+
+def _packed(field, values):
+    return _length_delimited(field, b"".join(_varint(v) for v in values))
+
+
+def _encode_value(value):
+    """Encode a tile Value message"""
+    if isinstance(value, bool):
+        return _key(7, _VARINT) + _varint(int(value))
+    if isinstance(value, int):
+        if value >= 0:
+            return _key(5, _VARINT) + _varint(value)
+        return _key(6, _VARINT) + _varint(_zigzag(value))
+    if isinstance(value, float):
+        return _key(3, _FIXED64) + struct.pack("<d", value)
+    return _length_delimited(1, str(value).encode("utf-8"))
+
+
+def encode_point_layer(name, features, extent=EXTENT):
+    """
+    Encode one layer as a complete tile.
+    `features` is an iterable of (feature_id, px, py, properties) with px/py in tile pixels.
+    """
+    keys, key_index = [], {}
+    values, value_index = [], {}
+    encoded_features = []
+
+    for feature_id, px, py, properties in features:
+        tags = []
+        for prop_key, prop_value in properties.items():
+            if prop_value is None:
+                continue
+            if prop_key not in key_index:
+                key_index[prop_key] = len(keys)
+                keys.append(prop_key)
+            # bool is an int subclass, so include the type to keep True and 1 apart
+            value_key = (type(prop_value), prop_value)
+            if value_key not in value_index:
+                value_index[value_key] = len(values)
+                values.append(prop_value)
+            tags.extend((key_index[prop_key], value_index[value_key]))
+
+        # A single MoveTo command (id 1, count 1) followed by the zigzagged position
+        geometry = [(1 & 0x7) | (1 << 3), _zigzag(px), _zigzag(py)]
+        feature = (
+            _key(1, _VARINT) + _varint(feature_id)
+            + _packed(2, tags)
+            + _key(3, _VARINT) + _varint(1)  # GeomType.POINT
+            + _packed(4, geometry)
+        )
+        encoded_features.append(_length_delimited(2, feature))
+
+    layer = bytearray()
+    layer += _key(15, _VARINT) + _varint(2)
+    layer += _length_delimited(1, name.encode("utf-8"))
+    for feature in encoded_features:
+        layer += feature
+    for key in keys:
+        layer += _length_delimited(3, key.encode("utf-8"))
+    for value in values:
+        layer += _length_delimited(4, _encode_value(value))
+    layer += _key(5, _VARINT) + _varint(extent)
+
+    return _length_delimited(3, bytes(layer))
+
+
+def _tile_pixel(lon, lat, zoom, x, y, extent=EXTENT):
+    n = 1 << zoom
+    fx, fy = world_fraction(lon, lat)
+    return round((fx * n - x) * extent), round((fy * n - y) * extent)
+
+
+def build_tree_tile(zoom, x, y):
+    """Encode the non-deleted trees in tile (x, y) at this zoom"""
+    bounds = tile_bounds(x, y, zoom)
+    pad_lon = (bounds.max_lon - bounds.min_lon) * BUFFER / EXTENT
+    pad_lat = (bounds.max_lat - bounds.min_lat) * BUFFER / EXTENT
+    area = BBox(
+        max(bounds.min_lon - pad_lon, -180.0),
+        max(bounds.min_lat - pad_lat, -90.0),
+        min(bounds.max_lon + pad_lon, 180.0),
+        min(bounds.max_lat + pad_lat, 90.0),
+    )
+
+    rows = (
+        filter_bbox(TreeSubmission.objects.filter(is_deleted=False), area)
+        .order_by('id')
+        .values_list('id', 'species', 'is_flagged', 'latitude', 'longitude')
+    )
+
+    features = []
+    for tree_id, species, is_flagged, latitude, longitude in rows.iterator(chunk_size=2000):
+        px, py = _tile_pixel(longitude, latitude, zoom, x, y)
+        features.append((tree_id, px, py, {'id': tree_id, 'species': species, 'is_flagged': is_flagged}))
+
+    return encode_point_layer(TILE_LAYER, features)
+
+
+def tile_cache_key(generation, zoom, x, y):
+    return f"tree_tile:{generation}:{zoom}:{x}:{y}"
+
+
+def get_tree_tile(zoom, x, y):
+    """Return (etag, tile_bytes), building and caching the tile on a miss"""
+    key = tile_cache_key(current_generation(), zoom, x, y)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    data = build_tree_tile(zoom, x, y)
+    etag = '"%s"' % hashlib.sha1(data).hexdigest()
+    cache.set(key, (etag, data), TILE_CACHE_TIMEOUT)
+    return etag, data
+
+
+def tile_keys_for_point(latitude, longitude, generation):
+    """Cache keys of the vector tiles whose buffered area contains this point, at every zoom level"""
+    fx, fy = world_fraction(longitude, latitude)
+    keys = []
+    for zoom in range(MIN_TILE_ZOOM, MAX_TILE_ZOOM + 1):
+        n = 1 << zoom
+        px, py = fx * n * EXTENT, fy * n * EXTENT
+        # The point's own tile plus any neighbour whose edge buffer reaches it
+        xs = {min(max(int((px + d) // EXTENT), 0), n - 1) for d in (-BUFFER, 0, BUFFER)}
+        ys = {min(max(int((py + d) // EXTENT), 0), n - 1) for d in (-BUFFER, 0, BUFFER)}
+        keys.extend(tile_cache_key(generation, zoom, x, y) for x in xs for y in ys)
+    return keys
@@ -0,0 +1,81 @@
+import heapq
+import math
+
+from .geo import (
+    BBox, GRID_CELL_DEGREES, GRID_COLUMNS, GRID_ROWS, METERS_PER_DEGREE,
+    filter_bbox, grid_row_col, haversine_batch,
+)
+from .models import TreeSubmission
+
+MAX_NEARBY_K = 100
+MAX_NEARBY_RADIUS_M = 50000
+# Above this many cells an IN (...) list stops paying off, so the rest of the search uses the lat/lon index
+MAX_RING_CELLS = 2000
+
+
+def _ring_cells(row, col, first, last):
+    """Grid cells whose Chebyshev distance from (row, col) is between first and last rings"""
+    cells = set()
+    for r in range(first, last + 1):
+        for dr in range(-r, r + 1):
+            cell_row = row + dr
+            if not 0 <= cell_row < GRID_ROWS:
+                continue
+            # Whole top/bottom edge of the ring, only the two sides in between
+            offsets = range(-r, r + 1) if abs(dr) == r else (-r, r) if r else (0,)
+            for dc in offsets:
+                cells.add(cell_row * GRID_COLUMNS + (col + dc) % GRID_COLUMNS)
+    return cells
+
+
+def _closest(lat, lon, rows, k, radius_m):
+    """Keep the k nearest (distance, id) pairs within radius_m, computing the distances for the batch at once"""
+    rows = list(rows)
+    distances = haversine_batch(lat, lon, [(row_lat, row_lon) for _, row_lat, row_lon in rows])
+    within = ((distance, row[0]) for distance, row in zip(distances, rows) if distance <= radius_m)
+    return heapq.nsmallest(k, within)
+
+
+def nearest_tree_ids(lat, lon, k=10, radius_m=1000):
+    """
+    Return [(distance_m, tree_id)] for the k live trees closest to (lat, lon) within radius_m, nearest first.
+    Searches outward ring by ring over the grid cells around the point (doubling the rings each round)
+    and stops as soon as no unread cell can hold anything closer than the k-th tree found.
+    """
+    trees = TreeSubmission.objects.filter(is_deleted=False)
+    row, col = grid_row_col(lat, lon)
+
+    # Smallest cell side in meters anywhere within the radius; every ring adds at least this much distance
+    lat_span = radius_m / METERS_PER_DEGREE
+    widest = min(abs(lat) + lat_span, 89.9)
+    cell_side = METERS_PER_DEGREE * GRID_CELL_DEGREES * math.cos(math.radians(widest))
+    max_ring = math.ceil(radius_m / cell_side) + 1
+
+    best = []
+    first = 0
+    last = 0
+    while first <= max_ring:
+        last = min(last, max_ring)
+        cells = _ring_cells(row, col, first, last)
+        if len(cells) > MAX_RING_CELLS:
+            # Sparse area: finish with one bounding-box query over the remaining radius
+            lon_span = lat_span / math.cos(math.radians(widest))
+            if lon_span >= 180.0:
+                min_lon, max_lon = -180.0, 180.0
+            else:
+                # Wrapped edges give a box that crosses the antimeridian, which filter_bbox understands
+                min_lon = (lon - lon_span + 180.0) % 360.0 - 180.0
+                max_lon = (lon + lon_span + 180.0) % 360.0 - 180.0
+            bbox = BBox(min_lon, max(lat - lat_span, -90.0), max_lon, min(lat + lat_span, 90.0))
+            candidates = filter_bbox(trees, bbox).values_list('id', 'latitude', 'longitude')
+            return _closest(lat, lon, candidates, k, radius_m)
+
+        candidates = trees.filter(grid_cell__in=cells).values_list('id', 'latitude', 'longitude')
+        best = heapq.nsmallest(k, best + _closest(lat, lon, candidates, k, radius_m))
+
+        # Anything in an unread ring is at least `last` whole cells away
+        reach = last * cell_side
+        if reach >= radius_m or (len(best) == k and best[-1][0] <= reach):
+            break
+        first, last = last + 1, max(last * 2, 1)
+    return best
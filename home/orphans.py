@@ -0,0 +1,120 @@
+import os
+from datetime import timedelta
+
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .direct_uploads import STAGING_PREFIX
+from .models import CustomImage, CustomUser, Message, TreeSubmission
+
+# S3 DeleteObjects takes at most this many keys per call
+DELETE_BATCH_SIZE = 1000
+
+
+def without_references(images):
+    """Narrow a CustomImage queryset to rows no avatar, message or tree (deleted trees included) points at"""
+    return images.filter(
+        ~Exists(CustomUser.objects.filter(avatar=OuterRef('pk'))),
+        ~Exists(Message.objects.filter(image_attachment=OuterRef('pk'))),
+        ~Exists(TreeSubmission.objects.filter(image=OuterRef('pk'))),
+    )
+
+
+def unreferenced_images(grace=timedelta(hours=24)):
+    """
+    CustomImage rows nothing points at, as NOT EXISTS anti-joins. Uploads still in flight and rows younger
+    than `grace` are left alone, since forms create the image a moment before the row that references it.
+    """
+    return without_references(CustomImage.objects.all()).filter(
+        Q(uploaded_at__isnull=True) | Q(uploaded_at__lt=timezone.now() - grace),
+        status__in=['ready', 'failed'],
+    )
+
+
+def referenced_names(images=None):
+    """Every storage name (originals and derivatives) used by the given CustomImage rows (default: all of them)"""
+    names = set()
+    images = CustomImage.objects.all() if images is None else images
+    rows = images.exclude(image='').values_list('image', 'derivatives')
+    for name, derivatives in rows.iterator(chunk_size=5000):
+        names.add(name)
+        names.update(derivatives.values())
+    return names
+
+
+def image_prefixes():
+    """
+    Directories image files are stored under: the content-addressed one, the legacy per-category ones
+    and the staging area for direct uploads that were never confirmed
+    """
+    return ['images', *(category for category, _ in CustomImage.CATEGORY_CHOICES), STAGING_PREFIX]
+
+
+def iter_stored_files(storage, prefix):
+    """
+    Yield (name, last modified) for every file under prefix. S3 buckets are listed flat, 1000 keys per request;
+    other storages are walked with listdir().
+    """
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is not None:
+        location = storage.location.strip('/')
+        root = f"{location}/" if location else ""
+        for obj in bucket.objects.filter(Prefix=f"{root}{prefix}/"):
+            yield obj.key[len(root):], obj.last_modified
+        return
+
+    if not storage.exists(prefix):
+        return
+    directories, files = storage.listdir(prefix)
+    for filename in files:
+        name = f"{prefix}/{filename}"
+        yield name, storage.get_modified_time(name)
+    for directory in directories:
+        yield from iter_stored_files(storage, f"{prefix}/{directory}")
+
+
+def orphaned_files(storage, referenced, grace=timedelta(hours=24)):
+    """Stored image files no row references; recent ones are skipped, as their row may not be committed yet"""
+    cutoff = timezone.now() - grace
+    for prefix in image_prefixes():
+        for name, modified in iter_stored_files(storage, prefix):
+            if name in referenced:
+                continue
+            if timezone.is_naive(modified):
+                modified = timezone.make_aware(modified)
+            if modified < cutoff:
+                yield name
+
+
+def delete_stored_files(storage, names):
+    """
+    Delete names from storage: through DeleteObjects, DELETE_BATCH_SIZE keys per call, on S3,
+    one by one elsewhere. Returns {name: error} for the files that could not be deleted.
+    """
+    errors = {}
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is None:
+        for name in names:
+            try:
+                storage.delete(name)
+            except OSError as e:
+                errors[name] = str(e)
+        return errors
+
+    location = storage.location.strip('/')
+    root = f"{location}/" if location else ""
+    for start in range(0, len(names), DELETE_BATCH_SIZE):
+        batch = names[start:start + DELETE_BATCH_SIZE]
+        response = bucket.delete_objects(Delete={
+            'Objects': [{'Key': f"{root}{name}"} for name in batch],
+            'Quiet': True,
+        })
+        for error in response.get('Errors', []):
+            errors[error['Key'][len(root):]] = error.get('Message', error.get('Code', ''))
+    return errors
+
+
+def remove_spool_files(paths):
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
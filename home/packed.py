@@ -0,0 +1,86 @@
+import json
+import sys
+from array import array
+
+from django.db.models import BooleanField, ExpressionWrapper, Q
+
+PACKED_CONTENT_TYPE = "application/vnd.catalog.trees"
+PACKED_MAGIC = b"CTP1"
+
+# Species codes are uint16
+PACKED_MAX_SPECIES = 0x10000
+
+# Ids are uint32: the client views them as a Uint32Array, and JavaScript has no cheap uint64 typed
+# array to hand to the map. BigAutoField ids beyond this have to go through the JSON format.
+PACKED_MAX_ID = 0xFFFFFFFF
+
+# Bits of the per-tree flags column
+FLAG_FLAGGED = 1
+FLAG_HAS_IMAGE = 2
+FLAG_HAS_DESCRIPTION = 4
+
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_packed_trees(trees, meta=None):
+    """
+    Encode trees as one columnar little-endian buffer:
+
+        "CTP1" | uint32 count | uint32 meta length | meta JSON (space padded to 4 bytes)
+        | uint32 ids | float32 latitudes | float32 longitudes | uint16 species codes | uint8 flags
+
+    The meta JSON carries the species dictionary ("species": [names], indexed by the codes)
+    plus anything passed in meta. Every column starts 4-byte aligned, so a client can view each one
+    as a typed array without copying. Descriptions and other details are fetched per tree on demand.
+    Raises ValueError when the trees span more than PACKED_MAX_SPECIES species, or when a tree id is
+    above PACKED_MAX_ID.
+    """
+    rows = (
+        trees.annotate(has_description=ExpressionWrapper(~Q(description=''), output_field=BooleanField()))
+        .order_by('id')
+        .values_list('id', 'latitude', 'longitude', 'species', 'is_flagged', 'image_id', 'has_description')
+    )
+
+    ids = array('I')
+    lats = array('f')
+    lons = array('f')
+    codes = array('H')
+    flags = bytearray()
+    species_codes = {}
+    for tree_id, lat, lon, species, is_flagged, image_id, has_description in rows.iterator(chunk_size=5000):
+        code = species_codes.get(species)
+        if code is None:
+            code = species_codes[species] = len(species_codes)
+            if code >= PACKED_MAX_SPECIES:
+                raise ValueError("too many species for the packed format; request a smaller bbox or use JSON")
+        if tree_id > PACKED_MAX_ID:
+            raise ValueError("tree ids above 2**32-1 don't fit the packed format; use JSON")
+        ids.append(tree_id)
+        lats.append(lat)
+        lons.append(lon)
+        codes.append(code)
+        flags.append(
+            (FLAG_FLAGGED if is_flagged else 0)
+            | (FLAG_HAS_IMAGE if image_id else 0)
+            | (FLAG_HAS_DESCRIPTION if has_description else 0)
+        )
+
+    header = dict(meta or {})
+    header['species'] = list(species_codes)
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header_bytes += b' ' * (-len(header_bytes) % 4)
+
+    return b''.join([
+        PACKED_MAGIC,
+        _little_endian(array('I', [len(ids), len(header_bytes)])),
+        header_bytes,
+        _little_endian(ids),
+        _little_endian(lats),
+        _little_endian(lons),
+        _little_endian(codes),
+        bytes(flags),
+    ])
@@ -0,0 +1,153 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .clusters import cluster_keys_for_point
+from .map_cache import bump_generation, current_generation
+from .models import CustomImage, CustomUser, TreeSubmission
+from .mvt import tile_keys_for_point
+from .snapshots import mark_snapshot_stale
+from .uploads import generate_image_derivatives, queue_upload
+
+
+logger = logging.getLogger(__name__)
+
+_file_release = threading.local()
+
+# Above this many points it is cheaper to retire every cached tile than to find the affected ones
+PRECISE_INVALIDATION_LIMIT = 50
+
+
+def invalidate_tree_locations(locations):
+    """
+    Clear cached map data (cluster and vector tiles) covering each (latitude, longitude)
+    and mark the GeoJSON snapshot stale.
+    Bulk writes that skip model signals should call this with the affected points.
+    """
+    locations = list(locations)
+    mark_snapshot_stale()
+    if len(locations) > PRECISE_INVALIDATION_LIMIT:
+        bump_generation()
+        return
+
+    generation = current_generation()
+    keys = set()
+    for latitude, longitude in locations:
+        keys.update(cluster_keys_for_point(float(latitude), float(longitude), generation))
+        keys.update(tile_keys_for_point(float(latitude), float(longitude), generation))
+    if keys:
+        cache.delete_many(list(keys))
+
+
+@receiver(post_init, sender=TreeSubmission)
+def remember_tree_location(sender, instance, **kwargs):
+    """Keep the loaded coordinates so a moved tree also clears the tiles it left"""
+    # Read __dict__ directly so deferred fields aren't fetched one query at a time
+    instance._loaded_location = (instance.__dict__.get('latitude'), instance.__dict__.get('longitude'))
+
+
+def _tree_locations(instance):
+    locations = {(instance.latitude, instance.longitude), getattr(instance, '_loaded_location', (None, None))}
+    return [(lat, lon) for lat, lon in locations if lat is not None and lon is not None]
+
+
+@receiver(post_save, sender=TreeSubmission)
+@receiver(post_delete, sender=TreeSubmission)
+def invalidate_tree_caches(sender, instance, **kwargs):
+    """Clear cached map data covering a tree whenever it is created, edited, flagged or deleted"""
+    invalidate_tree_locations(_tree_locations(instance))
+    instance._loaded_location = (instance.latitude, instance.longitude)
+
+
+def _display_name(user):
+    # Read __dict__ directly so deferred fields aren't fetched one query at a time
+    return user.__dict__.get('nickname') or user.__dict__.get('username')
+
+
+@receiver(post_init, sender=CustomUser)
+def remember_display_name(sender, instance, **kwargs):
+    """Keep the loaded display name so a save can tell whether the user was renamed"""
+    instance._loaded_display_name = _display_name(instance)
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_snapshot_for_user(sender, instance, created, **kwargs):
+    """
+    The snapshot and the change feed show each tree's submitter name, so renaming a user makes the snapshot
+    stale and moves their trees up the feed for clients to pick up the new name.
+    """
+    loaded = getattr(instance, '_loaded_display_name', None)
+    instance._loaded_display_name = _display_name(instance)
+    # Logins and other profile saves leave the name alone; skip those
+    if created or loaded == instance._loaded_display_name:
+        return
+    mark_snapshot_stale()
+    TreeSubmission.objects.filter(user=instance).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=CustomImage)
+def create_image_derivatives(sender, instance, created, **kwargs):
+    """
+    Resize every new upload so pages can show thumbnails instead of the original. The work runs on an upload
+    worker after commit, so a request storing an image doesn't also wait for the six derivative uploads.
+    """
+    # Spooled and direct uploads get theirs once the worker has stored the file (uploads.finish_upload);
+    # rows reusing a stored copy arrive with its derivatives
+    if created and instance.image and instance.is_ready and not instance.derivatives:
+        queue_upload(generate_image_derivatives, instance.pk)
+
+
+@receiver(post_save, sender=CustomImage)
+def touch_trees_for_image(sender, instance, created, **kwargs):
+    """
+    The change feed shows each tree's image URL, which changes as its upload becomes ready,
+    so move the trees using an image up the feed whenever the image is saved again.
+    Derivatives are recorded with update(); images.ensure_derivatives touches the trees itself.
+    """
+    if not created:
+        TreeSubmission.objects.filter(image=instance).update(updated_at=timezone.now())
+
+
+@contextmanager
+def defer_image_file_release():
+    """Delete CustomImage rows without removing their files, for callers that sweep storage themselves (gc_images)"""
+    _file_release.deferred = True
+    try:
+        yield
+    finally:
+        _file_release.deferred = False
+
+
+@receiver(post_delete, sender=CustomImage)
+def release_image_files(sender, instance, **kwargs):
+    """
+    Delete a removed image's stored file and derivatives once no other row references them.
+    Content-addressed uploads can share one object, so the remaining rows act as its reference count.
+    """
+    if getattr(_file_release, 'deferred', False):
+        return
+    spool_path = instance.spool_path
+    name = instance.image.name
+    names = []
+    if name and not CustomImage.objects.filter(image=name).exists():
+        names = [name, *instance.derivatives.values()]
+    storage = instance.image.storage
+
+    def delete_files():
+        if spool_path and os.path.exists(spool_path):
+            os.remove(spool_path)
+        for stored_name in names:
+            try:
+                storage.delete(stored_name)
+            except Exception:
+                # A failed delete only leaves an orphaned file behind, which gc_images sweeps up
+                logger.exception("Could not delete stored image %s", stored_name)
+
+    transaction.on_commit(delete_files)
@@ -0,0 +1,133 @@
+import gzip
+import hashlib
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from .exports import export_rows, iter_geojson
+
+try:
+    import brotli
+except ImportError:  # in requirements.txt; if it fails to build, clients get gzip
+    brotli = None
+
+# Part of every snapshot cache key; bumping it marks the snapshot stale
+SNAPSHOT_VERSION_KEY = "tree_snapshot_version"
+# Only regenerated after a change, so the timeout just bounds memory held by an idle site
+SNAPSHOT_CACHE_TIMEOUT = 60 * 60 * 24
+# How long one request may spend rebuilding before another one tries
+SNAPSHOT_BUILD_LOCK_TIMEOUT = 60
+
+SNAPSHOT_ENCODINGS = ('br', 'gzip', 'identity') if brotli is not None else ('gzip', 'identity')
+
+
+def snapshot_version():
+    version = cache.get(SNAPSHOT_VERSION_KEY)
+    if version is None:
+        cache.add(SNAPSHOT_VERSION_KEY, 1, None)
+        version = cache.get(SNAPSHOT_VERSION_KEY, 1)
+    return version
+
+
+def mark_snapshot_stale():
+    """Make the next request rebuild the GeoJSON snapshot"""
+    try:
+        cache.incr(SNAPSHOT_VERSION_KEY)
+    except ValueError:
+        cache.set(SNAPSHOT_VERSION_KEY, 2, None)
+
+
+def _meta_key(version):
+    return f"tree_snapshot:{version}:meta"
+
+
+def _body_key(version, encoding):
+    return f"tree_snapshot:{version}:{encoding}"
+
+
+def build_snapshot():
+    """Serialize every live tree as a GeoJSON FeatureCollection and compress it once per supported encoding"""
+    body = "".join(iter_geojson(export_rows())).encode('utf-8')
+    bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body)
+    meta = {
+        # Strong validator: identical trees always give identical bytes and the same tag
+        'etag': hashlib.sha256(body).hexdigest()[:32],
+        # Whole seconds, as sent in Last-Modified; _store_snapshot keeps it increasing
+        'last_modified': timezone.now().replace(microsecond=0),
+    }
+    return meta, bodies
+
+
+def get_snapshot_meta():
+    """
+    Return (version, meta) for the current snapshot, rebuilding it if trees changed since it was made.
+    While another request is rebuilding, the previous snapshot is served instead of building twice.
+    """
+    version = snapshot_version()
+    meta = cache.get(_meta_key(version))
+    if meta is not None:
+        return version, meta
+
+    if not cache.add(f"tree_snapshot:{version}:lock", 1, SNAPSHOT_BUILD_LOCK_TIMEOUT):
+        previous = cache.get("tree_snapshot:latest")
+        if previous is not None:
+            previous_meta = cache.get(_meta_key(previous))
+            if previous_meta is not None:
+                return previous, previous_meta
+
+    meta, _ = _store_snapshot(version)
+    return version, meta
+
+
+def _store_snapshot(version):
+    meta, bodies = build_snapshot()
+    previous = cache.get("tree_snapshot:latest")
+    previous_meta = cache.get(_meta_key(previous)) if previous is not None else None
+    if previous_meta is not None:
+        if previous_meta['etag'] == meta['etag']:
+            # Same trees, same validators
+            meta['last_modified'] = previous_meta['last_modified']
+        elif meta['last_modified'] <= previous_meta['last_modified']:
+            # Rebuilt within the second the previous snapshot was stamped with: move past it, or a client
+            # revalidating with If-Modified-Since alone would get a 304 for the snapshot it no longer has
+            meta['last_modified'] = previous_meta['last_modified'] + timedelta(seconds=1)
+    cache.set_many({_body_key(version, encoding): data for encoding, data in bodies.items()}, SNAPSHOT_CACHE_TIMEOUT)
+    # Written last, so a reader that finds the meta also finds the bodies
+    cache.set(_meta_key(version), meta, SNAPSHOT_CACHE_TIMEOUT)
+    cache.set("tree_snapshot:latest", version, None)
+    return meta, bodies
+
+
+def get_snapshot_body(version, meta, encoding):
+    """Return (meta, body) for one encoding; rebuilds if the body was evicted ahead of its meta"""
+    body = cache.get(_body_key(version, encoding))
+    if body is None:
+        # Also covers cache backends that refuse values this large
+        meta, bodies = _store_snapshot(version)
+        body = bodies[encoding]
+    return meta, body
+
+
+def choose_encoding(accept_encoding):
+    """Pick the best stored encoding the client accepts (honouring q=0), falling back to identity"""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    for encoding in SNAPSHOT_ENCODINGS:
+        if encoding == 'identity':
+            break
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return 'identity'
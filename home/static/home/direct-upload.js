@@ -0,0 +1,67 @@
+// Direct-to-bucket image uploads (IMAGE_DIRECT_UPLOADS).
+// File inputs marked with data-direct-upload="<category>" are sent straight to S3 with a presigned POST
+// when their form is submitted; the form then only carries the confirmed image's id (uploaded_image).
+// Any failure falls back to a normal multipart submit through Django.
+
+function csrfToken(form) {
+    const input = form.querySelector('input[name="csrfmiddlewaretoken"]');
+    return input ? input.value : '';
+}
+
+async function postJSON(url, form, body) {
+    const response = await fetch(url, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', 'X-CSRFToken': csrfToken(form) },
+        credentials: 'same-origin',
+        body: JSON.stringify(body),
+    });
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || `Upload failed (${response.status})`);
+    }
+    return data;
+}
+
+async function directUpload(input, file) {
+    const form = input.form;
+    const ticket = await postJSON(input.dataset.ticketUrl, form, {
+        category: input.dataset.directUpload,
+        content_type: file.type,
+        size: file.size,
+    });
+
+    // The policy fields must come before the file
+    const body = new FormData();
+    Object.entries(ticket.fields).forEach(([name, value]) => body.append(name, value));
+    body.append('file', file);
+    const stored = await fetch(ticket.url, { method: 'POST', body: body });
+    if (!stored.ok) {
+        throw new Error(`Storage rejected the upload (${stored.status})`);
+    }
+
+    const image = await postJSON(input.dataset.confirmUrl, form, { ticket: ticket.ticket });
+    return image.id;
+}
+
+document.addEventListener('submit', async function (e) {
+    const form = e.target;
+    // Runs after the page's own submit handlers, so respect their validation
+    if (e.defaultPrevented || form.dataset.directUploadDone) {
+        return;
+    }
+    const input = form.querySelector('input[type="file"][data-direct-upload]');
+    const hidden = form.querySelector('input[name="uploaded_image"]');
+    if (!input || !hidden || !input.files.length) {
+        return;
+    }
+
+    e.preventDefault();
+    form.dataset.directUploadDone = '1';
+    try {
+        hidden.value = await directUpload(input, input.files[0]);
+        input.value = '';
+    } catch (error) {
+        console.warn('Direct upload failed, sending the image through the form instead:', error);
+    }
+    form.submit();
+});
@@ -33,104 +33,245 @@ try {
     throw error;
 }
 
-// Load and display approved trees when map loads
-map.on('load', async () => {
-    console.log('Map loaded, fetching trees...');
-    try {
-        const response = await fetch('/api/trees/');
-        console.log('Response status:', response.status);
+let markersById = new Map(); // Markers already on the map, keyed by tree id
+let loadedBBox = null; // Area covered by the last /api/trees/ response
+let activeSpecies = 'all';
+
+function viewportContained(bounds) {
+    if (!loadedBBox) return false;
+    const [minLon, minLat, maxLon, maxLat] = loadedBBox;
+    return bounds.getWest() >= minLon && bounds.getSouth() >= minLat &&
+        bounds.getEast() <= maxLon && bounds.getNorth() <= maxLat;
+}
 
-        if (!response.ok) throw new Error('Failed to fetch trees');
+// Decode the ?format=packed tree payload (see home/packed.py). Each column is a typed-array view
+// straight onto the response buffer, so there is nothing to parse per tree.
+function decodePackedTrees(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+    if (magic !== 'CTP1') throw new Error('Unexpected tree payload');
+
+    const count = view.getUint32(4, true);
+    const metaLength = view.getUint32(8, true);
+    const meta = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 12, metaLength)));
+
+    let offset = 12 + metaLength;
+    const ids = new Uint32Array(buffer, offset, count); offset += count * 4;
+    const latitudes = new Float32Array(buffer, offset, count); offset += count * 4;
+    const longitudes = new Float32Array(buffer, offset, count); offset += count * 4;
+    const speciesCodes = new Uint16Array(buffer, offset, count); offset += count * 2;
+    const flags = new Uint8Array(buffer, offset, count);
+    return { count, meta, ids, latitudes, longitudes, speciesCodes, flags };
+}
 
-        const data = await response.json();
-        console.log('Received trees data:', data);
-        console.log('Number of approved trees:', data.trees.length);
+function treePopupHTML(tree) {
+    // Build popup content
+    let popupContent = `
+        <div class="tree-popup">
+            <h3>${tree.species}</h3>
+            <p>(${tree.latitude ?? 'No latitude'}, ${tree.longitude ?? 'No longitude'})</p>
+            <p>${tree.height ? 'Height: ' + tree.height + ' ft' : 'No height'}</p>
+            <p>${tree.diameter ? 'Diameter: ' + tree.diameter + ' in' : 'No diameter'}</p>
+    `;
+
+    // Image block
+    if (tree.image) {
+        popupContent += `
+            <div class="csp-popup-margin">
+                <img src="${tree.image}"
+                    alt="${tree.species}"
+                    class="csp-popup-img" />
+            </div>
+        `;
+    } else {
+        popupContent += `<p>No image</p>`;
+    }
 
-        allTrees = data.trees; // Store all trees for filtering
+    popupContent += `
+            <p>${tree.description || 'No description'}</p>
+            <p class="csp-popup-meta">Submitted by: ${tree.submitted_by}</p>
+    `;
+
+    // Add moderator controls if user is a moderator
+    if (IS_MODERATOR) {
+        popupContent += `
+            <div class="moderator-controls">
+                <button class="edit-tree-btn" data-tree-id="${tree.id}">Edit</button>
+                <button class="delete-tree-btn" data-tree-id="${tree.id}">Delete</button>
+            </div>
+        `;
+    } else if (IS_AUTHENTICATED && tree.submitted_by !== CURRENT_USER) {
+        // Regular users can flag trees (but not their own)
+        popupContent += `
+            <div class="user-controls">
+                <button class="flag-tree-btn csp-flag-btn" data-tree-id="${tree.id}">
+                    🚩 Flag for Review
+                </button>
+            </div>
+        `;
+    }
 
-        // Get unique species for filter dropdown
-        const uniqueSpecies = [...new Set(data.trees.map(tree => tree.species))].sort();
-        populateSpeciesFilter(uniqueSpecies);
+    popupContent += `</div>`;
+    return popupContent;
+}
 
-        // Add a marker for each approved tree
-        data.trees.forEach(tree => {
-            console.log(`Adding marker for ${tree.species} at [${tree.longitude}, ${tree.latitude}]`);
-
-            // Build popup content
-            let popupContent = `
-                <div class="tree-popup">
-                    <h3>${tree.species}</h3>
-                    <p>(${tree.latitude ?? 'No latitude'}, ${tree.longitude ?? 'No longitude'})</p>
-                    <p>${tree.height ? 'Height: ' + tree.height + ' ft' : 'No height'}</p>
-                    <p>${tree.diameter ? 'Diameter: ' + tree.diameter + ' in' : 'No diameter'}</p>
-            `;
-
-            // Image block
-            if (tree.image) {
-                popupContent += `
-                    <div class="csp-popup-margin">
-                        <img src="${tree.image}"
-                            alt="${tree.species}"
-                            class="csp-popup-img" />
-                    </div>
-                `;
-            } else {
-                popupContent += `<p>No image</p>`;
-            }
+// Fix Mapbox accessibility issue: remove aria-hidden from close button
+function fixPopupCloseButton(popup) {
+    const closeBtn = popup.getElement()?.querySelector('.mapboxgl-popup-close-button');
+    if (closeBtn) {
+        closeBtn.removeAttribute('aria-hidden');
+    }
+}
 
-            popupContent += `
-                    <p>${tree.description || 'No description'}</p>
-                    <p class="csp-popup-meta">Submitted by: ${tree.submitted_by}</p>
-            `;
-
-            // Add moderator controls if user is a moderator
-            if (IS_MODERATOR) {
-                popupContent += `
-                    <div class="moderator-controls">
-                        <button class="edit-tree-btn" data-tree-id="${tree.id}">Edit</button>
-                        <button class="delete-tree-btn" data-tree-id="${tree.id}">Delete</button>
-                    </div>
-                `;
-            } else if (IS_AUTHENTICATED && tree.submitted_by !== CURRENT_USER) {
-                // Regular users can flag trees (but not their own)
-                popupContent += `
-                    <div class="user-controls">
-                        <button class="flag-tree-btn csp-flag-btn" data-tree-id="${tree.id}">
-                            🚩 Flag for Review
-                        </button>
-                    </div>
-                `;
-            }
+// Trees from the packed payload only carry id, position and species;
+// the rest (description, image, submitter) is fetched the first time the popup opens.
+function addTreeMarker(tree) {
+    const detailsLoaded = tree.submitted_by !== undefined;
+    const popup = new mapboxgl.Popup({ offset: 25 })
+        .setHTML(detailsLoaded ? treePopupHTML(tree) : `<div class="tree-popup"><h3>${tree.species}</h3><p>Loading…</p></div>`);
 
-            popupContent += `</div>`;
+    const marker = new mapboxgl.Marker({ color: '#228B22' })
+        .setLngLat([tree.longitude, tree.latitude])
+        .setPopup(popup)
+        .addTo(map);
 
-            const popup = new mapboxgl.Popup({ offset: 25 })
-                .setHTML(popupContent);
+    let details = detailsLoaded ? Promise.resolve() : null;
+    popup.on('open', async () => {
+        fixPopupCloseButton(popup);
+        if (details) return;
+        details = fetch(`/api/trees/${tree.id}/`)
+            .then(response => {
+                if (!response.ok) throw new Error('Failed to fetch tree');
+                return response.json();
+            })
+            .then(data => {
+                Object.assign(tree, data);
+                popup.setHTML(treePopupHTML(tree));
+                fixPopupCloseButton(popup);
+            })
+            .catch(error => {
+                details = null; // try again next time the popup opens
+                console.error('Error loading tree details:', error);
+            });
+    });
 
-            const marker = new mapboxgl.Marker({ color: '#228B22' })
-                .setLngLat([tree.longitude, tree.latitude])
-                .setPopup(popup)
-                .addTo(map);
+    // Store marker with species info for filtering
+    const item = { marker: marker, species: tree.species };
+    allMarkers.push(item);
+    markersById.set(tree.id, item);
+    if (activeSpecies !== 'all' && tree.species !== activeSpecies) {
+        marker.getElement().style.display = 'none';
+    }
+}
 
-            // Store marker with species info for filtering
-            allMarkers.push({
-                marker: marker,
-                species: tree.species
-            });
+// Below this zoom the map shows server-side clusters instead of individual trees
+const CLUSTER_BELOW_ZOOM = 12;
+let clusterMarkers = [];
+let clusterRequest = 0;
+
+function setTreeMarkersVisible(visible) {
+    allMarkers.forEach(item => {
+        const show = visible && (activeSpecies === 'all' || item.species === activeSpecies);
+        item.marker.getElement().style.display = show ? 'block' : 'none';
+    });
+}
+
+function clearClusters() {
+    clusterMarkers.forEach(marker => marker.remove());
+    clusterMarkers = [];
+}
+
+// Fetch one marker per grid cell for the zoomed-out map
+async function loadClusters() {
+    const bounds = map.getBounds();
+    const bbox = [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()]
+        .map(v => v.toFixed(6)).join(',');
+    const zoom = Math.floor(map.getZoom());
+    const requestId = ++clusterRequest;
+
+    try {
+        const response = await fetch(`/api/trees/clusters/?z=${zoom}&bbox=${bbox}`);
+        if (!response.ok) throw new Error('Failed to fetch clusters');
 
-            // Fix Mapbox accessibility issue: remove aria-hidden from close button
-            popup.on('open', () => {
-                const closeBtn = popup.getElement().querySelector('.mapboxgl-popup-close-button');
-                if (closeBtn) {
-                    closeBtn.removeAttribute('aria-hidden');
-                }
+        const data = await response.json();
+        // Ignore responses that arrive after the user kept moving
+        if (requestId !== clusterRequest || map.getZoom() >= CLUSTER_BELOW_ZOOM) return;
+
+        clearClusters();
+        data.clusters.forEach(cluster => {
+            const count = activeSpecies === 'all' ? cluster.count : (cluster.species[activeSpecies] || 0);
+            if (!count) return;
+
+            const el = document.createElement('div');
+            el.className = 'tree-cluster';
+            el.textContent = count;
+            el.addEventListener('click', () => {
+                map.easeTo({ center: [cluster.longitude, cluster.latitude], zoom: zoom + 2 });
             });
+
+            clusterMarkers.push(new mapboxgl.Marker({ element: el })
+                .setLngLat([cluster.longitude, cluster.latitude])
+                .addTo(map));
         });
-        console.log('All markers added successfully');
+
+        const species = new Set(allTrees.map(tree => tree.species));
+        data.clusters.forEach(cluster => Object.keys(cluster.species).forEach(sp => species.add(sp)));
+        populateSpeciesFilter([...species].sort());
+    } catch (error) {
+        console.error('Error loading clusters:', error);
+    }
+}
+
+// Fetch only the trees inside the current viewport. The server snaps the box out
+// to whole tiles, so small pans inside the returned bbox need no extra request.
+async function loadVisibleTrees() {
+    if (map.getZoom() < CLUSTER_BELOW_ZOOM) {
+        setTreeMarkersVisible(false);
+        loadClusters();
+        return;
+    }
+    clusterRequest++;
+    clearClusters();
+    setTreeMarkersVisible(true);
+
+    const bounds = map.getBounds();
+    if (viewportContained(bounds)) return;
+
+    const bbox = [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()]
+        .map(v => v.toFixed(6)).join(',');
+    const zoom = Math.floor(map.getZoom());
+
+    try {
+        const response = await fetch(`/api/trees/?bbox=${bbox}&zoom=${zoom}&format=packed`);
+        if (!response.ok) throw new Error('Failed to fetch trees');
+
+        const packed = decodePackedTrees(await response.arrayBuffer());
+        loadedBBox = packed.meta.bbox || null;
+
+        for (let i = 0; i < packed.count; i++) {
+            const id = packed.ids[i];
+            if (markersById.has(id)) continue;
+            const tree = {
+                id: id,
+                latitude: packed.latitudes[i],
+                longitude: packed.longitudes[i],
+                species: packed.meta.species[packed.speciesCodes[i]],
+            };
+            allTrees.push(tree);
+            addTreeMarker(tree);
+        }
+
+        // Get unique species for filter dropdown
+        const uniqueSpecies = [...new Set(allTrees.map(tree => tree.species))].sort();
+        populateSpeciesFilter(uniqueSpecies);
     } catch (error) {
         console.error('Error loading trees:', error);
     }
-});
+}
+
+// Load trees for the initial viewport, then again whenever the map is moved
+map.on('load', loadVisibleTrees);
+map.on('moveend', loadVisibleTrees);
 
 let addMode = false;
 let tempMarker = null;
@@ -330,19 +471,16 @@ function populateSpeciesFilter(species) {
 }
 
 function filterBySpecies(selectedSpecies) {
-    allMarkers.forEach(item => {
-        if (selectedSpecies === 'all') {
-            // Show all markers
-            item.marker.getElement().style.display = 'block';
-        } else {
-            // Show only markers matching the selected species
-            if (item.species === selectedSpecies) {
-                item.marker.getElement().style.display = 'block';
-            } else {
-                item.marker.getElement().style.display = 'none';
-            }
-        }
-    });
+    activeSpecies = selectedSpecies;
+
+    if (map.getZoom() < CLUSTER_BELOW_ZOOM) {
+        // Cluster counts are per species, so redraw them for the new selection
+        loadClusters();
+        return;
+    }
+
+    // Show all markers, or only markers matching the selected species
+    setTreeMarkersVisible(true);
 }
 
 // Initialize filter button after DOM is loaded
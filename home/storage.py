@@ -0,0 +1,116 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage, InMemoryStorage, Storage
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .images import clear_url_cache
+
+
+def build_image_storage():
+    """
+    Create the storage named by IMAGE_STORAGE:
+      "s3"     the bucket configured by the AWS_* settings (django-storages; boto3 is imported here, not before)
+      "local"  files under IMAGE_STORAGE_ROOT, served from IMAGE_STORAGE_URL
+      "memory" a per-process in-memory store with the same URLs, for tests and benchmarks
+    or a dotted path to any Storage class, which is instantiated without arguments.
+    """
+    backend = settings.IMAGE_STORAGE
+    if backend == 's3':
+        from storages.backends.s3boto3 import S3Boto3Storage
+        return S3Boto3Storage()
+    if backend == 'local':
+        return FileSystemStorage(location=settings.IMAGE_STORAGE_ROOT, base_url=settings.IMAGE_STORAGE_URL)
+    if backend == 'memory':
+        return InMemoryStorage(base_url=settings.IMAGE_STORAGE_URL)
+    if '.' in backend:
+        return import_string(backend)()
+    raise ImproperlyConfigured(f"Unknown IMAGE_STORAGE {backend!r}; use 's3', 'local', 'memory' or a dotted path")
+
+
+class LazyImageStorage(Storage):
+    """
+    Stands in for the IMAGE_STORAGE backend and creates it on first use. A plain LazyObject won't do:
+    FileField's isinstance(storage, Storage) check would set it up as soon as models.py is imported.
+    """
+    _backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = build_image_storage()
+        return self._backend
+
+    def __getattr__(self, name):
+        # Backend-specific attributes (bucket, location, base_url, querystring_auth, ...)
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def open(self, name, mode='rb'):
+        return self.backend.open(name, mode)
+
+    def save(self, name, content, max_length=None):
+        return self.backend.save(name, content, max_length=max_length)
+
+    def get_valid_name(self, name):
+        return self.backend.get_valid_name(name)
+
+    def get_alternative_name(self, file_root, file_ext):
+        return self.backend.get_alternative_name(file_root, file_ext)
+
+    def get_available_name(self, name, max_length=None):
+        return self.backend.get_available_name(name, max_length=max_length)
+
+    def generate_filename(self, filename):
+        return self.backend.generate_filename(filename)
+
+    def path(self, name):
+        return self.backend.path(name)
+
+    def delete(self, name):
+        return self.backend.delete(name)
+
+    def exists(self, name):
+        return self.backend.exists(name)
+
+    def listdir(self, path):
+        return self.backend.listdir(path)
+
+    def size(self, name):
+        return self.backend.size(name)
+
+    def url(self, name):
+        return self.backend.url(name)
+
+    def get_accessed_time(self, name):
+        return self.backend.get_accessed_time(name)
+
+    def get_created_time(self, name):
+        return self.backend.get_created_time(name)
+
+    def get_modified_time(self, name):
+        return self.backend.get_modified_time(name)
+
+
+_image_storage = LazyImageStorage()
+
+
+def image_storage():
+    """Storage for CustomImage.image; the backend is only created on first use"""
+    return _image_storage
+
+
+def reset_image_storage():
+    """Build the storage again on next use, e.g. after changing IMAGE_STORAGE"""
+    _image_storage._backend = None
+    # Cached URLs are keyed by the (unchanging) stand-in, so they would outlive the backend
+    clear_url_cache()
+
+
+@receiver(setting_changed)
+def _image_storage_setting_changed(setting, **kwargs):
+    # Lets override_settings(IMAGE_STORAGE='memory') swap the backend
+    if setting.startswith('IMAGE_STORAGE'):
+        reset_image_storage()
@@ -1,3 +1,2278 @@
-from django.test import TestCase
+import base64
+import csv
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+from array import array
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from io import BytesIO, StringIO
+from unittest import mock, skipIf
 
-# Create your tests here.
+import requests
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, InMemoryStorage
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import QuerySet
+from django.db.migrations.executor import MigrationExecutor
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date, parse_http_date
+from django.utils.datastructures import MultiValueDict
+from PIL import Image, ImageCms
+
+try:
+    from moto import mock_aws
+except ImportError:  # requirements-dev.txt
+    mock_aws = None
+
+from .clusters import get_clusters
+from .dedupe import find_duplicate, find_duplicate_clusters, merge_duplicate_cluster, save_tree
+from .direct_uploads import (
+    TICKET_SALT, DirectUploadError, claim_uploaded_image, confirm_upload, create_upload_ticket, finish_direct_upload,
+)
+from .export_jobs import claim_next_job, delete_expired_jobs, request_export, run_export_job
+from .forms import clean_tree_row
+from .geo import (
+    BBox, filter_bbox, grid_cell, haversine_batch, haversine_m, parse_bbox, parse_zoom, snap_bbox_to_tiles,
+)
+from .images import clear_url_cache, normalize_upload, storage_url
+from .ingest import BulkTreeImporter, iter_geojson_features
+from .management.commands import import_trees
+from .models import (
+    Conversation, ConversationMembership, CustomImage, CustomUser, ExportJob, ImportCheckpoint, Message, TreeSubmission,
+)
+from .mvt import EXTENT, MIN_TILE_ZOOM, TILE_CONTENT_TYPE, encode_point_layer
+from .orphans import unreferenced_images
+from .nearby import nearest_tree_ids
+from . import snapshots
+from .packed import FLAG_FLAGGED, FLAG_HAS_DESCRIPTION, FLAG_HAS_IMAGE, PACKED_CONTENT_TYPE, PACKED_MAGIC
+from .storage import LazyImageStorage, build_image_storage, image_storage, reset_image_storage
+from .uploads import _run_in_thread, finish_upload, generate_image_derivatives, store_uploaded_image
+from .views import decode_change_cursor, encode_change_cursor, parse_range_header
+
+
+def make_tree(user, latitude, longitude, species="Oak", **fields):
+    return TreeSubmission.objects.create(user=user, species=species, latitude=latitude, longitude=longitude, **fields)
+
+
+def image_bytes(size=(40, 30), color=(30, 120, 60), image_format='PNG', mode='RGB', **save_args):
+    buffer = BytesIO()
+    Image.new(mode, size, color).save(buffer, image_format, **save_args)
+    return buffer.getvalue()
+
+
+def make_image(user, category="tree_images", name="leaf.png", **fields):
+    """A stored CustomImage; use with IMAGE_STORAGE="memory" so nothing leaves the process"""
+    return CustomImage.objects.create(image=ContentFile(image_bytes(), name=name), user=user, category=category, **fields)
+
+
+class BBoxParsingTests(SimpleTestCase):
+    def test_parses_four_values(self):
+        bbox = parse_bbox("-78.6, 38.0, -78.4,38.1")
+        self.assertEqual(bbox.as_list(), [-78.6, 38.0, -78.4, 38.1])
+        self.assertFalse(bbox.crosses_antimeridian)
+
+    def test_rejects_malformed_values(self):
+        for value in ["", "1,2,3", "1,2,3,4,5", "a,b,c,d", "nan,0,1,1", "inf,0,1,1",
+                      "-181,0,1,1", "0,-91,1,1", "0,10,1,5"]:
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_bbox(value)
+
+    def test_antimeridian_box(self):
+        bbox = parse_bbox("170,-10,-170,10")
+        self.assertTrue(bbox.crosses_antimeridian)
+        self.assertTrue(bbox.contains(175, 0))
+        self.assertTrue(bbox.contains(-175, 0))
+        self.assertFalse(bbox.contains(0, 0))
+
+    def test_zoom_range(self):
+        self.assertEqual(parse_zoom("0"), 0)
+        self.assertEqual(parse_zoom("22"), 22)
+        for value in ["-1", "23", "x", "1.5"]:
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_zoom(value)
+
+    def test_snap_grows_box_to_tile_edges(self):
+        bbox = BBox(-78.5, 38.02, -78.49, 38.03)
+        snapped = snap_bbox_to_tiles(bbox, 10)
+        self.assertLessEqual(snapped.min_lon, bbox.min_lon)
+        self.assertLessEqual(snapped.min_lat, bbox.min_lat)
+        self.assertGreaterEqual(snapped.max_lon, bbox.max_lon)
+        self.assertGreaterEqual(snapped.max_lat, bbox.max_lat)
+        # Zoom 10 tiles are 360/1024 degrees wide
+        tiles = (snapped.max_lon - snapped.min_lon) / (360 / 1024)
+        self.assertAlmostEqual(tiles, round(tiles), places=9)
+
+
+class TreeBBoxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+        cls.inside = make_tree(cls.user, 38.03, -78.48)
+        cls.outside = make_tree(cls.user, 40.0, -75.0)
+        cls.east = make_tree(cls.user, 0.0, 179.5)
+        cls.west = make_tree(cls.user, 0.0, -179.5)
+        cls.deleted = make_tree(cls.user, 38.031, -78.481, is_deleted=True)
+
+    def test_filter_bbox(self):
+        trees = filter_bbox(TreeSubmission.objects.all(), BBox(-79, 38, -78, 39))
+        self.assertEqual(set(trees.values_list('id', flat=True)), {self.inside.id, self.deleted.id})
+
+    def test_filter_bbox_across_antimeridian(self):
+        trees = filter_bbox(TreeSubmission.objects.all(), BBox(179, -1, -179, 1))
+        self.assertEqual(set(trees.values_list('id', flat=True)), {self.east.id, self.west.id})
+
+    def test_get_trees_with_bbox(self):
+        response = self.client.get("/api/trees/", {"bbox": "-79,38,-78,39"}, secure=True)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([tree['id'] for tree in data['trees']], [self.inside.id])
+        self.assertEqual(data['bbox'], [-79, 38, -78, 39])
+
+    def test_get_trees_snaps_to_zoom(self):
+        response = self.client.get("/api/trees/", {"bbox": "-78.481,38.029,-78.479,38.031", "zoom": "12"}, secure=True)
+        data = response.json()
+        self.assertEqual([tree['id'] for tree in data['trees']], [self.inside.id])
+        self.assertLess(data['bbox'][0], -78.481)
+
+    def test_get_trees_without_bbox_returns_all_live_trees(self):
+        response = self.client.get("/api/trees/", secure=True)
+        self.assertEqual(len(response.json()['trees']), 4)
+
+    def test_get_trees_rejects_bad_bbox(self):
+        for params in [{"bbox": "1,2,3"}, {"bbox": "0,0,1,1", "zoom": "99"}]:
+            with self.subTest(params=params):
+                response = self.client.get("/api/trees/", params, secure=True)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("error", response.json())
+
+
+class TreeClusterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+        make_tree(cls.user, 38.0300, -78.4800, species="Oak")
+        make_tree(cls.user, 38.0301, -78.4801, species="Oak")
+        make_tree(cls.user, 38.0302, -78.4802, species="Maple")
+        make_tree(cls.user, 38.0303, -78.4803, species="Maple", is_deleted=True)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_nearby_trees_share_a_cluster(self):
+        clusters = get_clusters(10, BBox(-79, 37.5, -78, 38.5))
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0]['count'], 3)
+        self.assertEqual(clusters[0]['species'], {"Oak": 2, "Maple": 1})
+        self.assertAlmostEqual(clusters[0]['latitude'], 38.0301, places=4)
+
+    def test_clusters_split_at_high_zoom(self):
+        clusters = get_clusters(18, BBox(-78.4805, 38.0299, -78.4799, 38.0304))
+        self.assertEqual(sum(cluster['count'] for cluster in clusters), 3)
+        self.assertGreater(len(clusters), 1)
+
+    def test_saving_a_tree_refreshes_cached_clusters(self):
+        bbox = BBox(-79, 37.5, -78, 38.5)
+        self.assertEqual(get_clusters(10, bbox)[0]['count'], 3)
+        make_tree(self.user, 38.0304, -78.4804)
+        self.assertEqual(get_clusters(10, bbox)[0]['count'], 4)
+
+    def test_endpoint(self):
+        response = self.client.get("/api/trees/clusters/", {"z": "10", "bbox": "-79,37.5,-78,38.5"}, secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['zoom'], 10)
+        self.assertEqual(response.json()['clusters'][0]['count'], 3)
+
+    def test_endpoint_rejects_bad_requests(self):
+        for params in [{}, {"z": "10"}, {"z": "19", "bbox": "0,0,1,1"}, {"z": "18", "bbox": "-80,30,-70,40"}]:
+            with self.subTest(params=params):
+                response = self.client.get("/api/trees/clusters/", params, secure=True)
+                self.assertEqual(response.status_code, 400)
+
+
+def read_protobuf(data):
+    """Decode one protobuf message into [(field, value)]; length-delimited values stay bytes"""
+    fields, pos = [], 0
+
+    def varint():
+        nonlocal pos
+        result = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return result
+
+    while pos < len(data):
+        key = varint()
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            fields.append((field, varint()))
+        elif wire_type == 1:
+            fields.append((field, struct.unpack('<d', data[pos:pos + 8])[0]))
+            pos += 8
+        elif wire_type == 2:
+            length = varint()
+            fields.append((field, data[pos:pos + length]))
+            pos += length
+        else:
+            raise AssertionError(f"unexpected wire type {wire_type}")
+    return fields
+
+
+def read_packed_varints(data):
+    values, result, shift = [], 0, 0
+    for byte in data:
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(result)
+            result = shift = 0
+    return values
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode_tile(data):
+    """{layer name: {'extent', 'features': [{'id', 'x', 'y', 'properties'}]}} of a point-only vector tile"""
+    layers = {}
+    for field, layer_bytes in read_protobuf(data):
+        assert field == 3
+        layer = read_protobuf(layer_bytes)
+        keys = [value.decode() for field, value in layer if field == 3]
+        values = []
+        for field, value_bytes in layer:
+            if field == 4:
+                (value_field, value), = read_protobuf(value_bytes)
+                values.append({1: lambda v: v.decode(), 3: float, 5: int, 6: unzigzag, 7: bool}[value_field](value))
+        features = []
+        for field, feature_bytes in layer:
+            if field != 2:
+                continue
+            feature = dict(read_protobuf(feature_bytes))
+            tags = read_packed_varints(feature[2])
+            command, x, y = read_packed_varints(feature[4])
+            assert command == (1 << 3) | 1 and feature[3] == 1
+            features.append({
+                'id': feature[1],
+                'x': unzigzag(x),
+                'y': unzigzag(y),
+                'properties': {keys[k]: values[v] for k, v in zip(tags[::2], tags[1::2])},
+            })
+        layer = dict(layer)
+        assert layer[15] == 2
+        layers[layer[1].decode()] = {'extent': layer[5], 'features': features}
+    return layers
+
+
+class VectorTileTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+        cls.tree = make_tree(cls.user, 38.03, -78.48, species="Oak", is_flagged=True)
+        make_tree(cls.user, 38.03, -78.48, species="Elm", is_deleted=True)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_encode_point_layer(self):
+        tile = decode_tile(encode_point_layer("trees", [
+            (1, 10, 20, {'species': "Oak", 'flagged': True, 'count': 3, 'skipped': None}),
+            (300, -5, 4100, {'species': "Oak", 'flagged': False, 'count': -2, 'score': 0.5}),
+        ]))
+        layer = tile["trees"]
+        self.assertEqual(layer['extent'], EXTENT)
+        self.assertEqual(layer['features'], [
+            {'id': 1, 'x': 10, 'y': 20, 'properties': {'species': "Oak", 'flagged': True, 'count': 3}},
+            {'id': 300, 'x': -5, 'y': 4100,
+             'properties': {'species': "Oak", 'flagged': False, 'count': -2, 'score': 0.5}},
+        ])
+
+    def test_tile_endpoint(self):
+        # z14 tile holding Charlottesville
+        response = self.client.get("/api/trees/tiles/14/4620/6318.mvt", secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], TILE_CONTENT_TYPE)
+        features = decode_tile(response.content)["trees"]['features']
+        self.assertEqual(len(features), 1)
+        feature = features[0]
+        self.assertEqual(feature['id'], self.tree.id)
+        self.assertEqual(feature['properties'], {'id': self.tree.id, 'species': "Oak", 'is_flagged': True})
+        self.assertTrue(0 <= feature['x'] < EXTENT and 0 <= feature['y'] < EXTENT)
+
+        response = self.client.get("/api/trees/tiles/14/4620/6318.mvt", secure=True,
+                                   headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_tile_changes_when_a_tree_moves_in(self):
+        etag = self.client.get("/api/trees/tiles/14/4620/6318.mvt", secure=True)['ETag']
+        make_tree(self.user, 38.031, -78.481, species="Maple")
+        response = self.client.get("/api/trees/tiles/14/4620/6318.mvt", secure=True, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(decode_tile(response.content)["trees"]['features']), 2)
+
+    def test_tiles_outside_the_pyramid_are_404(self):
+        for path in ["/api/trees/tiles/19/0/0.mvt", "/api/trees/tiles/12/4096/0.mvt", "/api/trees/tiles/12/0/4096.mvt"]:
+            with self.subTest(path=path):
+                self.assertEqual(self.client.get(path, secure=True).status_code, 404)
+
+    def test_zoomed_out_tiles_are_not_built(self):
+        # Those zooms show clusters; a tile would hold most of the catalog
+        with mock.patch('home.mvt.build_tree_tile', side_effect=AssertionError("built a low-zoom tile")):
+            for zoom in (0, 5, MIN_TILE_ZOOM - 1):
+                with self.subTest(zoom=zoom):
+                    response = self.client.get(f"/api/trees/tiles/{zoom}/0/0.mvt", secure=True)
+                    self.assertEqual(response.status_code, 404)
+        response = self.client.get(f"/api/trees/tiles/{MIN_TILE_ZOOM}/1155/1579.mvt", secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(decode_tile(response.content)["trees"]['features']), 1)
+
+
+class TreeChangeFeedTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+        cls.trees = [make_tree(cls.user, 38.03 + i / 1000, -78.48) for i in range(5)]
+
+    def get_changes(self, **params):
+        return self.client.get("/api/trees/changes/", params, secure=True)
+
+    def test_cursor_round_trip(self):
+        tree = self.trees[0]
+        cursor = encode_change_cursor(tree.updated_at, tree.id)
+        self.assertEqual(decode_change_cursor(cursor), (tree.updated_at, tree.id))
+
+    def test_pages_through_the_catalog(self):
+        first = self.get_changes(limit=3).json()
+        self.assertEqual([tree['id'] for tree in first['upserts']], [tree.id for tree in self.trees[:3]])
+        self.assertTrue(first['has_more'])
+        second = self.get_changes(limit=3, since=first['cursor']).json()
+        self.assertEqual([tree['id'] for tree in second['upserts']], [tree.id for tree in self.trees[3:]])
+        self.assertFalse(second['has_more'])
+
+        third = self.get_changes(since=second['cursor']).json()
+        self.assertEqual((third['upserts'], third['deleted'], third['cursor']), ([], [], second['cursor']))
+
+    def test_reports_edits_and_deletions_after_the_cursor(self):
+        cursor = self.get_changes().json()['cursor']
+        edited, deleted = self.trees[1], self.trees[3]
+        edited.description = "Leaning"
+        edited.save()
+        deleted.is_deleted = True
+        deleted.save()
+
+        changes = self.get_changes(since=cursor).json()
+        self.assertEqual([tree['id'] for tree in changes['upserts']], [edited.id])
+        self.assertEqual(changes['deleted'], [deleted.id])
+
+    def test_renaming_a_user_reports_their_trees(self):
+        other = make_tree(CustomUser.objects.create(username="other", profile_completed=True), 38.1, -78.4)
+        cursor = self.get_changes().json()['cursor']
+        # A save that leaves the name alone (a login) moves nothing
+        self.user.last_login = timezone.now()
+        self.user.save(update_fields=['last_login'])
+        self.assertEqual(self.get_changes(since=cursor).json()['upserts'], [])
+
+        self.user.nickname = "Treebeard"
+        self.user.save()
+        changes = self.get_changes(since=cursor).json()
+        self.assertEqual([tree['id'] for tree in changes['upserts']], [tree.id for tree in self.trees])
+        self.assertEqual({tree['submitted_by'] for tree in changes['upserts']}, {"Treebeard"})
+        self.assertNotIn(other.id, [tree['id'] for tree in changes['upserts']])
+
+    @override_settings(IMAGE_STORAGE='memory')
+    def test_image_becoming_ready_reports_its_trees(self):
+        reset_image_storage()
+        image = make_image(self.user, status='pending')
+        tree = make_tree(self.user, 38.1, -78.4, image=image)
+        cursor = self.get_changes().json()['cursor']
+        self.assertIsNone(self.get_changes().json()['upserts'][-1]['image'])
+
+        image.status = 'ready'
+        image.save(update_fields=['status'])
+        changes = self.get_changes(since=cursor).json()
+        self.assertEqual([(t['id'], t['image']) for t in changes['upserts']], [(tree.id, image.url)])
+
+        # The derivatives arrive later, through update(), and swap in the resized URL
+        generate_image_derivatives(image.pk)
+        image.refresh_from_db()
+        changes = self.get_changes(since=changes['cursor']).json()
+        self.assertEqual([(t['id'], t['image']) for t in changes['upserts']], [(tree.id, image.large_url)])
+        self.assertNotEqual(image.large_url, image.url)
+
+    def test_rejects_malformed_cursors(self):
+        for cursor in ["abc", "1", "1-", "-1", "1-2-3", "x-1", "1-x", "1.5-2",
+                       "99999999999999999999-1", "-99999999999999999999-1"]:
+            with self.subTest(cursor=cursor):
+                response = self.get_changes(since=cursor)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {"error": "Invalid cursor"})
+
+    def test_out_of_range_tree_id_is_not_an_error(self):
+        cursor = encode_change_cursor(self.trees[0].updated_at, 99999999999999999999)
+        self.assertEqual(self.get_changes(since=cursor).status_code, 200)
+
+    def test_rejects_bad_limits(self):
+        for limit in ["0", "-5", "x"]:
+            with self.subTest(limit=limit):
+                self.assertEqual(self.get_changes(limit=limit).status_code, 400)
+
+
+@override_settings(IMAGE_STORAGE='memory')
+class UserListTests(TestCase):
+    url = "/api/users/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.me = CustomUser.objects.create_user(username="me", password="x", profile_completed=True)
+        cls.others = [
+            CustomUser.objects.create(username=name, profile_completed=True, nickname=nickname)
+            for name, nickname in (("dana", ""), ("bea", "Birch Fan"), ("cam", ""), ("abe", "Maple Lover"), ("eve", ""))
+        ]
+        CustomUser.objects.create(username="gone", profile_completed=True, is_active=False)
+
+    def setUp(self):
+        reset_image_storage()
+        self.client.force_login(self.me)
+
+    def get(self, **params):
+        return self.client.get(self.url, params, secure=True)
+
+    def test_pages(self):
+        first = self.get(page_size=2).json()
+        self.assertEqual([user['username'] for user in first['users']], ["abe", "bea"])
+        self.assertEqual((first['page'], first['has_next']), (1, True))
+        last = self.get(page_size=2, page=3).json()
+        self.assertEqual([user['username'] for user in last['users']], ["eve"])
+        self.assertFalse(last['has_next'])
+        self.assertEqual(self.get(page_size=2, page=4).json()['users'], [])
+        # Inactive users and the requester are left out
+        self.assertEqual(len(self.get().json()['users']), 5)
+
+    def test_fields(self):
+        abe = self.others[3]
+        abe.avatar = make_image(abe, category="avatars")
+        abe.save()
+        users = {user['username']: user for user in self.get().json()['users']}
+        self.assertEqual(set(users['abe']), {'id', 'username', 'display_name', 'avatar'})
+        self.assertEqual((users['abe']['id'], users['abe']['display_name']), (abe.id, "Maple Lover"))
+        self.assertEqual(users['abe']['avatar'], abe.avatar.thumbnail_url)
+        self.assertEqual((users['cam']['display_name'], users['cam']['avatar']), ("cam", None))
+
+    def test_search(self):
+        self.assertEqual([user['username'] for user in self.get(q="maple").json()['users']], ["abe"])
+        self.assertEqual([user['username'] for user in self.get(q="A").json()['users']], ["abe", "bea", "cam", "dana"])
+
+    def test_page_parameters(self):
+        self.assertEqual(self.get(page="two").status_code, 400)
+        self.assertEqual(self.get(page_size="x").status_code, 400)
+        # Out-of-range values are clamped rather than rejected
+        response = self.get(page=0, page_size=0).json()
+        self.assertEqual((response['page'], len(response['users']), response['has_next']), (1, 1, True))
+        with mock.patch('home.views.USERS_MAX_PAGE_SIZE', 3):
+            self.assertEqual(len(self.get(page_size=1000).json()['users']), 3)
+
+    def test_queries_do_not_grow_with_users(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                self.get()
+            return len(queries)
+
+        baseline = count_queries()
+        for i in range(10):
+            user = CustomUser.objects.create(username=f"new{i}", profile_completed=True)
+            user.avatar = make_image(user, category="avatars")
+            user.save()
+        self.assertEqual(count_queries(), baseline)
+
+    def test_requires_login(self):
+        self.client.logout()
+        self.assertEqual(self.get().status_code, 302)
+
+
+class IndexShellTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/", secure=True)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_render_does_not_depend_on_catalog_or_users(self):
+        self.client.force_login(self.user)
+        baseline, response = self.count_queries()
+        self.assertNotIn('trees', response.context)
+        self.assertNotIn('users', response.context)
+        for i in range(20):
+            other = CustomUser.objects.create(username=f"user{i}", profile_completed=True)
+            make_tree(other, 38.03 + i / 1000, -78.48)
+        queries, response = self.count_queries()
+        self.assertEqual(queries, baseline)
+        self.assertNotContains(response, "user7")
+
+    def test_anonymous_visitors_get_the_shell(self):
+        make_tree(self.user, 38.03, -78.48, description="Hidden in the shell")
+        _, response = self.count_queries()
+        self.assertNotContains(response, "Hidden in the shell")
+
+
+class TreeExportTests(TestCase):
+    url = "/api/trees/export/"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True,
+                                                  nickname="Treebeard")
+        cls.other = CustomUser.objects.create_user(username="walker", password="x", profile_completed=True)
+        cls.oak = make_tree(cls.user, 38.03, -78.48, species="Oak", description='Big, "old" oak', height=20.0)
+        cls.elm = make_tree(cls.other, 38.05, -78.50, species="Elm", is_flagged=True)
+        cls.ash = make_tree(cls.other, 40.0, -75.0, species="Ash")
+        make_tree(cls.user, 38.03, -78.48, species="Oak", is_deleted=True)
+        for tree, submitted_at in ((cls.oak, (2024, 5, 1, 12)), (cls.elm, (2024, 6, 15, 8)), (cls.ash, (2024, 7, 1, 12))):
+            TreeSubmission.objects.filter(id=tree.id).update(
+                submitted_at=datetime(*submitted_at, tzinfo=dt_timezone.utc)
+            )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def export(self, **params):
+        response = self.client.get(self.url, params, secure=True)
+        if response.status_code != 200:
+            return response, None
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode('utf-8')
+
+    def exported_ids(self, **params):
+        response, body = self.export(format='ndjson', **params)
+        self.assertEqual(response.status_code, 200, body)
+        return [json.loads(line)['id'] for line in body.splitlines()]
+
+    def test_csv_is_streamed(self):
+        response, body = self.export()
+        self.assertEqual(response['Content-Type'], "text/csv")
+        self.assertIn('filename="charlottesville_trees.csv"', response['Content-Disposition'])
+        rows = list(csv.reader(StringIO(body)))
+        self.assertEqual(rows[0], ["ID", "Species", "Description", "Latitude", "Longitude", "Submitted By", "Date"])
+        self.assertEqual(
+            rows[1], [str(self.oak.id), "Oak", 'Big, "old" oak', "38.03", "-78.48", "Treebeard", "2024-05-01 12:00:00"]
+        )
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.oak.id), str(self.elm.id), str(self.ash.id)])
+        self.assertEqual(rows[2][5], "walker")
+
+    def test_queries_do_not_grow_with_rows(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                self.export()
+            return len(queries)
+
+        baseline = count_queries()
+        for i in range(30):
+            make_tree(self.other if i % 2 else self.user, 38.0 + i / 1000, -78.48)
+        self.assertEqual(count_queries(), baseline)
+
+    def test_requires_login(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url, secure=True).status_code, 302)
+
+    def test_geojson_is_streamed(self):
+        response, body = self.export(format='geojson')
+        self.assertEqual(response['Content-Type'], "application/geo+json")
+        self.assertIn('filename="charlottesville_trees.geojson"', response['Content-Disposition'])
+        data = json.loads(body)
+        self.assertEqual(data['type'], "FeatureCollection")
+        oak = data['features'][0]
+        self.assertEqual((oak['id'], oak['geometry']), (self.oak.id, {'type': 'Point', 'coordinates': [-78.48, 38.03]}))
+        self.assertEqual(oak['properties']['submitted_by'], "Treebeard")
+        self.assertEqual(oak['properties']['height'], 20.0)
+        self.assertEqual(oak['properties']['submitted_at'], "2024-05-01T12:00:00+00:00")
+        self.assertEqual(len(data['features']), 3)
+
+        TreeSubmission.objects.all().delete()
+        self.assertEqual(json.loads(self.export(format='GeoJSON')[1])['features'], [])
+
+    def test_ndjson_is_streamed(self):
+        response, body = self.export(format='ndjson')
+        self.assertEqual(response['Content-Type'], "application/x-ndjson")
+        records = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([record['id'] for record in records], [self.oak.id, self.elm.id, self.ash.id])
+        elm = records[1]
+        self.assertEqual((elm['latitude'], elm['longitude'], elm['is_flagged']), (38.05, -78.5, True))
+
+    def test_filters(self):
+        oak, elm, ash = self.oak.id, self.elm.id, self.ash.id
+        for params, expected in (
+            ({'bbox': "-78.6,38.0,-78.4,38.1"}, [oak, elm]),
+            ({'species': "Elm"}, [elm]),
+            ({'species': ["Elm", "Ash"]}, [elm, ash]),
+            ({'start': "2024-06-01"}, [elm, ash]),
+            ({'end': "2024-06-15"}, [oak, elm]),
+            ({'end': "2024-06-15T08:00:00Z"}, [oak, elm]),
+            ({'end': "2024-06-15T07:59:59Z"}, [oak]),
+            ({'start': "2024-05-02", 'end': "2024-06-30"}, [elm]),
+            ({'submitter': "walker"}, [elm, ash]),
+            ({'submitter': "nobody"}, []),
+            ({'flagged': "true"}, [elm]),
+            ({'flagged': "0"}, [oak, ash]),
+            ({'bbox': "-80,37,-70,41", 'species': "Oak", 'flagged': "false", 'submitter': "mapper"}, [oak]),
+        ):
+            with self.subTest(params=params):
+                self.assertEqual(self.exported_ids(**params), expected)
+
+    def test_bad_filters(self):
+        for params in (
+            {'format': "xlsx"},
+            {'bbox': "1,2,3"},
+            {'bbox': "-79,39,-78,38"},
+            {'end': "2024-06-15T25:00"},
+            {'start': "yesterday"},
+            {'end': "2024-13-01"},
+            {'flagged': "maybe"},
+        ):
+            with self.subTest(params=params):
+                response, _ = self.export(**params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("error", response.json())
+
+
+class ExportJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+        for i in range(20):
+            make_tree(cls.user, 38.03 + i / 1000, -78.48, species="Oak" if i % 2 else "Elm")
+
+    def setUp(self):
+        export_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_root)
+        patcher = mock.patch.object(ExportJob._meta.get_field('file'), 'storage', FileSystemStorage(location=export_root))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def params(self, **params):
+        return MultiValueDict({name: [value] for name, value in params.items()})
+
+    def test_identical_requests_share_a_job(self):
+        job, created = request_export('csv', self.params(species="Oak"), self.user)
+        same, created_again = request_export('csv', self.params(species="Oak"), self.user)
+        other, _ = request_export('csv', self.params(species="Elm"), self.user)
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(same.id, job.id)
+        self.assertNotEqual(other.id, job.id)
+
+    def test_rejects_unknown_format_and_bad_filters(self):
+        with self.assertRaises(ValueError):
+            request_export('xlsx', self.params(), self.user)
+        with self.assertRaises(ValueError):
+            request_export('csv', self.params(bbox="1,2"), self.user)
+
+    def test_failed_job_is_requeued(self):
+        job, _ = request_export('csv', self.params(), self.user)
+        ExportJob.objects.filter(id=job.id).update(status='failed', error="disk full")
+        job, _ = request_export('csv', self.params(), self.user)
+        self.assertEqual((job.status, job.error), ('pending', ''))
+
+    @override_settings(EXPORT_JOB_TIMEOUT=600)
+    def test_stale_running_job_is_requeued(self):
+        job, _ = request_export('csv', self.params(), self.user)
+        self.assertEqual(claim_next_job().id, job.id)
+        # A live worker's job stays put
+        self.assertIsNone(claim_next_job())
+        self.assertEqual(request_export('csv', self.params(), self.user)[0].status, 'running')
+
+        # ...until it has been running for longer than the timeout
+        ExportJob.objects.filter(id=job.id).update(started_at=timezone.now() - timedelta(seconds=601))
+        job, _ = request_export('csv', self.params(), self.user)
+        self.assertEqual((job.status, job.started_at), ('pending', None))
+
+        ExportJob.objects.filter(id=job.id).update(status='running', started_at=timezone.now() - timedelta(hours=1))
+        reclaimed = claim_next_job()
+        self.assertEqual(reclaimed.id, job.id)
+        self.assertEqual(reclaimed.status, 'running')
+        self.assertGreater(reclaimed.started_at, timezone.now() - timedelta(seconds=60))
+
+    def test_run_job_and_download_ranges(self):
+        job, _ = request_export('csv', self.params(), self.user)
+        job = run_export_job(claim_next_job())
+        self.assertEqual(job.status, 'done')
+        with job.file.open('rb') as f:
+            content = f.read()
+        self.assertEqual(len(content), job.size)
+        self.assertEqual(content.count(b"\n"), 21)
+
+        self.client.force_login(self.user)
+        url = f"/api/trees/export/jobs/{job.id}/download/"
+        etag = f'"{job.key}"'
+
+        def download(**headers):
+            response = self.client.get(url, secure=True, headers=headers)
+            return response, b''.join(response.streaming_content) if response.streaming else response.content
+
+        response, body = download()
+        self.assertEqual((response.status_code, body), (200, content))
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        response, body = download(Range="bytes=10-19")
+        self.assertEqual((response.status_code, body), (206, content[10:20]))
+        self.assertEqual(response['Content-Range'], f"bytes 10-19/{job.size}")
+        self.assertEqual(response['Content-Length'], "10")
+
+        response, body = download(Range="bytes=100-")
+        self.assertEqual((response.status_code, body), (206, content[100:]))
+
+        response, body = download(Range="bytes=-7")
+        self.assertEqual((response.status_code, body), (206, content[-7:]))
+
+        response, body = download(Range="bytes=10-19", **{'If-Range': etag})
+        self.assertEqual((response.status_code, body), (206, content[10:20]))
+
+        # A changed artifact invalidates the client's partial copy: send the whole file
+        response, body = download(Range="bytes=10-19", **{'If-Range': '"stale"'})
+        self.assertEqual((response.status_code, body), (200, content))
+
+        response, _ = download(Range=f"bytes={job.size}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f"bytes */{job.size}")
+
+    @override_settings(EXPORT_JOB_RETENTION=7 * 24 * 3600, EXPORT_SUPERSEDED_RETENTION=3600)
+    def test_expired_and_superseded_jobs_are_deleted(self):
+        request_export('csv', self.params(), self.user)
+        first = run_export_job(claim_next_job())
+        request_export('csv', self.params(species="Oak"), self.user)
+        oaks = run_export_job(claim_next_job())
+        # An edit changes the catalog stamp, so the same request now needs a new artifact
+        make_tree(self.user, 38.1, -78.48)
+        second, created = request_export('csv', self.params(), self.user)
+        self.assertTrue(created)
+        second = run_export_job(claim_next_job())
+        queued, _ = request_export('geojson', self.params(), self.user)
+        storage = ExportJob._meta.get_field('file').storage
+
+        self.assertEqual(delete_expired_jobs(), 0)
+        # Downloads of the replaced file get EXPORT_SUPERSEDED_RETENTION to finish
+        self.assertEqual(delete_expired_jobs(timezone.now() + timedelta(hours=2)), 1)
+        self.assertFalse(ExportJob.objects.filter(id=first.id).exists())
+        self.assertFalse(storage.exists(first.file.name))
+        self.assertTrue(storage.exists(second.file.name))
+
+        self.assertEqual(delete_expired_jobs(timezone.now() + timedelta(days=8)), 2)
+        self.assertEqual(list(ExportJob.objects.all()), [queued])
+        self.assertFalse(storage.exists(oaks.file.name))
+
+    @override_settings(EXPORT_SUPERSEDED_RETENTION=0)
+    def test_failed_jobs_are_replaced_too(self):
+        failed, _ = request_export('csv', self.params(), self.user)
+        ExportJob.objects.filter(id=failed.id).update(status='failed', finished_at=timezone.now())
+        make_tree(self.user, 38.1, -78.48)
+        request_export('csv', self.params(), self.user)
+        # Nothing replaces a failed job until a newer one is done
+        self.assertEqual(delete_expired_jobs(), 0)
+        run_export_job(claim_next_job())
+        self.assertEqual(delete_expired_jobs(timezone.now() + timedelta(seconds=1)), 1)
+        self.assertFalse(ExportJob.objects.filter(id=failed.id).exists())
+
+    @override_settings(EXPORT_JOB_RETENTION=0)
+    def test_job_is_kept_when_its_file_cannot_be_deleted(self):
+        request_export('csv', self.params(), self.user)
+        job = run_export_job(claim_next_job())
+        storage = ExportJob._meta.get_field('file').storage
+        with mock.patch.object(storage, 'delete', side_effect=OSError("read-only")), \
+                self.assertLogs('home.export_jobs', 'ERROR'):
+            self.assertEqual(delete_expired_jobs(timezone.now() + timedelta(seconds=1)), 0)
+        self.assertTrue(ExportJob.objects.filter(id=job.id).exists())
+
+    @override_settings(EXPORT_JOB_RETENTION=0)
+    def test_worker_sweeps_expired_jobs_when_idle(self):
+        request_export('csv', self.params(), self.user)
+        out = StringIO()
+        call_command('run_export_jobs', '--once', stdout=out)
+        self.assertIn("done", out.getvalue())
+        self.assertIn("Deleted 1 expired export jobs", out.getvalue())
+        self.assertFalse(ExportJob.objects.exists())
+
+    def test_creating_a_job_requires_a_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        response = client.post("/api/trees/export/jobs/", {'format': 'csv'}, secure=True)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(ExportJob.objects.exists())
+
+    def test_download_before_the_job_is_done(self):
+        job, _ = request_export('csv', self.params(), self.user)
+        self.client.force_login(self.user)
+        response = self.client.get(f"/api/trees/export/jobs/{job.id}/download/", secure=True)
+        self.assertEqual(response.status_code, 409)
+
+
+class RangeHeaderTests(SimpleTestCase):
+    def test_parse_range_header(self):
+        self.assertEqual(parse_range_header("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(parse_range_header("bytes=500-", 1000), (500, 999))
+        self.assertEqual(parse_range_header("bytes=900-5000", 1000), (900, 999))
+        self.assertEqual(parse_range_header("bytes=-100", 1000), (900, 999))
+        self.assertEqual(parse_range_header("bytes=-5000", 1000), (0, 999))
+
+    def test_unsupported_ranges_are_ignored(self):
+        for header in [None, "", "items=0-1", "bytes=0-1,5-6", "bytes=a-b", "bytes=-"]:
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range_header(header, 1000))
+
+    def test_unsatisfiable_ranges(self):
+        for header in ["bytes=1000-", "bytes=5-2", "bytes=2000-3000"]:
+            with self.subTest(header=header), self.assertRaises(ValueError):
+                parse_range_header(header, 1000)
+
+
+class BulkTreeImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="surveyor", password="x", profile_completed=True)
+
+    def post(self, body, content_type, client=None, **extra):
+        client = client or self.client
+        client.force_login(self.user)
+        return client.post("/api/trees/bulk/", data=body, content_type=content_type, secure=True, **extra)
+
+    def test_csv(self):
+        body = (
+            "Latitude,Longitude,Species,Height,Description\n"
+            "38.03,-78.48,red_maple,12.5,By the gate\n"
+            "\n"
+            "95,-78.48,Oak,,\n"
+            "38.04,-78.49,Oak,tall,\n"
+            "38.05,-78.50,Oak,,\n"
+        )
+        response = self.post(body, 'text/csv')
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual((data['created'], data['failed'], data['truncated']), (2, 2, False))
+        self.assertEqual(
+            [(error['row'], sorted(error['errors'])) for error in data['errors']],
+            [(3, ['latitude']), (4, ['height'])],
+        )
+        tree = TreeSubmission.objects.get(latitude=38.03)
+        self.assertEqual(
+            (tree.species, tree.height, tree.description, tree.user), ("Red Maple", 12.5, "By the gate", self.user)
+        )
+        self.assertEqual(TreeSubmission.objects.filter(grid_cell__isnull=False).count(), 2)
+
+    def test_ndjson(self):
+        body = "\n".join([
+            json.dumps({"latitude": 38.03, "longitude": -78.48, "species": "Oak", "diameter": 0.4}),
+            "{not json",
+            "[1, 2]",
+            json.dumps({"latitude": 38.03, "longitude": -78.48}),
+            "",
+            json.dumps({"latitude": "38.04", "longitude": "-78.49", "species": "Elm", "extra": "ignored"}),
+        ])
+        response = self.post(body, 'application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual((data['created'], data['failed']), (2, 3))
+        self.assertEqual(
+            data['errors'],
+            [
+                {'row': 2, 'errors': {'__all__': ['Invalid JSON']}},
+                {'row': 3, 'errors': {'__all__': ['Each line must be a JSON object']}},
+                {'row': 4, 'errors': {'species': ['Please select a tree species from the dropdown.']}},
+            ],
+        )
+        self.assertEqual(sorted(TreeSubmission.objects.values_list('species', flat=True)), ["Elm", "Oak"])
+
+    def test_only_invalid_rows(self):
+        response = self.post("latitude,longitude,species\nx,y,Oak\n", 'text/csv')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['created'], 0)
+        self.assertFalse(TreeSubmission.objects.exists())
+
+    def test_non_finite_numbers_are_rejected(self):
+        for value in ("nan", "inf", "-Infinity", float("nan")):
+            _, errors = clean_tree_row({"latitude": 38.03, "longitude": -78.48, "species": "Oak", "height": value,
+                                        "diameter": value})
+            self.assertEqual(errors, {"height": ["Enter a number."], "diameter": ["Enter a number."]})
+        _, errors = clean_tree_row({"latitude": "nan", "longitude": "inf", "species": "Oak"})
+        self.assertEqual(sorted(errors), ["latitude", "longitude"])
+        # JSON's NaN literal parses to a float, so it has to be caught after parsing too
+        body = '{"latitude": 38.03, "longitude": -78.48, "species": "Oak", "height": NaN}'
+        response = self.post(body, 'application/x-ndjson')
+        self.assertEqual(response.json()['failed'], 1)
+        self.assertFalse(TreeSubmission.objects.exists())
+
+    def test_row_cap(self):
+        body = "latitude,longitude,species\n" + "".join(f"38.0{i},-78.48,Oak\n" for i in range(5))
+        with mock.patch('home.views.BULK_MAX_ROWS', 3):
+            data = self.post(body, 'text/csv').json()
+        self.assertEqual((data['created'], data['truncated']), (3, True))
+        self.assertEqual(TreeSubmission.objects.count(), 3)
+
+    def test_unknown_format(self):
+        self.assertEqual(self.post("", 'text/csv', QUERY_STRING="format=xml").status_code, 400)
+
+    def test_each_batch_is_inserted_all_or_nothing(self):
+        def fail_second_batch(importer, batch):
+            if importer.created:
+                raise RuntimeError("disk full")
+
+        importer = BulkTreeImporter(self.user, batch_size=2, on_flush=fail_second_batch)
+        rows = [{"latitude": 38.03 + i / 1000, "longitude": -78.48, "species": "Oak"} for i in range(4)]
+        with self.assertRaises(RuntimeError):
+            for number, row in enumerate(rows, start=1):
+                importer.add(number, row)
+        self.assertEqual(importer.created, 2)
+        self.assertEqual(sorted(TreeSubmission.objects.values_list('latitude', flat=True)), [38.03, 38.031])
+
+    def test_requires_csrf_token_and_login(self):
+        body = "latitude,longitude,species\n38.03,-78.48,Oak\n"
+        client = Client(enforce_csrf_checks=True)
+        self.assertEqual(self.post(body, 'text/csv', client=client).status_code, 403)
+        token = "a" * 32
+        client.cookies['csrftoken'] = token
+        self.assertEqual(self.post(body, 'text/csv', client=client, HTTP_X_CSRFTOKEN=token,
+                                   HTTP_REFERER="https://testserver/").status_code, 201)
+
+        self.client.logout()
+        response = self.client.post("/api/trees/bulk/", data=body, content_type='text/csv', secure=True)
+        self.assertEqual(response.status_code, 302)
+
+
+def feature(longitude, latitude, **properties):
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [longitude, latitude]},
+            "properties": properties}
+
+
+class GeoJSONStreamTests(SimpleTestCase):
+    def test_features_spanning_chunks(self):
+        features = [
+            feature(-78.48, 38.03, species="Oak", description='tricky "features": [1, 2], {}'),
+            feature(-78.49, 38.04, species="Elm", tags={"nested": [1, {"deep": None}]}),
+            feature(-78.5, 38.05, species="Ash"),
+        ]
+        document = json.dumps({"type": "FeatureCollection", "name": "survey", "features": features}, indent=2)
+        for chunk_size in (1, 7, 64, 1 << 16):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(list(iter_geojson_features(StringIO(document), chunk_size=chunk_size)), features)
+
+    def test_empty_collection(self):
+        self.assertEqual(list(iter_geojson_features(StringIO('{"features": [ ]}'), chunk_size=3)), [])
+
+    def test_malformed_documents(self):
+        features = json.dumps([feature(-78.48, 38.03), feature(-78.49, 38.04)])
+        for document in ('{"type": "FeatureCollection"}', '{"features": ' + features[:-30], '{"features": [{"a": }]}'):
+            with self.subTest(document=document), self.assertRaises(ValueError):
+                list(iter_geojson_features(StringIO(document), chunk_size=5))
+
+
+class ImportTreesCommandTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="surveyor", password="x", profile_completed=True)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "survey.csv")
+        with open(self.path, "w") as f:
+            f.write("latitude,longitude,species\n")
+            for i in range(5):
+                f.write(f"38.0{i},-78.48,Oak\n")
+            f.write("north,-78.48,Oak\n")
+
+    def import_trees(self, *args, path=None):
+        out = StringIO()
+        call_command('import_trees', path or self.path, '--user=surveyor', '--batch-size=2', *args,
+                     stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_resumes_after_an_interrupted_run(self):
+        def interrupted(lines):
+            for number, row, error in iter_csv_rows(lines):
+                if number == 5:
+                    raise KeyboardInterrupt
+                yield number, row, error
+
+        iter_csv_rows = import_trees.iter_csv_rows
+        with mock.patch.object(import_trees, 'iter_csv_rows', interrupted), self.assertRaises(KeyboardInterrupt):
+            self.import_trees()
+        checkpoint = ImportCheckpoint.objects.get()
+        self.assertEqual((checkpoint.rows_done, checkpoint.created, checkpoint.finished), (4, 4, False))
+        self.assertEqual(TreeSubmission.objects.count(), 4)
+
+        output = self.import_trees()
+        self.assertIn("Resuming after row 4", output)
+        self.assertEqual(
+            sorted(TreeSubmission.objects.values_list('latitude', flat=True)), [38.0, 38.01, 38.02, 38.03, 38.04]
+        )
+        checkpoint.refresh_from_db()
+        self.assertEqual((checkpoint.rows_done, checkpoint.created, checkpoint.failed, checkpoint.finished),
+                         (6, 5, 1, True))
+
+    def test_skips_finished_files(self):
+        self.import_trees()
+        self.assertEqual(TreeSubmission.objects.count(), 5)
+        self.assertIn("already imported (5 trees)", self.import_trees())
+        self.assertEqual(TreeSubmission.objects.count(), 5)
+
+        self.import_trees('--restart')
+        self.assertEqual(TreeSubmission.objects.count(), 10)
+        self.assertEqual(ImportCheckpoint.objects.get().created, 5)
+
+    def test_an_edited_file_is_imported_again(self):
+        self.import_trees()
+        with open(self.path, "a") as f:
+            f.write("38.09,-78.48,Elm\n")
+        self.import_trees()
+        self.assertEqual(TreeSubmission.objects.count(), 11)
+        self.assertEqual(ImportCheckpoint.objects.count(), 2)
+
+    def test_geojson_file(self):
+        path = os.path.join(os.path.dirname(self.path), "survey.geojson")
+        features = [feature(-78.48, 38.03 + i / 100, species="Elm", height=i + 1) for i in range(3)]
+        features.append({"type": "Feature", "geometry": {"type": "LineString", "coordinates": []}})
+        with open(path, "w") as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+        self.import_trees(path=path)
+        self.assertEqual(sorted(TreeSubmission.objects.values_list('height', flat=True)), [1.0, 2.0, 3.0])
+        checkpoint = ImportCheckpoint.objects.get()
+        self.assertEqual((checkpoint.created, checkpoint.failed, checkpoint.finished), (3, 1, True))
+
+
+class NearbyTreesTests(TestCase):
+    origin = (38.03, -78.48)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+        rng = random.Random(11)
+        lat, lon = cls.origin
+        points = [(lat + rng.uniform(-0.003, 0.003), lon + rng.uniform(-0.003, 0.003)) for _ in range(60)]
+        # A sparse outer scatter, so wide searches read many empty rings
+        points += [(lat + rng.uniform(-0.1, 0.1), lon + rng.uniform(-0.1, 0.1)) for _ in range(40)]
+        TreeSubmission.objects.bulk_create([
+            TreeSubmission(user=cls.user, species="Oak", latitude=point_lat, longitude=point_lon,
+                           grid_cell=grid_cell(point_lat, point_lon))
+            for point_lat, point_lon in points
+        ])
+        cls.deleted = make_tree(cls.user, lat, lon, is_deleted=True)
+
+    def brute_force(self, lat, lon, k, radius_m):
+        distances = [
+            (haversine_m(lat, lon, tree_lat, tree_lon), tree_id)
+            for tree_id, tree_lat, tree_lon in TreeSubmission.objects.filter(is_deleted=False)
+            .values_list('id', 'latitude', 'longitude')
+        ]
+        return sorted(item for item in distances if item[0] <= radius_m)[:k]
+
+    def assertMatchesBruteForce(self, lat, lon, k, radius_m):
+        found = nearest_tree_ids(lat, lon, k, radius_m)
+        expected = self.brute_force(lat, lon, k, radius_m)
+        self.assertEqual([tree_id for _, tree_id in found], [tree_id for _, tree_id in expected])
+        for (distance, _), (expected_distance, _) in zip(found, expected):
+            self.assertAlmostEqual(distance, expected_distance, places=6)
+
+    def test_matches_brute_force(self):
+        lat, lon = self.origin
+        for k, radius_m in ((1, 1000), (10, 50), (10, 300), (25, 1000), (100, 5000), (100, 20000)):
+            with self.subTest(k=k, radius_m=radius_m):
+                self.assertMatchesBruteForce(lat, lon, k, radius_m)
+        # From an empty spot away from the dense patch
+        self.assertMatchesBruteForce(lat + 0.05, lon - 0.05, 5, 10000)
+
+    def test_ring_search_and_bbox_fallback_agree(self):
+        lat, lon = self.origin
+        for limit in (8, 10 ** 9):
+            with self.subTest(max_ring_cells=limit), mock.patch('home.nearby.MAX_RING_CELLS', limit):
+                self.assertMatchesBruteForce(lat, lon, 10, 3000)
+                self.assertMatchesBruteForce(lat, lon, 100, 15000)
+
+    def test_fallback_box_crosses_the_antimeridian(self):
+        east = make_tree(self.user, 0.0, 179.9995)
+        west = make_tree(self.user, 0.0, -179.9995)
+        with mock.patch('home.nearby.MAX_RING_CELLS', 8):
+            found = nearest_tree_ids(0.0, 179.9999, 5, 1000)
+        self.assertEqual([tree_id for _, tree_id in found], [east.id, west.id])
+        self.assertEqual([tree_id for _, tree_id in nearest_tree_ids(0.0, 179.9999, 5, 1000)], [east.id, west.id])
+
+    def test_haversine_batch(self):
+        lat, lon = self.origin
+        points = [(lat, lon), (lat + 0.01, lon), (-33.87, 151.21), (lat, lon + 180)]
+        for distance, (other_lat, other_lon) in zip(haversine_batch(lat, lon, points), points):
+            self.assertAlmostEqual(distance, haversine_m(lat, lon, other_lat, other_lon), places=6)
+        self.assertAlmostEqual(haversine_batch(lat, lon, points[1:2])[0], 1111.95, places=1)
+        self.assertEqual(haversine_batch(lat, lon, []), [])
+
+    def test_endpoint(self):
+        lat, lon = self.origin
+        response = self.client.get("/api/trees/nearby/", {'lat': lat, 'lon': lon, 'k': 3, 'radius_m': 500}, secure=True)
+        self.assertEqual(response.status_code, 200)
+        trees = response.json()['trees']
+        expected = self.brute_force(lat, lon, 3, 500)
+        self.assertEqual([tree['id'] for tree in trees], [tree_id for _, tree_id in expected])
+        self.assertEqual([tree['distance_m'] for tree in trees], [round(distance, 1) for distance, _ in expected])
+        self.assertEqual(trees[0]['species'], "Oak")
+
+    def test_parameter_validation(self):
+        for params in (
+            {},
+            {'lat': 38.03},
+            {'lat': 'north', 'lon': -78.48},
+            {'lat': 91, 'lon': -78.48},
+            {'lat': 38.03, 'lon': 180.5},
+            {'lat': 'nan', 'lon': -78.48},
+            {'lat': 38.03, 'lon': -78.48, 'k': 0},
+            {'lat': 38.03, 'lon': -78.48, 'k': 101},
+            {'lat': 38.03, 'lon': -78.48, 'k': 2.5},
+            {'lat': 38.03, 'lon': -78.48, 'radius_m': 0},
+            {'lat': 38.03, 'lon': -78.48, 'radius_m': 50001},
+            {'lat': 38.03, 'lon': -78.48, 'radius_m': 'inf'},
+        ):
+            with self.subTest(params=params):
+                response = self.client.get("/api/trees/nearby/", params, secure=True)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("error", response.json())
+
+
+class TreeSnapshotTests(TestCase):
+    url = "/api/trees/snapshot.geojson"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+        cls.tree = make_tree(cls.user, 38.03, -78.48)
+        make_tree(cls.user, 38.04, -78.49, species="Elm")
+
+    def setUp(self):
+        cache.clear()
+        self.now = timezone.now().replace(microsecond=250000)
+        patcher = mock.patch('home.snapshots.timezone.now', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, **headers):
+        return self.client.get(self.url, secure=True, headers=headers)
+
+    def test_full_response(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "application/geo+json")
+        self.assertNotIn('Content-Encoding', response)
+        self.assertIn("Accept-Encoding", response['Vary'])
+        self.assertEqual(response['Last-Modified'], http_date(self.now.replace(microsecond=0).timestamp()))
+        data = json.loads(response.content)
+        self.assertEqual(sorted(f['properties']['species'] for f in data['features']), ["Elm", "Oak"])
+
+    def test_if_none_match(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(**{'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(self.get(**{'If-None-Match': '*'}).status_code, 304)
+        # When both are sent the entity tag decides, however recent If-Modified-Since is
+        response = self.get(**{'If-None-Match': '"stale"', 'If-Modified-Since': http_date(self.now.timestamp() + 60)})
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_modified_since(self):
+        last_modified = self.get()['Last-Modified']
+        self.assertEqual(self.get(**{'If-Modified-Since': last_modified}).status_code, 304)
+
+        # An edit within the same second still moves Last-Modified on
+        self.now += timedelta(milliseconds=500)
+        TreeSubmission.objects.filter(id=self.tree.id).update(species="Ash")
+        snapshots.mark_snapshot_stale()
+        response = self.get(**{'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(parse_http_date(response['Last-Modified']), parse_http_date(last_modified))
+        self.assertIn(b'"Ash"', response.content)
+
+    def test_rebuild_without_changes_keeps_the_validators(self):
+        first = self.get()
+        self.now += timedelta(minutes=5)
+        snapshots.mark_snapshot_stale()
+        second = self.get()
+        self.assertEqual((second['ETag'], second['Last-Modified']), (first['ETag'], first['Last-Modified']))
+        self.assertEqual(self.get(**{'If-Modified-Since': first['Last-Modified']}).status_code, 304)
+
+    def test_encoding_negotiation(self):
+        identity = self.get().content
+        etag = self.get()['ETag'].strip('"')
+
+        response = self.get(**{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual((response['Content-Encoding'], response['ETag']), ('gzip', f'"{etag}-gzip"'))
+        self.assertEqual(gzip.decompress(response.content), identity)
+        self.assertEqual(self.get(**{'If-None-Match': f'"{etag}-gzip"'}).status_code, 304)
+
+        for accept in ('gzip;q=0, identity', 'compress', ''):
+            with self.subTest(accept=accept):
+                response = self.get(**{'Accept-Encoding': accept})
+                self.assertNotIn('Content-Encoding', response)
+                self.assertEqual(response.content, identity)
+
+    @skipIf(snapshots.brotli is None, "brotli is not installed")
+    def test_brotli_is_preferred(self):
+        identity = self.get().content
+        for accept in ('gzip, deflate, br', '*'):
+            with self.subTest(accept=accept):
+                response = self.get(**{'Accept-Encoding': accept})
+                self.assertEqual(response['Content-Encoding'], 'br')
+                self.assertEqual(snapshots.brotli.decompress(response.content), identity)
+        self.assertEqual(self.get(**{'Accept-Encoding': 'gzip, br;q=0'})['Content-Encoding'], 'gzip')
+
+
+@override_settings(IMAGE_STORAGE='memory', TREE_DUPLICATE_RADIUS_M=5.0)
+class DuplicateTreeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+
+    def setUp(self):
+        self.existing = make_tree(self.user, 38.03, -78.48, species="Oak")
+
+    def new_tree(self, latitude=38.03002, longitude=-78.48, species="Oak", **fields):
+        return TreeSubmission(user=self.user, species=species, latitude=latitude, longitude=longitude, **fields)
+
+    def test_find_duplicate(self):
+        # About 2m north
+        self.assertEqual(find_duplicate("Oak", 38.03002, -78.48), self.existing)
+        self.assertIsNone(find_duplicate("Elm", 38.03002, -78.48))
+        # About 11m north
+        self.assertIsNone(find_duplicate("Oak", 38.0301, -78.48))
+        self.assertIsNone(find_duplicate("Oak", 38.03, -78.48, exclude_id=self.existing.id))
+
+    def test_warn_saves_the_tree_and_reports_the_match(self):
+        tree, duplicate = save_tree(self.new_tree(), action='warn')
+        self.assertIsNotNone(tree.pk)
+        self.assertNotEqual(tree.pk, self.existing.pk)
+        self.assertEqual(duplicate, self.existing)
+
+    def test_off_skips_the_check(self):
+        tree, duplicate = save_tree(self.new_tree(), action='off')
+        self.assertIsNotNone(tree.pk)
+        self.assertIsNone(duplicate)
+
+    def test_merge_fills_in_missing_attributes(self):
+        image = make_image(self.user)
+        tree, duplicate = save_tree(self.new_tree(height=12.5, description="Old oak", image=image), action='merge')
+        self.assertEqual((tree, duplicate), (self.existing, self.existing))
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.height, self.existing.description), (12.5, "Old oak"))
+        self.assertEqual(self.existing.image, image)
+        self.assertEqual(TreeSubmission.objects.count(), 1)
+
+    def test_merge_deletes_the_image_the_existing_tree_does_not_take(self):
+        kept = make_image(self.user)
+        self.existing.image = kept
+        self.existing.save()
+        dropped = make_image(self.user)
+        save_tree(self.new_tree(image=dropped), action='merge')
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.image, kept)
+        self.assertFalse(CustomImage.objects.filter(id=dropped.id).exists())
+
+    def test_merge_keeps_an_image_used_elsewhere(self):
+        self.existing.image = make_image(self.user)
+        self.existing.save()
+        avatar = make_image(self.user, category="avatars")
+        self.user.avatar = avatar
+        self.user.save()
+        save_tree(self.new_tree(image=avatar), action='merge')
+        self.assertTrue(CustomImage.objects.filter(id=avatar.id).exists())
+
+    def test_find_duplicate_clusters(self):
+        second = make_tree(self.user, 38.03002, -78.48)
+        third = make_tree(self.user, 38.03004, -78.48)
+        make_tree(self.user, 38.03002, -78.48, species="Elm")
+        make_tree(self.user, 38.04, -78.48)
+        self.assertEqual(find_duplicate_clusters(), [[self.existing.id, second.id, third.id]])
+
+    def test_find_duplicate_clusters_does_not_chain(self):
+        # Ten street trees about 4m apart in a line: each is within the radius of its neighbours only
+        row = [make_tree(self.user, 38.05 + i * 0.000036, -78.48) for i in range(10)]
+        clusters = find_duplicate_clusters(radius_m=5)
+        self.assertEqual(clusters, [[row[i].id, row[i + 1].id] for i in range(0, 10, 2)])
+        for ids in clusters:
+            first, second = TreeSubmission.objects.filter(id__in=ids).order_by('id')
+            self.assertLessEqual(haversine_m(first.latitude, first.longitude, second.latitude, second.longitude), 5)
+
+    def test_merge_cluster_keeps_the_oldest_tree_and_cleans_up_images(self):
+        adopted = make_image(self.user)
+        dropped = make_image(self.user)
+        second = make_tree(self.user, 38.03002, -78.48, image=adopted, height=20.0)
+        third = make_tree(self.user, 38.03004, -78.48, image=dropped, description="Twin trunk")
+
+        keeper = merge_duplicate_cluster([self.existing.id, second.id, third.id])
+        self.assertEqual(keeper.id, self.existing.id)
+        keeper.refresh_from_db()
+        self.assertEqual((keeper.image, keeper.height, keeper.description), (adopted, 20.0, "Twin trunk"))
+
+        for tree in (second, third):
+            tree.refresh_from_db()
+            self.assertTrue(tree.is_deleted)
+            self.assertIsNone(tree.image)
+        self.assertTrue(CustomImage.objects.filter(id=adopted.id).exists())
+        self.assertFalse(CustomImage.objects.filter(id=dropped.id).exists())
+
+
+def decode_packed(data):
+    """(meta, [(id, lat, lon, species, flags)]) of a packed tree buffer"""
+    assert data[:4] == PACKED_MAGIC
+    count, meta_length = struct.unpack_from('<II', data, 4)
+    offset = 12
+    meta = json.loads(data[offset:offset + meta_length])
+    offset += meta_length
+    columns = []
+    for typecode in 'IffH':
+        column = array(typecode)
+        column.frombytes(data[offset:offset + count * column.itemsize])
+        # Columns are little-endian and 4-byte aligned
+        assert offset % 4 == 0
+        columns.append(column)
+        offset += count * column.itemsize
+    flags = list(data[offset:offset + count])
+    assert offset + count == len(data)
+    ids, lats, lons, codes = columns
+    return meta, [
+        (ids[i], lats[i], lons[i], meta['species'][codes[i]], flags[i]) for i in range(count)
+    ]
+
+
+@override_settings(IMAGE_STORAGE='memory')
+class PackedTreesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+        cls.plain = make_tree(cls.user, 38.03, -78.48, species="Oak")
+        cls.flagged = make_tree(cls.user, 38.04, -78.49, species="Elm", is_flagged=True, description="Dead limb")
+        cls.pictured = make_tree(cls.user, 38.05, -78.47, species="Oak", image=make_image(cls.user))
+        make_tree(cls.user, 38.06, -78.46, species="Ash", is_deleted=True)
+        make_tree(cls.user, 10.0, 10.0, species="Baobab")
+
+    def get_packed(self, **params):
+        return self.client.get("/api/trees/", {"format": "packed", **params}, secure=True)
+
+    def test_encodes_columns(self):
+        response = self.get_packed(bbox="-79,38,-78,39")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], PACKED_CONTENT_TYPE)
+        meta, rows = decode_packed(response.content)
+        self.assertEqual(meta['bbox'], [-79, 38, -78, 39])
+        self.assertEqual(meta['species'], ["Oak", "Elm"])
+        self.assertEqual([(tree_id, species, flags) for tree_id, _, _, species, flags in rows], [
+            (self.plain.id, "Oak", 0),
+            (self.flagged.id, "Elm", FLAG_FLAGGED | FLAG_HAS_DESCRIPTION),
+            (self.pictured.id, "Oak", FLAG_HAS_IMAGE),
+        ])
+        # float32 coordinates are good to about a meter
+        self.assertAlmostEqual(rows[1][1], 38.04, places=5)
+        self.assertAlmostEqual(rows[1][2], -78.49, places=5)
+
+    def test_without_bbox(self):
+        meta, rows = decode_packed(self.get_packed().content)
+        self.assertNotIn('bbox', meta)
+        self.assertEqual(len(rows), 4)
+
+    def test_empty_result(self):
+        meta, rows = decode_packed(self.get_packed(bbox="0,0,1,1").content)
+        self.assertEqual((meta['species'], rows), ([], []))
+
+    def test_too_many_species_is_a_client_error(self):
+        with mock.patch('home.packed.PACKED_MAX_SPECIES', 2):
+            response = self.get_packed()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("too many species", response.json()['error'])
+
+    def test_ids_beyond_uint32_are_a_client_error(self):
+        # Rather than wrapping around to some other tree's id
+        with mock.patch('home.packed.PACKED_MAX_ID', self.flagged.id - 1):
+            response = self.get_packed()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("use JSON", response.json()['error'])
+        self.assertEqual(len(decode_packed(self.get_packed().content)[1]), 4)
+
+
+@override_settings(IMAGE_STORAGE='memory', IMAGE_UPLOAD_MODE='sync')
+class ImageDerivativeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+
+    def setUp(self):
+        reset_image_storage()
+
+    def store(self, content):
+        with self.captureOnCommitCallbacks() as callbacks:
+            image = store_uploaded_image(ContentFile(content, name="bark.png"), self.user, "tree_images")
+        return image, callbacks
+
+    def test_derivatives_are_made_after_the_request(self):
+        storage = image_storage()
+        with mock.patch.object(type(storage), 'open', side_effect=AssertionError("read back in the request")):
+            image, callbacks = self.store(image_bytes(size=(300, 200)))
+        self.assertEqual((image.status, image.derivatives), ('ready', {}))
+        self.assertEqual(image.thumbnail_url, image.public_url)
+
+        executor = mock.Mock()
+        with mock.patch('home.uploads._get_executor', return_value=executor):
+            for callback in callbacks:
+                callback()
+        executor.submit.assert_called_once_with(_run_in_thread, generate_image_derivatives, image.pk)
+
+        generate_image_derivatives(image.pk)
+        image.refresh_from_db()
+        self.assertEqual(len(image.derivatives), 6)
+        with storage.open(image.derivatives["64.webp"]) as f, Image.open(f) as thumbnail:
+            self.assertEqual(thumbnail.size, (64, 43))
+        self.assertNotEqual(image.thumbnail_url, image.public_url)
+
+    def test_reused_copy_is_not_queued_again(self):
+        content = image_bytes(size=(300, 200))
+        first, _ = self.store(content)
+        generate_image_derivatives(first.pk)
+        second, callbacks = self.store(content)
+        self.assertEqual(callbacks, [])
+        first.refresh_from_db()
+        self.assertEqual(second.derivatives, first.derivatives)
+
+    @override_settings(IMAGE_UPLOAD_MODE='async')
+    def test_spooled_upload_derives_from_the_spool(self):
+        spool_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_root)
+        with override_settings(IMAGE_SPOOL_ROOT=spool_root):
+            image, _ = self.store(image_bytes(size=(300, 200)))
+        storage = image_storage()
+        with mock.patch.object(type(storage), 'open', side_effect=AssertionError("downloaded the stored file")):
+            image = finish_upload(image.pk)
+        self.assertEqual((image.status, len(image.derivatives)), ('ready', 6))
+
+
+@override_settings(IMAGE_STORAGE='memory', IMAGE_UPLOAD_MODE='async')
+class AsyncImageUploadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+
+    def setUp(self):
+        spool_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_root)
+        spool_settings = override_settings(IMAGE_SPOOL_ROOT=spool_root)
+        spool_settings.enable()
+        self.addCleanup(spool_settings.disable)
+        # A fresh in-memory bucket for each test
+        reset_image_storage()
+
+    def spool(self, content=None, name="bark.png"):
+        with self.captureOnCommitCallbacks() as callbacks:
+            image = store_uploaded_image(ContentFile(content or image_bytes(), name=name), self.user, "tree_images")
+        return image, callbacks
+
+    def test_upload_is_spooled_and_handed_to_a_worker(self):
+        image, callbacks = self.spool()
+        self.assertEqual(image.status, 'pending')
+        self.assertTrue(os.path.exists(image.spool_path))
+        self.assertFalse(image.image.storage.exists(image.image.name))
+        self.assertIsNone(image.public_url)
+        self.assertIsNone(image.thumbnail_url)
+
+        executor = mock.Mock()
+        with mock.patch('home.uploads._get_executor', return_value=executor):
+            for callback in callbacks:
+                callback()
+        executor.submit.assert_called_once_with(_run_in_thread, finish_upload, image.pk)
+
+    def test_worker_stores_the_file_and_marks_it_ready(self):
+        content = image_bytes()
+        image, _ = self.spool(content)
+        spool_path = image.spool_path
+
+        finished = finish_upload(image.pk)
+        self.assertEqual(finished.status, 'ready')
+        image.refresh_from_db()
+        self.assertEqual((image.status, image.spool_path), ('ready', ''))
+        self.assertFalse(os.path.exists(spool_path))
+        with image.image.open('rb') as stored:
+            self.assertEqual(stored.read(), content)
+        self.assertEqual(set(image.derivatives), {"64.webp", "64.jpeg", "256.webp", "256.jpeg", "1024.webp", "1024.jpeg"})
+        self.assertIsNotNone(image.public_url)
+
+        # Only one worker gets to upload it
+        self.assertIsNone(finish_upload(image.pk))
+
+    def test_failed_upload_is_retried(self):
+        image, _ = self.spool()
+        with mock.patch.object(LazyImageStorage, 'save', side_effect=OSError("bucket unavailable")):
+            with self.assertLogs('home.uploads', 'ERROR'):
+                self.assertEqual(finish_upload(image.pk).status, 'failed')
+        image.refresh_from_db()
+        self.assertEqual(image.status, 'failed')
+        self.assertTrue(os.path.exists(image.spool_path))
+
+        # Without --retry-failed the sweep leaves failed uploads alone
+        call_command('process_image_uploads', stdout=StringIO())
+        image.refresh_from_db()
+        self.assertEqual(image.status, 'failed')
+
+        out = StringIO()
+        call_command('process_image_uploads', retry_failed=True, stdout=out)
+        self.assertIn("Uploaded 1 images, 0 failed", out.getvalue())
+        image.refresh_from_db()
+        self.assertEqual((image.status, image.spool_path), ('ready', ''))
+        self.assertTrue(image.image.storage.exists(image.image.name))
+
+    def test_identical_upload_reuses_the_stored_copy(self):
+        content = image_bytes()
+        first, _ = self.spool(content)
+        finish_upload(first.pk)
+        first.refresh_from_db()
+
+        second, callbacks = self.spool(content, name="same.png")
+        self.assertEqual(second.status, 'ready')
+        self.assertEqual(second.image.name, first.image.name)
+        self.assertEqual(second.derivatives, first.derivatives)
+        self.assertEqual(callbacks, [])
+        self.assertEqual(os.listdir(settings.IMAGE_SPOOL_ROOT), [])
+
+
+def animation_bytes(image_format, frames=3, size=(300, 200), **save_args):
+    images = [Image.new('RGB', size, (80 * i, 40, 200 - 60 * i)) for i in range(frames)]
+    buffer = BytesIO()
+    images[0].save(buffer, image_format, save_all=True, append_images=images[1:], **save_args)
+    return buffer.getvalue()
+
+
+@override_settings(IMAGE_MAX_DIMENSION=100, IMAGE_UPLOAD_QUALITY=85)
+class NormalizeUploadTests(SimpleTestCase):
+    def normalize(self, content, name="photo.jpg"):
+        normalized = normalize_upload(ContentFile(content, name=name))
+        return normalized, Image.open(BytesIO(normalized.read()))
+
+    def test_photo_is_rotated_downscaled_and_stripped(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise
+        exif[0x010F] = "Camera maker"
+        normalized, image = self.normalize(image_bytes((400, 200), image_format='JPEG', exif=exif.tobytes()))
+        self.assertEqual(normalized.name, "photo.jpg")
+        self.assertEqual(image.format, 'JPEG')
+        self.assertEqual(image.size, (50, 100))
+        self.assertEqual(normalized.image_size, (50, 100))
+        self.assertNotIn('exif', image.info)
+
+    def test_transparent_image_stays_png(self):
+        normalized, image = self.normalize(image_bytes((50, 50), (0, 0, 0, 0), mode='RGBA'), name="icon.png")
+        self.assertEqual((normalized.name, image.format, image.mode), ("icon.png", 'PNG', 'RGBA'))
+
+    def test_rgb_profile_is_kept(self):
+        srgb = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        _, image = self.normalize(image_bytes(image_format='JPEG', icc_profile=srgb))
+        self.assertEqual(image.info.get('icc_profile'), srgb)
+
+    def test_profile_is_dropped_when_the_colour_mode_changes(self):
+        # The profile no longer describes the pixels once CMYK has become RGB
+        profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        content = image_bytes(color=(0, 100, 200, 0), image_format='JPEG', mode='CMYK', icc_profile=profile)
+        _, image = self.normalize(content)
+        self.assertEqual(image.mode, 'RGB')
+        self.assertNotIn('icc_profile', image.info)
+
+    def test_greyscale_becomes_rgb(self):
+        grey = Image.new('L', (20, 20), 128)
+        buffer = BytesIO()
+        grey.save(buffer, 'PNG')
+        _, image = self.normalize(buffer.getvalue(), name="grey.png")
+        self.assertEqual((image.mode, image.getpixel((0, 0))), ('RGB', (128, 128, 128)))
+
+    def test_animated_gif_keeps_every_frame_without_metadata(self):
+        content = animation_bytes('GIF', duration=[100, 200, 300], loop=0, comment=b"shot on my phone")
+        normalized, image = self.normalize(content, name="wave.gif")
+        self.assertEqual((normalized.name, image.format), ("wave.gif", 'GIF'))
+        self.assertEqual((image.n_frames, image.size, normalized.image_size), (3, (100, 67), (100, 67)))
+        self.assertNotIn('comment', image.info)
+        self.assertEqual(image.info['loop'], 0)
+        durations = []
+        for frame in range(image.n_frames):
+            image.seek(frame)
+            durations.append(image.info['duration'])
+        self.assertEqual(durations, [100, 200, 300])
+
+    def test_animated_webp_drops_exif(self):
+        exif = Image.Exif()
+        exif[0x8825] = {0x0002: (38.0, 1.0, 48.0)}  # GPS latitude
+        content = animation_bytes('WEBP', duration=120, exif=exif.tobytes())
+        self.assertIn('exif', Image.open(BytesIO(content)).info)
+        normalized, image = self.normalize(content, name="wave.webp")
+        self.assertEqual((normalized.name, image.format, image.n_frames), ("wave.webp", 'WEBP', 3))
+        self.assertNotIn('exif', image.info)
+
+
+class CountingStorage:
+    """Minimal storage that counts url() calls"""
+
+    def __init__(self, querystring_auth=False):
+        self.querystring_auth = querystring_auth
+        self.calls = 0
+
+    def url(self, name):
+        self.calls += 1
+        return f"https://bucket.example/{name}?sig={self.calls}" if self.querystring_auth else f"https://bucket.example/{name}"
+
+
+@override_settings(IMAGE_URL_CACHE_SIZE=2)
+class ImageUrlTests(SimpleTestCase):
+    def setUp(self):
+        clear_url_cache()
+        self.addCleanup(clear_url_cache)
+
+    def test_unsigned_urls_are_memoized(self):
+        storage = CountingStorage()
+        self.assertEqual(storage_url(storage, "a.jpg"), "https://bucket.example/a.jpg")
+        storage_url(storage, "a.jpg")
+        self.assertEqual(storage.calls, 1)
+
+    def test_least_recently_used_url_is_evicted(self):
+        storage = CountingStorage()
+        for name in ["a.jpg", "b.jpg", "a.jpg", "c.jpg"]:
+            storage_url(storage, name)
+        self.assertEqual(storage.calls, 3)
+        storage_url(storage, "a.jpg")
+        self.assertEqual(storage.calls, 3)
+        storage_url(storage, "b.jpg")
+        self.assertEqual(storage.calls, 4)
+
+    def test_signed_urls_are_not_memoized(self):
+        storage = CountingStorage(querystring_auth=True)
+        self.assertNotEqual(storage_url(storage, "a.jpg"), storage_url(storage, "a.jpg"))
+        self.assertEqual(storage.calls, 2)
+
+    @override_settings(IMAGE_URL_CACHE_SIZE=0)
+    def test_cache_can_be_disabled(self):
+        storage = CountingStorage()
+        storage_url(storage, "a.jpg")
+        storage_url(storage, "a.jpg")
+        self.assertEqual(storage.calls, 2)
+
+
+@override_settings(IMAGE_STORAGE='memory', IMAGE_STORE_URLS=True)
+class StoredImageUrlTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+
+    def setUp(self):
+        reset_image_storage()
+
+    def sign_urls(self):
+        backend = image_storage().backend
+        backend.querystring_auth = True
+        self.addCleanup(delattr, backend, 'querystring_auth')
+
+    def test_url_is_stored_on_save(self):
+        image = make_image(self.user)
+        self.assertEqual(image.image.name, "tree_images/leaf.png")
+        self.assertEqual(image.stored_url, "/media/tree_images/leaf.png")
+        # Stored once, not again by the model's own save
+        _, files = image.image.storage.listdir("tree_images")
+        self.assertEqual([name for name in files if name.endswith(".png")], ["leaf.png"])
+        self.assertEqual(CustomImage.objects.get(id=image.id).public_url, image.stored_url)
+
+    def test_signed_urls_are_not_stored(self):
+        self.sign_urls()
+        image = make_image(self.user)
+        self.assertEqual(CustomImage.objects.get(id=image.id).stored_url, "")
+
+    def test_stored_url_is_ignored_once_urls_are_signed(self):
+        image = make_image(self.user)
+        CustomImage.objects.filter(id=image.id).update(stored_url="https://stale.example/leaf.png")
+        self.sign_urls()
+        image = CustomImage.objects.get(id=image.id)
+        with mock.patch.object(LazyImageStorage, 'url', return_value="https://signed.example/leaf.png?sig=1"):
+            self.assertEqual(image.public_url, "https://signed.example/leaf.png?sig=1")
+
+
+@skipIf(mock_aws is None, "moto is not installed")
+@override_settings(IMAGE_STORAGE='s3', IMAGE_DIRECT_UPLOADS=True, IMAGE_DIRECT_UPLOAD_MAX_BYTES=50 * 1024,
+                   IMAGE_DIRECT_UPLOAD_EXPIRES=600, IMAGE_MAX_DIMENSION=100)
+class DirectUploadTests(TestCase):
+    """Direct-to-bucket uploads against a moto S3 bucket"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+        cls.other = CustomUser.objects.create_user(username="other", password="x", profile_completed=True)
+
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        reset_image_storage()
+        self.addCleanup(reset_image_storage)
+        self.storage = image_storage()
+        self.bucket = self.storage.bucket
+        self.bucket.create()
+
+    def staged_name(self, ticket):
+        return signing.loads(ticket['ticket'], salt=TICKET_SALT)['name']
+
+    def upload(self, content, content_type='image/jpeg', user=None, size=None):
+        """Request a ticket and POST the file to the bucket the way direct-upload.js does; returns the ticket"""
+        size = len(content) if size is None else size
+        ticket = create_upload_ticket(user or self.user, 'tree_images', content_type, size)
+        response = requests.post(ticket['url'], data=ticket['fields'], files={'file': ('upload', content)})
+        self.assertEqual(response.status_code, 204)
+        return ticket
+
+    def confirm(self, ticket, user=None):
+        """confirm_upload without running the queued worker; returns (image, on-commit callbacks)"""
+        with self.captureOnCommitCallbacks() as callbacks:
+            image = confirm_upload(user or self.user, ticket['ticket'])
+        return image, callbacks
+
+    def staged_exists(self, ticket):
+        return self.storage.exists(self.staged_name(ticket))
+
+    def test_ticket_pins_the_upload(self):
+        ticket = create_upload_ticket(self.user, 'avatars', 'image/png', 1234)
+        name = self.staged_name(ticket)
+        self.assertRegex(name, rf"^uploads/{self.user.pk}/[0-9a-f]{{32}}\.png$")
+        self.assertEqual(ticket['fields']['key'], name)
+        self.assertEqual(ticket['fields']['Content-Type'], 'image/png')
+        policy = json.loads(base64.b64decode(ticket['fields']['policy']))
+        self.assertIn(['content-length-range', 1, 50 * 1024], policy['conditions'])
+        self.assertIn({'Content-Type': 'image/png'}, policy['conditions'])
+        self.assertEqual(signing.loads(ticket['ticket'], salt=TICKET_SALT),
+                         {'name': name, 'user': self.user.pk, 'category': 'avatars'})
+
+    def test_ticket_requests_are_validated(self):
+        for category, content_type, size in [("banners", 'image/png', 10), ("avatars", 'image/tiff', 10),
+                                             ("avatars", 'image/png', 0), ("avatars", 'image/png', 50 * 1024 + 1)]:
+            with self.subTest(category=category, content_type=content_type, size=size):
+                with self.assertRaises(DirectUploadError):
+                    create_upload_ticket(self.user, category, content_type, size)
+
+    def test_tampered_ticket_is_rejected(self):
+        ticket = self.upload(image_bytes(image_format='JPEG'))
+        forged = signing.dumps({'name': "uploads/1/forged.jpg", 'user': self.user.pk, 'category': 'avatars'})
+        for token in [ticket['ticket'][:-2] + "xx", forged]:
+            with self.subTest(token=token), self.assertRaisesMessage(DirectUploadError, "expired"):
+                confirm_upload(self.user, token)
+
+    def test_expired_ticket_is_rejected(self):
+        issued = timezone.now().timestamp() - 2 * 600 - 1
+        with mock.patch('time.time', return_value=issued):
+            ticket = create_upload_ticket(self.user, 'tree_images', 'image/jpeg', 100)
+        with self.assertRaisesMessage(DirectUploadError, "expired"):
+            confirm_upload(self.user, ticket['ticket'])
+
+    def test_someone_elses_ticket_is_rejected(self):
+        ticket = self.upload(image_bytes(image_format='JPEG'))
+        with self.assertRaisesMessage(DirectUploadError, "someone else"):
+            confirm_upload(self.other, ticket['ticket'])
+        # The owner can still confirm it
+        self.assertTrue(self.staged_exists(ticket))
+        self.assertEqual(self.confirm(ticket)[0].user, self.user)
+
+    def test_missing_upload_is_rejected(self):
+        ticket = create_upload_ticket(self.user, 'tree_images', 'image/jpeg', 100)
+        with self.assertRaisesMessage(DirectUploadError, "not been uploaded"):
+            confirm_upload(self.user, ticket['ticket'])
+
+    def test_oversized_upload_is_rejected_and_deleted(self):
+        # The bucket enforces the policy's size range; the HEAD check covers anything that slipped past it
+        ticket = self.upload(b"\x89PNG\r\n\x1a\n" + os.urandom(60 * 1024), content_type='image/png', size=1000)
+        with self.assertRaisesMessage(DirectUploadError, "too large"):
+            self.confirm(ticket)
+        self.assertFalse(self.staged_exists(ticket))
+        self.assertFalse(CustomImage.objects.exists())
+
+    def test_non_image_is_rejected_and_deleted(self):
+        ticket = self.upload(b"<html>not an image</html>")
+        with self.assertRaisesMessage(DirectUploadError, "JPEG, PNG, WebP or GIF"):
+            self.confirm(ticket)
+        self.assertFalse(self.staged_exists(ticket))
+
+    def test_confirm_does_not_download_the_upload(self):
+        ticket = self.upload(image_bytes(image_format='JPEG'))
+        with mock.patch.object(LazyImageStorage, 'open', side_effect=AssertionError("downloaded on the request")):
+            image, callbacks = self.confirm(ticket)
+        self.assertEqual((image.status, image.image.name), ('pending', self.staged_name(ticket)))
+        self.assertIsNone(image.public_url)
+        self.assertEqual(len(callbacks), 1)
+
+        with self.assertRaisesMessage(DirectUploadError, "already been confirmed"):
+            confirm_upload(self.user, ticket['ticket'])
+
+    def test_concurrent_confirmations_create_one_row(self):
+        ticket = self.upload(image_bytes(image_format='JPEG'))
+        self.confirm(ticket)
+        # The second request passed the exists() check before the first one committed
+        with mock.patch.object(QuerySet, 'exists', return_value=False), \
+                self.assertRaisesMessage(DirectUploadError, "already been confirmed"):
+            self.confirm(ticket)
+        self.assertEqual(CustomImage.objects.filter(image=self.staged_name(ticket)).count(), 1)
+        self.assertTrue(self.staged_exists(ticket))
+
+    def test_worker_normalizes_stores_and_deletes_the_staged_object(self):
+        exif = Image.Exif()
+        exif[0x010F] = "Camera maker"
+        ticket = self.upload(image_bytes((400, 200), image_format='JPEG', exif=exif.tobytes()))
+        image, _ = self.confirm(ticket)
+
+        finished = finish_direct_upload(image.pk)
+        self.assertEqual(finished.status, 'ready')
+        image.refresh_from_db()
+        self.assertEqual(image.status, 'ready')
+        self.assertRegex(image.image.name, r"^images/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$")
+        self.assertEqual((image.width, image.height), (100, 50))
+        self.assertEqual(len(image.derivatives), 6)
+        self.assertFalse(self.staged_exists(ticket))
+        with image.image.open('rb') as f:
+            stored = Image.open(BytesIO(f.read()))
+        self.assertEqual(stored.size, (100, 50))
+        self.assertNotIn('exif', stored.info)
+
+        self.assertEqual(claim_uploaded_image(image.pk, self.user, 'tree_images'), image)
+        self.assertIsNone(claim_uploaded_image(image.pk, self.other, 'tree_images'))
+        self.assertIsNone(claim_uploaded_image(image.pk, self.user, 'avatars'))
+        # Already done
+        self.assertIsNone(finish_direct_upload(image.pk))
+
+    def test_identical_uploads_share_one_stored_object(self):
+        content = image_bytes(image_format='JPEG')
+        first, _ = self.confirm(self.upload(content))
+        second, _ = self.confirm(self.upload(content))
+        finish_direct_upload(first.pk)
+        finish_direct_upload(second.pk)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(second.status, 'ready')
+        self.assertEqual(second.image.name, first.image.name)
+        self.assertEqual(second.derivatives, first.derivatives)
+        originals = [obj.key for obj in self.bucket.objects.filter(Prefix="images/") if obj.key.endswith(".jpg")
+                     and not any(obj.key.endswith(f"_{size}.jpg") for size in (64, 256, 1024))]
+        self.assertEqual(originals, [first.image.name])
+        self.assertEqual(list(self.bucket.objects.filter(Prefix="uploads/")), [])
+
+    def test_undecodable_upload_fails_in_the_worker_and_is_deleted(self):
+        # Right magic bytes, but no image behind them
+        ticket = self.upload(b"\xff\xd8\xff\xe0" + b"\x00" * 200)
+        image, _ = self.confirm(ticket)
+        with self.assertLogs('home.direct_uploads', 'ERROR'):
+            self.assertEqual(finish_direct_upload(image.pk).status, 'failed')
+        image.refresh_from_db()
+        self.assertEqual(image.status, 'failed')
+        self.assertFalse(self.staged_exists(ticket))
+
+    def test_sweep_finishes_pending_direct_uploads(self):
+        ticket = self.upload(image_bytes(image_format='JPEG'))
+        image, _ = self.confirm(ticket)
+        out = StringIO()
+        call_command('process_image_uploads', stdout=out)
+        self.assertIn("Uploaded 1 images", out.getvalue())
+        image.refresh_from_db()
+        self.assertEqual(image.status, 'ready')
+        self.assertFalse(self.staged_exists(ticket))
+
+    def test_endpoints(self):
+        self.client.force_login(self.user)
+        content = image_bytes(image_format='JPEG')
+        response = self.client.post("/api/images/uploads/", {'category': 'tree_images', 'content_type': 'image/jpeg',
+                                                             'size': len(content)},
+                                    content_type='application/json', secure=True)
+        self.assertEqual(response.status_code, 200)
+        ticket = response.json()
+        requests.post(ticket['url'], data=ticket['fields'], files={'file': ('upload', content)})
+
+        with self.captureOnCommitCallbacks():
+            response = self.client.post("/api/images/uploads/confirm/", {'ticket': ticket['ticket']},
+                                        content_type='application/json', secure=True)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['status'], 'pending')
+        self.assertTrue(CustomImage.objects.filter(id=response.json()['id'], user=self.user).exists())
+
+        response = self.client.post("/api/images/uploads/confirm/", {'ticket': "bogus"},
+                                    content_type='application/json', secure=True)
+        self.assertEqual(response.status_code, 400)
+
+        with override_settings(IMAGE_DIRECT_UPLOADS=False):
+            response = self.client.post("/api/images/uploads/", {}, content_type='application/json', secure=True)
+        self.assertEqual(response.status_code, 404)
+
+
+def stored_names(image):
+    return [image.image.name, *image.derivatives.values()]
+
+
+@override_settings(IMAGE_STORAGE='memory')
+class GarbageCollectImagesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+
+    def setUp(self):
+        reset_image_storage()
+        self.storage = image_storage()
+
+    def old_image(self, **fields):
+        image = make_image(self.user, **fields)
+        CustomImage.objects.filter(pk=image.pk).update(uploaded_at=timezone.now() - timedelta(days=2))
+        return image
+
+    def gc(self, *args):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('gc_images', '--grace-hours=1', *args, stdout=out)
+        return out.getvalue()
+
+    def test_referenced_images_are_kept(self):
+        on_tree = self.old_image()
+        make_tree(self.user, 38.03, -78.48, image=on_tree)
+        on_deleted_tree = self.old_image()
+        make_tree(self.user, 38.03, -78.48, image=on_deleted_tree, is_deleted=True)
+        avatar = self.old_image(category="avatars")
+        self.user.avatar = avatar
+        self.user.save()
+        attachment = self.old_image(category="message_attachments")
+        other = CustomUser.objects.create_user(username="other", password="x", profile_completed=True)
+        conversation = Conversation.objects.create()
+        conversation.participants.add(self.user, other)
+        Message.objects.create(conversation=conversation, sender=self.user, content="look", image_attachment=attachment)
+        garbage = self.old_image()
+
+        self.assertEqual(list(unreferenced_images()), [garbage])
+        self.gc('--grace-hours=0')
+        self.assertEqual(
+            set(CustomImage.objects.values_list('id', flat=True)),
+            {on_tree.id, on_deleted_tree.id, avatar.id, attachment.id},
+        )
+        for image in (on_tree, on_deleted_tree, avatar, attachment):
+            self.assertTrue(all(self.storage.exists(name) for name in stored_names(image)))
+        self.assertFalse(any(self.storage.exists(name) for name in stored_names(garbage)))
+
+    def test_recent_and_unfinished_rows_are_left_alone(self):
+        recent = make_image(self.user)
+        pending = self.old_image(status="pending")
+        failed = self.old_image(status="failed")
+        self.assertEqual(list(unreferenced_images(grace=timedelta(hours=1))), [failed])
+        self.gc()
+        self.assertEqual(CustomImage.objects.filter(id__in=[recent.id, pending.id]).count(), 2)
+        self.assertFalse(CustomImage.objects.filter(id=failed.id).exists())
+        # The grace window also covers files that don't have a row yet
+        self.assertTrue(all(self.storage.exists(name) for name in stored_names(recent)))
+
+    def test_shared_content_addressed_file_outlives_one_of_its_rows(self):
+        kept = self.old_image()
+        make_tree(self.user, 38.03, -78.48, image=kept)
+        copy = CustomImage.objects.create(
+            image=kept.image.name, user=self.user, category="tree_images", derivatives=kept.derivatives,
+        )
+        CustomImage.objects.filter(pk=copy.pk).update(uploaded_at=timezone.now() - timedelta(days=2))
+
+        self.gc('--grace-hours=0')
+        self.assertFalse(CustomImage.objects.filter(id=copy.id).exists())
+        self.assertTrue(all(self.storage.exists(name) for name in stored_names(kept)))
+
+    def test_deleting_a_row_keeps_a_file_another_row_shares(self):
+        kept = make_image(self.user)
+        copy = CustomImage.objects.create(image=kept.image.name, user=self.user, category="tree_images")
+        with self.captureOnCommitCallbacks(execute=True):
+            copy.delete()
+        self.assertTrue(self.storage.exists(kept.image.name))
+        with self.captureOnCommitCallbacks(execute=True):
+            kept.delete()
+        self.assertFalse(any(self.storage.exists(name) for name in stored_names(kept)))
+
+    def test_stray_files_are_deleted_after_the_grace_window(self):
+        stray = self.storage.save("images/ab/stray.png", ContentFile(b"not referenced"))
+        self.gc()
+        self.assertTrue(self.storage.exists(stray))
+        self.gc('--grace-hours=0')
+        self.assertFalse(self.storage.exists(stray))
+
+    def test_dry_run_deletes_nothing(self):
+        garbage = self.old_image()
+        stray = self.storage.save("images/ab/stray.png", ContentFile(b"not referenced"))
+        output = self.gc('--grace-hours=0', '--dry-run')
+        self.assertIn("1 unreferenced image rows", output)
+        self.assertIn(stray, output)
+        self.assertIn("Dry run, nothing deleted", output)
+        self.assertTrue(CustomImage.objects.filter(id=garbage.id).exists())
+        self.assertTrue(all(self.storage.exists(name) for name in [stray, *stored_names(garbage)]))
+
+
+@skipIf(mock_aws is None, "moto is not installed")
+@override_settings(IMAGE_STORAGE='s3')
+class GarbageCollectBucketTests(TestCase):
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        reset_image_storage()
+        self.addCleanup(reset_image_storage)
+        self.storage = image_storage()
+        self.storage.bucket.create()
+
+    def test_orphans_are_deleted_in_batches(self):
+        names = [self.storage.save(f"images/{i:02x}/stray.png", ContentFile(b"x")) for i in range(5)]
+        kept = self.storage.save("images/ff/kept.png", ContentFile(b"x"))
+        user = CustomUser.objects.create_user(username="mapper", password="x", profile_completed=True)
+        image = CustomImage.objects.bulk_create([CustomImage(image=kept, category="tree_images")])[0]
+        make_tree(user, 38.03, -78.48, image=image)
+
+        bucket = self.storage.bucket
+        with mock.patch('home.orphans.DELETE_BATCH_SIZE', 2), \
+                mock.patch.object(bucket, 'delete_objects', wraps=bucket.delete_objects) as delete_objects:
+            call_command('gc_images', '--grace-hours=0', stdout=StringIO())
+        self.assertEqual([len(c.kwargs['Delete']['Objects']) for c in delete_objects.call_args_list], [2, 2, 1])
+        self.assertFalse(any(self.storage.exists(name) for name in names))
+        self.assertTrue(self.storage.exists(kept))
+
+
+class ImageStorageTests(SimpleTestCase):
+    def tearDown(self):
+        reset_image_storage()
+
+    def test_migration_graph_loads_without_boto3(self):
+        # The historical migrations reference home.storage.image_storage; with a non-S3 backend nothing may pull
+        # in boto3. A fresh interpreter, since this test process may have imported it already.
+        script = (
+            "import sys, django\n"
+            "django.setup()\n"
+            "from django.db.migrations.loader import MigrationLoader\n"
+            "state = MigrationLoader(None, ignore_no_migrations=True).project_state()\n"
+            "field = state.apps.get_model('home', 'CustomImage')._meta.get_field('image')\n"
+            "field.storage.save('probe.txt', __import__('io').BytesIO(b'x'))\n"
+            "print(sorted(name for name in sys.modules if name.split('.')[0] in ('boto3', 'botocore')))\n"
+        )
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'a21.settings', 'IMAGE_STORAGE': 'memory'}
+        result = subprocess.run([sys.executable, "-c", script], cwd=settings.BASE_DIR, env=env,
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "[]")
+
+    @override_settings(IMAGE_STORAGE='memory', IMAGE_STORAGE_URL='/img/')
+    def test_memory_backend(self):
+        self.assertIsInstance(image_storage().backend, InMemoryStorage)
+        name = image_storage().save("a/b.txt", ContentFile(b"x"))
+        self.assertEqual(image_storage().url(name), "/img/a/b.txt")
+
+    def test_local_backend(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with override_settings(IMAGE_STORAGE='local', IMAGE_STORAGE_ROOT=root, IMAGE_STORAGE_URL='/media/'):
+            name = image_storage().save("avatars/me.txt", ContentFile(b"x"))
+            self.assertTrue(os.path.exists(os.path.join(root, "avatars", "me.txt")))
+            self.assertEqual(image_storage().url(name), "/media/avatars/me.txt")
+
+    def test_changing_the_setting_swaps_the_backend(self):
+        with override_settings(IMAGE_STORAGE='memory'):
+            first = image_storage().backend
+            with override_settings(IMAGE_STORAGE='django.core.files.storage.InMemoryStorage'):
+                self.assertIsNot(image_storage().backend, first)
+            self.assertIsNot(image_storage().backend, first)
+
+    @override_settings(IMAGE_STORAGE='ftp')
+    def test_unknown_backend(self):
+        with self.assertRaises(ImproperlyConfigured):
+            build_image_storage()
+
+
+def make_conversation(*users, **fields):
+    conversation = Conversation.objects.create(**fields)
+    conversation.participants.add(*users)
+    return conversation
+
+
+def send(conversation, sender, content="hi"):
+    return Message.objects.create(conversation=conversation, sender=sender, content=content)
+
+
+class ConversationTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = CustomUser.objects.create_user(username="alice", password="x", profile_completed=True)
+        cls.bob = CustomUser.objects.create_user(username="bob", password="x", profile_completed=True)
+        cls.carol = CustomUser.objects.create_user(username="carol", password="x", profile_completed=True)
+
+    def get(self, path, user=None):
+        self.client.force_login(user or self.alice)
+        return self.client.get(path, secure=True)
+
+
+class ConversationListTests(ConversationTestCase):
+    def test_lists_own_conversations_by_last_activity_with_unread_counts(self):
+        quiet = make_conversation(self.alice, self.bob)
+        busy = make_conversation(self.alice, self.carol)
+        group = make_conversation(self.alice, self.bob, self.carol, is_group=True, name="Arborists")
+        make_conversation(self.bob, self.carol)
+        send(quiet, self.bob)
+        send(group, self.alice)
+        send(group, self.bob)
+        send(busy, self.carol)
+        send(busy, self.carol)
+        send(busy, self.alice)
+
+        response = self.get("/messages/")
+        self.assertEqual(response.status_code, 200)
+        conversations = response.context['conversations']
+        self.assertEqual([c.id for c in conversations], [busy.id, group.id, quiet.id])
+        # Own messages never count as unread
+        self.assertEqual([c.unread_count for c in conversations], [2, 1, 1])
+        self.assertEqual(response.context['total_unread'], 4)
+
+    def test_conversation_without_messages_comes_last(self):
+        empty = make_conversation(self.alice, self.bob)
+        active = make_conversation(self.alice, self.carol)
+        send(active, self.carol)
+        response = self.get("/messages/")
+        self.assertEqual([c.id for c in response.context['conversations']], [active.id, empty.id])
+        self.assertEqual(response.context['conversations'][1].unread_count, 0)
+
+    def test_query_count_does_not_grow_with_conversations(self):
+        def count_queries():
+            self.client.force_login(self.alice)
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get("/messages/", secure=True)
+            return len(queries)
+
+        conversation = make_conversation(self.alice, self.bob)
+        send(conversation, self.bob)
+        baseline = count_queries()
+        for _ in range(10):
+            conversation = make_conversation(self.alice, self.bob, self.carol, is_group=True)
+            send(conversation, self.carol)
+        self.assertEqual(count_queries(), baseline)
+
+    def test_requires_login(self):
+        response = self.client.get("/messages/", secure=True)
+        self.assertEqual(response.status_code, 302)
+
+
+class ConversationDetailTests(ConversationTestCase):
+    def test_opening_marks_everything_read(self):
+        conversation = make_conversation(self.alice, self.bob)
+        send(conversation, self.bob)
+        newest = send(conversation, self.bob)
+        self.assertEqual(self.get("/messages/").context['total_unread'], 2)
+
+        response = self.get(f"/messages/{conversation.pk}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['messages']), 2)
+        membership = conversation.memberships.get(user=self.alice)
+        self.assertEqual(membership.last_read_message_id, newest.id)
+        self.assertEqual(self.get("/messages/").context['total_unread'], 0)
+        # Bob's watermark is untouched
+        self.assertEqual(conversation.memberships.get(user=self.bob).last_read_message_id, 0)
+
+    def test_non_member_is_forbidden(self):
+        conversation = make_conversation(self.alice, self.bob)
+        send(conversation, self.bob)
+        response = self.get(f"/messages/{conversation.pk}/", user=self.carol)
+        self.assertEqual(response.status_code, 403)
+
+    def test_query_count_does_not_grow_with_messages(self):
+        conversation = make_conversation(self.alice, self.bob, self.carol, is_group=True)
+
+        def count_queries():
+            self.client.force_login(self.alice)
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(f"/messages/{conversation.pk}/", secure=True)
+            return len(queries)
+
+        send(conversation, self.bob)
+        baseline = count_queries()
+        for sender in [self.bob, self.carol] * 5:
+            send(conversation, sender)
+        self.assertEqual(count_queries(), baseline)
+
+
+class ReadWatermarkTests(ConversationTestCase):
+    def test_unread_counts_only_others_messages_past_the_watermark(self):
+        conversation = make_conversation(self.alice, self.bob, self.carol, is_group=True)
+        read = send(conversation, self.bob)
+        send(conversation, self.alice)
+        send(conversation, self.bob)
+        send(conversation, self.carol)
+        ConversationMembership.objects.filter(conversation=conversation, user=self.alice).update(
+            last_read_message_id=read.id
+        )
+        response = self.get("/messages/")
+        self.assertEqual(response.context['conversations'][0].unread_count, 2)
+        self.assertEqual(response.context['total_unread'], 2)
+        self.assertEqual(response.context['unread_message_count'], 2)
+
+    def test_badge_sums_across_conversations(self):
+        send(make_conversation(self.alice, self.bob), self.bob)
+        send(make_conversation(self.alice, self.carol), self.carol)
+        send(make_conversation(self.bob, self.carol), self.carol)
+        self.assertEqual(self.get("/messages/").context['unread_message_count'], 2)
+        self.assertEqual(self.get("/messages/", user=self.carol).context['unread_message_count'], 0)
+
+    def test_own_messages_show_read_up_to_the_other_members_watermark(self):
+        conversation = make_conversation(self.alice, self.bob)
+        seen = send(conversation, self.alice, "seen")
+        send(conversation, self.alice, "not yet")
+        ConversationMembership.objects.filter(conversation=conversation, user=self.bob).update(
+            last_read_message_id=seen.id
+        )
+        response = self.get(f"/messages/{conversation.pk}/")
+        self.assertEqual(response.context['others_read_upto'], seen.id)
+        statuses = re.findall(r'message-read-status[^>]*>\s*(\w+)', response.content.decode())
+        self.assertEqual(statuses, ["Read", "Sent"])
+
+
+class ReadWatermarkMigrationTests(TransactionTestCase):
+    before = [("home", "0025_customimage_uploaded_at")]
+    after = [("home", "0026_conversationmembership")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_read_by_becomes_watermarks_and_back(self):
+        apps = self.migrate(self.before)
+        User = apps.get_model("home", "CustomUser")
+        Conversation = apps.get_model("home", "Conversation")
+        Message = apps.get_model("home", "Message")
+        alice = User.objects.create(username="alice")
+        bob = User.objects.create(username="bob")
+        conversation = Conversation.objects.create()
+        conversation.participants.add(alice, bob)
+        first = Message.objects.create(conversation=conversation, sender=bob, content="one")
+        second = Message.objects.create(conversation=conversation, sender=bob, content="two")
+        Message.objects.create(conversation=conversation, sender=alice, content="three")
+        first.read_by.add(alice)
+        second.read_by.add(alice)
+
+        apps = self.migrate(self.after)
+        Membership = apps.get_model("home", "ConversationMembership")
+        watermarks = dict(Membership.objects.values_list("user_id", "last_read_message_id"))
+        self.assertEqual(watermarks, {alice.id: second.id, bob.id: 0})
+
+        apps = self.migrate(self.before)
+        Message = apps.get_model("home", "Message")
+        self.assertEqual(
+            sorted(Message.objects.filter(read_by=alice.id).values_list("id", flat=True)), [first.id, second.id]
+        )
+        self.assertFalse(Message.objects.filter(read_by=bob.id).exists())
@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, transaction
+
+from .images import ensure_derivatives
+from .models import CustomImage, custom_image_path
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.IMAGE_UPLOAD_WORKERS, thread_name_prefix="image-upload")
+    return _executor
+
+
+def hash_upload(uploaded_file):
+    """SHA-256 hex digest of an uploaded file, read in chunks"""
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+
+def spool_upload(uploaded_file):
+    """Copy an uploaded file to the local spool directory chunk by chunk; returns (path, sha256 hex digest)"""
+    os.makedirs(settings.IMAGE_SPOOL_ROOT, exist_ok=True)
+    _, extension = os.path.splitext(uploaded_file.name)
+    path = os.path.join(settings.IMAGE_SPOOL_ROOT, f"{uuid.uuid4().hex}{extension.lower()}")
+    digest = hashlib.sha256()
+    with open(path, 'wb') as spooled:
+        for chunk in uploaded_file.chunks():
+            digest.update(chunk)
+            spooled.write(chunk)
+    return path, digest.hexdigest()
+
+
+def find_stored_copy(content_hash):
+    """
+    The ready image already holding these bytes, or None. Call it inside a transaction: the row stays locked
+    until commit, so a concurrent delete can't remove the shared file underneath a new reference to it.
+    """
+    return (
+        CustomImage.objects.select_for_update()
+        .filter(content_hash=content_hash, status='ready')
+        .exclude(image='')
+        .first()
+    )
+
+
+def _reuse_stored_copy(content_hash, user, category, private):
+    """
+    If these bytes are already stored, create a row pointing at the existing object (and its derivatives)
+    instead of uploading them again. Returns None when there is no stored copy.
+    """
+    with transaction.atomic():
+        existing = find_stored_copy(content_hash)
+        if existing is None:
+            return None
+        return CustomImage.objects.create(
+            image=existing.image.name,
+            derivatives=existing.derivatives,
+            width=existing.width,
+            height=existing.height,
+            content_hash=content_hash,
+            user=user,
+            category=category,
+            private=private,
+        )
+
+
+def store_uploaded_image(uploaded_file, user, category, private=False):
+    """
+    Create the CustomImage for an uploaded file, stored under a key derived from its SHA-256
+    so repeated uploads of the same bytes reuse one object. In "async" IMAGE_UPLOAD_MODE the file is
+    only spooled to local disk and the row starts out pending; a worker thread uploads it once the
+    transaction commits.
+    """
+    # Set by images.normalize_upload (the forms' clean step)
+    width, height = getattr(uploaded_file, 'image_size', (None, None))
+
+    if settings.IMAGE_UPLOAD_MODE != 'async':
+        content_hash = hash_upload(uploaded_file)
+        reused = _reuse_stored_copy(content_hash, user, category, private)
+        if reused is not None:
+            return reused
+        return CustomImage.objects.create(
+            image=uploaded_file, content_hash=content_hash, width=width, height=height,
+            user=user, category=category, private=private,
+        )
+
+    spool_path, content_hash = spool_upload(uploaded_file)
+    reused = _reuse_stored_copy(content_hash, user, category, private)
+    if reused is not None:
+        os.remove(spool_path)
+        return reused
+
+    image = CustomImage(
+        user=user, category=category, private=private, status='pending',
+        content_hash=content_hash, width=width, height=height,
+    )
+    image.spool_path = spool_path
+    # Record the intended storage name now; assigning a plain name doesn't upload anything
+    image.image.name = custom_image_path(image, os.path.basename(uploaded_file.name))
+    image.save()
+    queue_upload(finish_upload, image.pk)
+    return image
+
+
+def queue_upload(job, image_id):
+    """Run job(image_id) on a worker thread once the current transaction commits"""
+    transaction.on_commit(lambda: _get_executor().submit(_run_in_thread, job, image_id))
+
+
+def _run_in_thread(job, image_id):
+    try:
+        job(image_id)
+    finally:
+        # Worker threads get their own connection; don't leave it open between jobs
+        connection.close()
+
+
+def claim_upload(image_id):
+    """Move a pending image to uploading; False if another worker already has it"""
+    return CustomImage.objects.filter(id=image_id, status='pending').update(status='uploading') == 1
+
+
+def finish_upload(image_id):
+    """
+    Push a spooled image to the image field's storage and mark it ready.
+    Returns the image, or None when it was not pending here.
+    """
+    spool_path = CustomImage.objects.filter(id=image_id).values_list('spool_path', flat=True).first()
+    # The spool is local disk: leave images spooled on another machine to that machine's workers
+    if not spool_path or not os.path.exists(spool_path) or not claim_upload(image_id):
+        return None
+    image = CustomImage.objects.get(id=image_id)
+    try:
+        with open(spool_path, 'rb') as spooled:
+            name = image.image.storage.save(image.image.name, File(spooled))
+    except Exception:
+        logger.exception("Upload of image %s failed", image_id)
+        CustomImage.objects.filter(id=image_id).update(status='failed')
+        image.status = 'failed'
+        return image
+
+    image.image.name = name
+    image.status = 'ready'
+    image.spool_path = ''
+    image.save(update_fields=['image', 'status', 'spool_path'])
+    # From the spooled copy, before it goes, rather than downloading the file just stored
+    with open(spool_path, 'rb') as spooled:
+        ensure_derivatives(image, spooled)
+    try:
+        os.remove(spool_path)
+    except OSError:
+        pass
+    return image
+
+
+def generate_image_derivatives(image_id):
+    """Upload worker job for images stored inside the request (sync IMAGE_UPLOAD_MODE): create their derivatives"""
+    image = CustomImage.objects.filter(id=image_id, status='ready').exclude(image='').first()
+    if image is not None:
+        ensure_derivatives(image)
+    return image
@@ -12,14 +12,25 @@ urlpatterns = [
     path('messages/<int:pk>/', views.conversation_detail, name='conversation_detail'),
     path('messages/new/<int:user_id>/', views.create_conversation, name='create_conversation'),
     path('community/', views.community, name='community'),
+    path('api/users/', views.get_users, name='get_users'),
     path('create_group/', views.create_group_conversation, name='create_group_conversation'),
     path('messages/<int:pk>/leave/', views.leave_group, name='leave_group'),
     # path('submit-tree/', views.submit_tree, name='submit_tree'),
     path('moderate/', views.moderate_trees, name='moderate_trees'),
     path("api/trees/export/", views.export_trees_csv, name="export_trees_csv"),
+    path("api/trees/export/jobs/", views.create_export_job, name="create_export_job"),
+    path("api/trees/export/jobs/<int:job_id>/", views.export_job_status, name="export_job_status"),
+    path("api/trees/export/jobs/<int:job_id>/download/", views.download_export_job, name="download_export_job"),
     # path('submission-success/', views.feedback_success, name='submission_success'),
     path("api/trees/add/", views.add_tree, name="add_tree"),
+    path("api/trees/bulk/", views.bulk_add_trees, name="bulk_add_trees"),
     path("api/trees/", views.get_trees, name="get_trees"),
+    path("api/trees/clusters/", views.get_tree_clusters, name="get_tree_clusters"),
+    path("api/trees/nearby/", views.get_nearby_trees, name="get_nearby_trees"),
+    path("api/trees/snapshot.geojson", views.get_tree_snapshot, name="get_tree_snapshot"),
+    path("api/trees/changes/", views.get_tree_changes, name="get_tree_changes"),
+    path("api/trees/tiles/<int:z>/<int:x>/<int:y>.mvt", views.get_tree_tile, name="get_tree_tile"),
+    path("api/trees/<int:tree_id>/", views.get_tree, name="get_tree"),
     path("api/trees/<int:tree_id>/edit/", views.edit_tree, name="edit_tree"),
     path("api/trees/<int:tree_id>/delete/", views.delete_tree, name="delete_tree"),
     path("api/trees/<int:tree_id>/flag/", views.flag_tree, name="flag_tree"),
@@ -45,5 +56,7 @@ urlpatterns = [
     path('api/notifications/delete/', views.delete_notifications, name='delete_notifications'),
     path('manage-images/', views.manage_images, name='manage_images')
     ,
-    path('api/images/<int:image_id>/toggle/', views.image_toggle, name='image_toggle')
+    path('api/images/<int:image_id>/toggle/', views.image_toggle, name='image_toggle'),
+    path('api/images/uploads/', views.request_upload_ticket, name='request_upload_ticket'),
+    path('api/images/uploads/confirm/', views.confirm_direct_upload, name='confirm_direct_upload'),
 ]
\ No newline at end of file
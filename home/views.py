@@ -1,18 +1,34 @@
 from django.shortcuts import render, redirect, redirect, get_object_or_404
-import csv
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.files.storage import FileSystemStorage
 from .forms import ProfileForm, MessageForm, GroupConversationForm, SPECIES_CHOICES, CustomImagePrivacyForm, TreeForm 
 import os
 from django.contrib.auth.decorators import user_passes_test, login_required
-from .models import TreeSubmission, Conversation, Message, CustomUser, Notification, CustomImage
+from .models import TreeSubmission, Conversation, ConversationMembership, Message, CustomUser, Notification, CustomImage, ExportJob
+from .geo import parse_bbox, parse_zoom, snap_bbox_to_tiles, filter_bbox
+from .clusters import get_clusters, MAX_CLUSTER_ZOOM
+from .mvt import get_tree_tile as build_cached_tile, MAX_TILE_ZOOM, MIN_TILE_ZOOM, TILE_CONTENT_TYPE
+from .exports import EXPORT_FORMATS, EXPORT_WRITERS, export_rows, filter_export_trees
+from .export_jobs import request_export
+from .ingest import BulkTreeImporter, iter_csv_rows, iter_ndjson_rows
+from .dedupe import save_tree
+from .nearby import nearest_tree_ids, MAX_NEARBY_K, MAX_NEARBY_RADIUS_M
+from .packed import encode_packed_trees, PACKED_CONTENT_TYPE
+from .snapshots import get_snapshot_meta, get_snapshot_body, choose_encoding
+from .direct_uploads import DirectUploadError, create_upload_ticket, confirm_upload
+from django.utils.http import http_date, parse_http_date_safe
 from django import forms
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
 from django.db.models import Q # For searching
+from django.db.models import Count, F, Max, Prefetch
 from django.forms import modelformset_factory
+import csv
 import json
+from datetime import datetime, timedelta, timezone as dt_timezone
 from django.contrib import messages
 from django.urls import reverse
+from django.conf import settings
 
 def is_moderator(user):
     return user.is_authenticated and user.role == 'moderator'
@@ -26,12 +42,14 @@ def google_login_redirect(request):
 
 # Create your views here.
 def index(request):
+    """
+    Render the map shell only; trees load through the viewport APIs and users through /api/users/,
+    so the page costs the same however large the catalog gets.
+    """
     mapbox_token = os.getenv("MAPBOX_TOKEN")
-    all_users = []
     is_mod = False
 
     if request.user.is_authenticated:
-        all_users = CustomUser.objects.exclude(id=request.user.id)
         is_mod = request.user.role == 'moderator'
 
     form_has_errors = False
@@ -42,8 +60,10 @@ def index(request):
             print(form.data, form.files)
             tree = form.save(commit=False, user=request.user)
             tree.user = request.user
-            tree.save()
+            saved, duplicate = save_tree(tree)
             url = f"{reverse('index')}?tree_submitted=1"
+            if duplicate is not None:
+                url += "&duplicate=" + ("merged" if saved.pk == duplicate.pk else "nearby")
             return redirect(url)
         else:
             form_has_errors = True
@@ -52,16 +72,11 @@ def index(request):
     else:
         form = TreeForm()
 
-    # Trees to render on the map
-    trees = TreeSubmission.objects.filter(is_deleted=False)
-
     return render(request, 'home/index.html', {
-        'all_users': all_users,
         "MAPBOX_TOKEN": mapbox_token,
         'is_moderator': is_mod,
         'species_choices': SPECIES_CHOICES,
         'tree_form': form,
-        'trees': trees,
         'form_has_errors': form_has_errors,
     })
 
@@ -127,30 +142,30 @@ def profile(request):
 def account_settings(request):
     return render(request, 'home/account_settings.html')
 
+@login_required
 def conversation_list(request):
-    conversations = request.user.conversations.all()
-    
-    # Calculate unread counts for each conversation
-    conversations_with_unread = []
-    total_unread = 0
-    
-    for conversation in conversations:
-        # Count unread messages in this conversation
-        # Messages where user is NOT the sender AND user is NOT in read_by
-        unread_count = conversation.messages.exclude(
-            sender=request.user
-        ).exclude(
-            read_by=request.user
-        ).count()
-        
-        total_unread += unread_count
-        
-        # Add unread_count as an attribute to the conversation object
-        conversation.unread_count = unread_count
-        conversations_with_unread.append(conversation)
-    
+    """
+    The user's conversations, most recently active first, with unread counts. Built from one annotated query
+    plus one prefetch of the participants and their avatars, however many conversations there are.
+    """
+    conversations = list(
+        # Filtering before annotating makes the counts below use this same membership row
+        Conversation.objects.filter(memberships__user=request.user)
+        .annotate(
+            # Messages from others past the user's read watermark
+            unread_count=Count(
+                'messages',
+                filter=Q(messages__id__gt=F('memberships__last_read_message_id')) & ~Q(messages__sender=request.user),
+            ),
+            last_activity=Max('messages__timestamp'),
+        )
+        .prefetch_related(Prefetch('participants', queryset=CustomUser.objects.select_related('avatar')))
+        .order_by(F('last_activity').desc(nulls_last=True), '-id')
+    )
+    total_unread = sum(conversation.unread_count for conversation in conversations)
+
     return render(request, 'home/conversation_list.html', {
-        'conversations': conversations_with_unread,
+        'conversations': conversations,
         'total_unread': total_unread
     })
 
@@ -158,7 +173,8 @@ def conversation_list(request):
 def conversation_detail(request, pk):
     conversation = get_object_or_404(Conversation, pk=pk)
 
-    if request.user not in conversation.participants.all():
+    membership = ConversationMembership.objects.filter(conversation=conversation, user=request.user).first()
+    if membership is None:
         return HttpResponse("You are not authorized to view this conversation.", status=403)
 
     if request.method == 'POST':
@@ -172,15 +188,24 @@ def conversation_detail(request, pk):
     else:
         form = MessageForm()
 
-    messages = conversation.messages.all()
-    
-    # Mark all messages in this conversation as read by current user
-    for message in messages:
-        if request.user not in message.read_by.all():
-            message.read_by.add(request.user)
+    messages = list(conversation.messages.select_related('sender', 'image_attachment'))
+
+    # Mark everything shown as read by moving the user's watermark: one UPDATE, however long the thread
+    if messages:
+        from django.utils import timezone
+        newest_id = max(message.id for message in messages)
+        ConversationMembership.objects.filter(pk=membership.pk, last_read_message_id__lt=newest_id).update(
+            last_read_message_id=newest_id, last_read_at=timezone.now()
+        )
+    # The user's own messages up to here have been read by someone else
+    others_read_upto = conversation.memberships.exclude(user=request.user).aggregate(
+        upto=Max('last_read_message_id')
+    )['upto'] or 0
+
     return render(request, 'home/conversation_detail.html', {
         'conversation': conversation,
         'messages': messages,
+        'others_read_upto': others_read_upto,
         'form': form
     })
 
@@ -259,6 +284,43 @@ def community(request):
             user.conversant = user in conversants
     return render(request, 'home/community.html', {'other_users': other_users, "conversants": conversants})
 
+USERS_PAGE_SIZE = 50
+USERS_MAX_PAGE_SIZE = 100
+
+@login_required
+def get_users(request):
+    """
+    Paginated list of other users for pickers that load on demand:
+    ?page= (from 1), ?page_size= (up to 100) and an optional ?q= search on username/nickname.
+    """
+    try:
+        page_size = min(max(int(request.GET.get('page_size', USERS_PAGE_SIZE)), 1), USERS_MAX_PAGE_SIZE)
+        page_number = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        return JsonResponse({"error": "page and page_size must be integers"}, status=400)
+
+    users = CustomUser.objects.filter(is_active=True).exclude(id=request.user.id).select_related('avatar')
+    query = request.GET.get('q', '').strip()
+    if query:
+        users = users.filter(Q(username__icontains=query) | Q(nickname__icontains=query))
+
+    # Fetch one extra row to learn whether there is a next page without a COUNT(*)
+    offset = (page_number - 1) * page_size
+    rows = list(users.order_by('username', 'id')[offset:offset + page_size + 1])
+    return JsonResponse({
+        'users': [
+            {
+                'id': user.id,
+                'username': user.username,
+                'display_name': user.get_display_name(),
+                'avatar': user.avatar.thumbnail_url if user.avatar else None,
+            }
+            for user in rows[:page_size]
+        ],
+        'page': page_number,
+        'has_next': len(rows) > page_size,
+    })
+
 @login_required
 @csrf_exempt
 def add_tree(request):
@@ -278,15 +340,66 @@ def add_tree(request):
     if not all([species, latitude, longitude]):
         return JsonResponse({"error": "Missing required fields"}, status=400)
 
-    tree = TreeSubmission.objects.create(
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return JsonResponse({"error": "latitude and longitude must be numbers"}, status=400)
+
+    tree, duplicate = save_tree(TreeSubmission(
         user=request.user,
         species=species,
         latitude=latitude,
         longitude=longitude,
         description=description
-    )
+    ))
+
+    if duplicate is not None and duplicate.pk == tree.pk:
+        return JsonResponse({"success": True, "tree_id": tree.id, "merged": True}, status=200)
+    return JsonResponse({
+        "success": True,
+        "tree_id": tree.id,
+        "duplicate_of": duplicate.id if duplicate is not None else None,
+    }, status=201)
 
-    return JsonResponse({"success": True, "tree_id": tree.id}, status=201)
+BULK_MAX_ROWS = 100000
+
+@login_required
+def bulk_add_trees(request):
+    """
+    Import many trees in one request. The body is NDJSON (one object per line) or CSV with a header row,
+    chosen by ?format= or the Content-Type. Valid rows are inserted in batches; invalid ones are reported by row number.
+    Clients send the CSRF token in the X-CSRFToken header, as the map and direct-upload scripts do.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST required"}, status=405)
+
+    body_format = request.GET.get('format') or ('csv' if request.content_type == 'text/csv' else 'ndjson')
+    if body_format not in ('csv', 'ndjson'):
+        return JsonResponse({"error": "format must be csv or ndjson"}, status=400)
+
+    # Iterating the request reads the body line by line instead of buffering it all
+    rows = iter_csv_rows(request) if body_format == 'csv' else iter_ndjson_rows(request)
+    importer = BulkTreeImporter(request.user)
+    truncated = False
+    try:
+        for count, (number, row, error) in enumerate(rows, start=1):
+            if count > BULK_MAX_ROWS:
+                truncated = True
+                break
+            importer.add(number, row, error)
+        importer.flush()
+    except (UnicodeDecodeError, csv.Error) as e:
+        importer.flush()
+        return JsonResponse({"error": f"Could not parse body: {e}", "created": importer.created}, status=400)
+
+    status = 201 if importer.created else (400 if importer.failed else 200)
+    return JsonResponse({
+        "success": importer.created > 0,
+        "created": importer.created,
+        "failed": importer.failed,
+        "errors": importer.errors,
+        "truncated": truncated,
+    }, status=status)
 
 @user_passes_test(is_moderator)
 def moderate_trees(request):
@@ -294,26 +407,214 @@ def moderate_trees(request):
     flagged_trees = TreeSubmission.objects.filter(is_flagged=True, is_deleted=False)
     return render(request, 'archive/moderate_trees.html', {'submissions': flagged_trees})
 
+def tree_to_dict(tree):
+    """Map payload for a single tree (expects user and image to be select_related)"""
+    return {
+        'id': tree.id,
+        'species': tree.species,
+        'latitude': tree.latitude,
+        'longitude': tree.longitude,
+        'description': tree.description,
+        'height': tree.height,
+        'diameter': tree.diameter,
+        'image': tree.image.large_url if tree.image else None,
+        'is_flagged': tree.is_flagged,
+        'submitted_by': tree.user.get_display_name(),
+    }
+
 def get_trees(request):
-    """API endpoint to fetch all non-deleted trees for map display"""
+    """
+    API endpoint to fetch non-deleted trees for map display.
+    Optional ?bbox=minLon,minLat,maxLon,maxLat limits the result to the viewport,
+    and ?zoom= snaps that box out to whole map tiles.
+    ?format=packed returns the compact columnar binary encoding (see packed.py) instead of JSON.
+    """
+    packed = request.GET.get('format') == 'packed'
     trees = TreeSubmission.objects.filter(is_deleted=False)
-    trees_data = [
-        {
-            'id': tree.id,
-            'species': tree.species,
-            'latitude': tree.latitude,
-            'longitude': tree.longitude,
-            'description': tree.description,
-            'height': tree.height,
-            'diameter': tree.diameter,
-            'image': tree.image.public_url if tree.image else None,
-            'is_flagged': tree.is_flagged,
-            'submitted_by': tree.user.get_display_name(),
-        }
-        for tree in trees
-    ]
+    if not packed:
+        trees = trees.select_related('user', 'image')
+
+    bbox = None
+    if request.GET.get('bbox'):
+        try:
+            bbox = parse_bbox(request.GET['bbox'])
+            if request.GET.get('zoom'):
+                bbox = snap_bbox_to_tiles(bbox, parse_zoom(request.GET['zoom']))
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        trees = filter_bbox(trees, bbox)
+
+    if packed:
+        meta = {'bbox': bbox.as_list()} if bbox is not None else {}
+        try:
+            body = encode_packed_trees(trees, meta)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        return HttpResponse(body, content_type=PACKED_CONTENT_TYPE)
+
+    trees_data = [tree_to_dict(tree) for tree in trees]
+    if bbox is not None:
+        return JsonResponse({'trees': trees_data, 'bbox': bbox.as_list()})
     return JsonResponse({'trees': trees_data})
 
+def get_tree(request, tree_id):
+    """Details of one tree, for map popups that load them on demand"""
+    tree = get_object_or_404(TreeSubmission.objects.select_related('user', 'image'), id=tree_id, is_deleted=False)
+    return JsonResponse(tree_to_dict(tree))
+
+def get_nearby_trees(request):
+    """
+    API endpoint for the field survey: ?lat=&lon= with optional k (default 10) and radius_m (default 1000).
+    Returns the k closest trees within the radius, nearest first, each with its distance_m.
+    """
+    try:
+        lat = float(request.GET['lat'])
+        lon = float(request.GET['lon'])
+        k = int(request.GET.get('k', 10))
+        radius_m = float(request.GET.get('radius_m', 1000))
+    except KeyError:
+        return JsonResponse({"error": "lat and lon are required"}, status=400)
+    except ValueError:
+        return JsonResponse({"error": "lat, lon, k and radius_m must be numbers"}, status=400)
+
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return JsonResponse({"error": "lat must be between -90 and 90 and lon between -180 and 180"}, status=400)
+    if not 1 <= k <= MAX_NEARBY_K:
+        return JsonResponse({"error": f"k must be between 1 and {MAX_NEARBY_K}"}, status=400)
+    if not 0 < radius_m <= MAX_NEARBY_RADIUS_M:
+        return JsonResponse({"error": f"radius_m must be between 0 and {MAX_NEARBY_RADIUS_M}"}, status=400)
+
+    nearest = nearest_tree_ids(lat, lon, k, radius_m)
+    trees = TreeSubmission.objects.select_related('user', 'image').in_bulk([tree_id for _, tree_id in nearest])
+    results = []
+    for distance, tree_id in nearest:
+        tree_data = tree_to_dict(trees[tree_id])
+        tree_data['distance_m'] = round(distance, 1)
+        results.append(tree_data)
+    return JsonResponse({'trees': results})
+
+def get_tree_clusters(request):
+    """
+    API endpoint returning one cluster per grid cell for the zoomed-out map:
+    ?z=<zoom>&bbox=minLon,minLat,maxLon,maxLat
+    """
+    if not request.GET.get('z') or not request.GET.get('bbox'):
+        return JsonResponse({"error": "z and bbox are required"}, status=400)
+
+    try:
+        zoom = parse_zoom(request.GET['z'], max_zoom=MAX_CLUSTER_ZOOM)
+        bbox = parse_bbox(request.GET['bbox'])
+        clusters = get_clusters(zoom, bbox)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    return JsonResponse({'zoom': zoom, 'clusters': clusters})
+
+def get_tree_tile(request, z, x, y):
+    """
+    Mapbox Vector Tile of the trees in web-mercator tile z/x/y (layer "trees"), for zooms MIN_TILE_ZOOM
+    to MAX_TILE_ZOOM; style sources should set those as minzoom/maxzoom
+    """
+    if not MIN_TILE_ZOOM <= z <= MAX_TILE_ZOOM or x >= (1 << z) or y >= (1 << z):
+        return HttpResponse(status=404)
+
+    etag, data = build_cached_tile(z, x, y)
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(data, content_type=TILE_CONTENT_TYPE)
+    response['ETag'] = etag
+    # Let browsers keep tiles but revalidate them against the ETag on every use
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def get_tree_snapshot(request):
+    """
+    GeoJSON of every live tree for the public map, served from a precomputed, precompressed snapshot.
+    Repeat visitors revalidate with If-None-Match / If-Modified-Since and usually get a 304.
+    """
+    version, meta = get_snapshot_meta()
+    etag = meta['etag']
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        # Every encoding of the snapshot shares the hash, so any of its tags matches
+        not_modified = if_none_match.strip() == '*' or etag in if_none_match
+    else:
+        since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+        not_modified = since is not None and int(meta['last_modified'].timestamp()) <= since
+
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    tag = f'"{etag}"' if encoding == 'identity' else f'"{etag}-{encoding}"'
+    if not_modified:
+        response = HttpResponse(status=304)
+    else:
+        meta, body = get_snapshot_body(version, meta, encoding)
+        response = HttpResponse(body, content_type=EXPORT_FORMATS['geojson'][0])
+        if encoding != 'identity':
+            response['Content-Encoding'] = encoding
+    response['ETag'] = tag
+    response['Last-Modified'] = http_date(meta['last_modified'].timestamp())
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = 'public, no-cache'
+    return response
+
+CHANGES_PAGE_SIZE = 1000
+CHANGES_MAX_PAGE_SIZE = 5000
+
+def encode_change_cursor(updated_at, tree_id):
+    """Opaque "<microseconds since epoch>-<id>" position in the (updated_at, id) ordering"""
+    micros = (updated_at - datetime(1970, 1, 1, tzinfo=dt_timezone.utc)) // timedelta(microseconds=1)
+    return f"{micros}-{tree_id}"
+
+def decode_change_cursor(cursor):
+    """Inverse of encode_change_cursor; raises ValueError for anything it could not have produced"""
+    micros, tree_id = cursor.split('-')
+    try:
+        updated_at = datetime(1970, 1, 1, tzinfo=dt_timezone.utc) + timedelta(microseconds=int(micros))
+    except OverflowError:
+        raise ValueError("cursor is out of range")
+    return updated_at, int(tree_id)
+
+def get_tree_changes(request):
+    """
+    API endpoint for incremental map sync: ?since=<cursor> returns trees changed
+    after the cursor as upserts, soft-deleted trees as tombstones, and the next cursor.
+    Without since it pages through the whole catalog. Keep polling while has_more is true.
+    """
+    try:
+        limit = min(int(request.GET.get('limit', CHANGES_PAGE_SIZE)), CHANGES_MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return JsonResponse({"error": "Invalid limit"}, status=400)
+
+    trees = TreeSubmission.objects.select_related('user', 'image').order_by('updated_at', 'id')
+
+    since = request.GET.get('since')
+    if since:
+        try:
+            updated_at, tree_id = decode_change_cursor(since)
+        except ValueError:
+            return JsonResponse({"error": "Invalid cursor"}, status=400)
+        trees = trees.filter(Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, id__gt=tree_id))
+
+    # Fetch one extra row to know whether another page follows
+    page = list(trees[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    upserts = [tree_to_dict(tree) for tree in page if not tree.is_deleted]
+    deleted = [tree.id for tree in page if tree.is_deleted]
+    cursor = encode_change_cursor(page[-1].updated_at, page[-1].id) if page else since
+
+    return JsonResponse({
+        'upserts': upserts,
+        'deleted': deleted,
+        'cursor': cursor,
+        'has_more': has_more,
+    })
+
 def feedback_success(request):
     return render(request, 'home/submission_success.html')
 
@@ -674,28 +975,139 @@ def learn(request):
 
 @login_required
 def export_trees_csv(request):
-    response = HttpResponse(
-        content_type="text/csv",
-        headers={"Content-Disposition": 'attachment; filename="charlottesville_trees.csv"'},
+    """
+    Export active trees as ?format=csv (default), geojson or ndjson.
+    Accepts the filters understood by filter_export_trees (bbox, species, start, end, submitter, flagged).
+    """
+    export_format = request.GET.get('format', 'csv').lower()
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({"error": "format must be one of: csv, geojson, ndjson"}, status=400)
+
+    try:
+        trees = filter_export_trees(request.GET)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    content_type, extension = EXPORT_FORMATS[export_format]
+    # Stream rows straight from a database cursor so memory stays flat for any catalog size
+    return StreamingHttpResponse(
+        EXPORT_WRITERS[export_format](export_rows(trees)),
+        content_type=content_type,
+        headers={"Content-Disposition": f'attachment; filename="charlottesville_trees.{extension}"'},
     )
 
-    writer = csv.writer(response)
-    writer.writerow(["ID", "Species", "Description", "Latitude", "Longitude", "Submitted By", "Date"])
+def export_job_to_dict(job):
+    data = {
+        'id': job.id,
+        'status': job.status,
+        'format': job.format,
+        'params': job.params,
+        'size': job.size,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.status == 'done':
+        data['download_url'] = reverse('download_export_job', args=[job.id])
+    if job.status == 'failed':
+        data['error'] = job.error
+    return data
 
-    # Query only active (non-deleted) trees
-    trees = TreeSubmission.objects.filter(is_deleted=False)
+@login_required
+def create_export_job(request):
+    """
+    Queue a background export with the same format/filters as /api/trees/export/.
+    Identical requests against an unchanged catalog reuse the existing job and file.
+    Session-authenticated, so the POST has to carry the CSRF token.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST required"}, status=405)
+
+    params = request.POST if request.POST else request.GET
+    try:
+        job, created = request_export(params.get('format', 'csv').lower(), params, user=request.user)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    return JsonResponse(export_job_to_dict(job), status=201 if created else 200)
+
+@login_required
+def export_job_status(request, job_id):
+    job = get_object_or_404(ExportJob, id=job_id)
+    return JsonResponse(export_job_to_dict(job))
+
+RANGE_CHUNK_SIZE = 64 * 1024
 
-    for tree in trees:
-        writer.writerow([
-            tree.id,
-            tree.species,
-            tree.description,
-            tree.latitude,
-            tree.longitude,
-            tree.user.get_display_name(),
-            tree.submitted_at.strftime("%Y-%m-%d %H:%M:%S"),
-        ])
+def parse_range_header(header, size):
+    """
+    Parse a single "bytes=start-end" range against a file of `size` bytes.
+    Returns (start, end) inclusive, None when absent or unsupported, or raises ValueError if unsatisfiable.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if start:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start = max(size - int(end), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+def iter_file_range(fileobj, start, length):
+    try:
+        fileobj.seek(start)
+        while length > 0:
+            chunk = fileobj.read(min(RANGE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        fileobj.close()
 
+@login_required
+def download_export_job(request, job_id):
+    """Serve a finished export; local files honour Range/If-Range so interrupted downloads can resume"""
+    job = get_object_or_404(ExportJob, id=job_id)
+    if job.status != 'done' or not job.file:
+        return JsonResponse({"error": "Export is not ready"}, status=409)
+
+    if not isinstance(job.file.storage, FileSystemStorage):
+        # S3 serves byte ranges natively, so hand the client the object URL
+        return redirect(job.file.url)
+
+    content_type, extension = EXPORT_FORMATS[job.format]
+    etag = f'"{job.key}"'
+    size = job.file.size
+
+    byte_range = None
+    if request.headers.get('If-Range', etag) == etag:
+        try:
+            byte_range = parse_range_header(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    start, end = byte_range if byte_range else (0, size - 1)
+    length = end - start + 1
+    response = StreamingHttpResponse(
+        iter_file_range(job.file.open('rb'), start, length),
+        status=206 if byte_range else 200,
+        content_type=content_type,
+    )
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Content-Disposition'] = f'attachment; filename="charlottesville_trees.{extension}"'
     return response
 
 @login_required
@@ -817,6 +1229,53 @@ def manage_images(request):
     return render(request, 'home/manage_images.html', {'formset': formset})
 
 
+@login_required
+def request_upload_ticket(request):
+    """
+    Start a direct upload: returns a presigned POST ({"url", "fields"}) for the browser to send the file
+    straight to the bucket, plus a ticket to pass to confirm_direct_upload afterwards.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    if not settings.IMAGE_DIRECT_UPLOADS:
+        return JsonResponse({'error': 'Direct uploads are disabled'}, status=404)
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+
+    size = data.get('size')
+    if size is not None and not isinstance(size, int):
+        return JsonResponse({'error': 'size must be an integer'}, status=400)
+    try:
+        ticket = create_upload_ticket(request.user, data.get('category'), data.get('content_type'), size)
+    except DirectUploadError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(ticket)
+
+
+@login_required
+def confirm_direct_upload(request):
+    """
+    Finish a direct upload: checks the staged file's size and type and creates its CustomImage, whose id forms
+    can attach. The image stays pending until an upload worker has normalized and stored it.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    if not settings.IMAGE_DIRECT_UPLOADS:
+        return JsonResponse({'error': 'Direct uploads are disabled'}, status=404)
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+
+    try:
+        image = confirm_upload(request.user, str(data.get('ticket', '')))
+    except DirectUploadError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'id': image.id, 'status': image.status, 'preview_url': image.preview_url}, status=201)
+
+
 @login_required
 @csrf_exempt
 def image_toggle(request, image_id):